@@ -0,0 +1,538 @@
+# PURPOSE: A stand-in for the Metashape python module, so the batch tooling and templates can be run (and timed) on any Linux box.
+# It covers what scripts/ and metashape_batch use: Document, Chunk, cameras and sensors, markers, scalebars, tie point filters, Vector/Matrix,
+# the region, CoordinateSystem and the enums. Processing calls do no photogrammetry: they sleep for a configurable latency and fill the
+# chunk with synthetic products of a configurable size (markers, tie points, depth maps, a mesh), and the exports write real files (a
+# small OBJ/MTL mesh, a placeholder PDF) so that later steps have something to read.
+#
+# Put bench/ first on sys.path (or PYTHONPATH) to use it. Configure with Metashape.configure(...) or, for child processes, the
+# FAKE_METASHAPE environment variable holding the same settings as JSON, ex:
+#     FAKE_METASHAPE='{"latency": {"buildDepthMaps": 0.5}, "markers": 48, "faces": 20000}'
+
+import copy
+import json
+import math
+import os
+import time
+
+
+CONFIG = {
+    "latency": {},           # seconds slept by each processing call (by method name)
+    "default_latency": 0.0,
+    "markers": 48,           # markers found by detectMarkers, labelled "target 1", "target 2", ...
+    "tie_points": 10000,
+    "faces": 5000,           # faces in the built mesh
+    "sensor": [4000, 3000],  # image width, height (px)
+    "align_fraction": 1.0,   # share of cameras that align
+    "rescue_align_fraction": None,  # share that align when matched without reference preselection (default: align_fraction)
+    "project_bytes": 1024,   # bytes written per save
+}
+
+
+def configure(**settings):
+    """Update the fake's settings (see CONFIG)."""
+    for key, value in settings.items():
+        if key not in CONFIG:
+            raise KeyError("Unknown fake Metashape setting {!r}".format(key))
+        if key == "latency":
+            CONFIG["latency"].update(value)
+        else:
+            CONFIG[key] = value
+
+
+if os.environ.get("FAKE_METASHAPE"):
+    configure(**json.loads(os.environ["FAKE_METASHAPE"]))
+
+
+def _work(name):
+    seconds = CONFIG["latency"].get(name, CONFIG["default_latency"])
+    if seconds:
+        time.sleep(seconds)
+
+
+### Enums. Any name not defined here resolves to an enum value of that name (ex. Metashape.MildFiltering).
+
+class Enum(str):
+    def __repr__(self):
+        return "Metashape." + self
+
+
+def __getattr__(name):
+    if name[:1].isupper():
+        return Enum(name)
+    raise AttributeError(name)
+
+
+### Geometry
+
+class Vector:
+    def __init__(self, values):
+        self._v = [float(x) for x in values]
+
+    def __len__(self):
+        return len(self._v)
+
+    def __iter__(self):
+        return iter(self._v)
+
+    def __getitem__(self, i):
+        return self._v[i]
+
+    def __setitem__(self, i, value):
+        self._v[i] = float(value)
+
+    def __add__(self, other):
+        return Vector(a + b for a, b in zip(self._v, other))
+
+    def __sub__(self, other):
+        return Vector(a - b for a, b in zip(self._v, other))
+
+    def __mul__(self, k):
+        return Vector(a * k for a in self._v)
+
+    __rmul__ = __mul__
+
+    def __truediv__(self, k):
+        return Vector(a / k for a in self._v)
+
+    def __neg__(self):
+        return Vector(-a for a in self._v)
+
+    def __eq__(self, other):
+        return isinstance(other, Vector) and self._v == other._v
+
+    def __repr__(self):
+        return "Vector([{}])".format(", ".join(repr(a) for a in self._v))
+
+    @property
+    def x(self):
+        return self._v[0]
+
+    @property
+    def y(self):
+        return self._v[1]
+
+    @property
+    def z(self):
+        return self._v[2]
+
+    @property
+    def size(self):
+        return len(self._v)
+
+    def norm(self):
+        return math.sqrt(sum(a * a for a in self._v))
+
+    def normalized(self):
+        return self / self.norm()
+
+    def list(self):
+        return list(self._v)
+
+
+class Matrix:
+    def __init__(self, rows=None):
+        self._m = [[float(x) for x in row] for row in rows] if rows is not None else _identity(4)
+
+    @staticmethod
+    def Diag(values):
+        values = list(values)
+        return Matrix([[values[i] if i == j else 0. for j in range(len(values))] for i in range(len(values))])
+
+    @staticmethod
+    def Translation(v):
+        m = _identity(4)
+        for i in range(3):
+            m[i][3] = v[i]
+        return Matrix(m)
+
+    @staticmethod
+    def Rotation(r):
+        m = _identity(4)
+        for i in range(3):
+            for j in range(3):
+                m[i][j] = r[i, j]
+        return Matrix(m)
+
+    @property
+    def size(self):
+        return (len(self._m), len(self._m[0]))
+
+    def __getitem__(self, index):
+        i, j = index
+        return self._m[i][j]
+
+    def __setitem__(self, index, value):
+        i, j = index
+        self._m[i][j] = float(value)
+
+    def __mul__(self, other):
+        if isinstance(other, Matrix):
+            return Matrix([[sum(self._m[i][k] * other._m[k][j] for k in range(len(other._m))) for j in range(len(other._m[0]))]
+                           for i in range(len(self._m))])
+        if isinstance(other, Vector):
+            return Vector(sum(a * b for a, b in zip(row, other)) for row in self._m)
+        return Matrix([[a * other for a in row] for row in self._m])
+
+    def __repr__(self):
+        return "Matrix({})".format(self._m)
+
+    def t(self):
+        return Matrix([list(col) for col in zip(*self._m)])
+
+    def inv(self):
+        n = len(self._m)
+        a = [row[:] + [1. if i == j else 0. for j in range(n)] for i, row in enumerate(self._m)]
+        for col in range(n):
+            pivot = max(range(col, n), key=lambda r: abs(a[r][col]))
+            if abs(a[pivot][col]) < 1e-15:
+                raise ValueError("Singular matrix")
+            a[col], a[pivot] = a[pivot], a[col]
+            p = a[col][col]
+            a[col] = [x / p for x in a[col]]
+            for r in range(n):
+                if r != col and a[r][col]:
+                    f = a[r][col]
+                    a[r] = [x - f * y for x, y in zip(a[r], a[col])]
+        return Matrix([row[n:] for row in a])
+
+    def mulp(self, v):
+        """Transform a point (homogeneous 4x4 times a 3 vector)."""
+        x = list(v) + [1.]
+        out = [sum(self._m[i][k] * x[k] for k in range(4)) for i in range(4)]
+        return Vector(c / out[3] for c in out[:3])
+
+    def mulv(self, v):
+        """Transform a direction (no translation)."""
+        return Vector(sum(self._m[i][k] * v[k] for k in range(3)) for i in range(3))
+
+    def scale(self):
+        return math.sqrt(self._m[0][0] ** 2 + self._m[0][1] ** 2 + self._m[0][2] ** 2)
+
+    def rotation(self):
+        s = self.scale()
+        return Matrix([[self._m[i][j] / s for j in range(3)] for i in range(3)])
+
+    def translation(self):
+        return Vector(self._m[i][3] for i in range(3))
+
+
+def _identity(n):
+    return [[1. if i == j else 0. for j in range(n)] for i in range(n)]
+
+
+class CoordinateSystem:
+    """A local (metric, un-projected) coordinate system: project, unproject and localframe are identities."""
+
+    def __init__(self, wkt="LOCAL_CS[\"Local Coordinates (m)\"]"):
+        self.wkt = wkt
+        self.name = wkt.split('"')[1] if '"' in wkt else wkt
+
+    def project(self, v):
+        return Vector(v)
+
+    def unproject(self, v):
+        return Vector(v)
+
+    def localframe(self, v):
+        return Matrix()
+
+
+### Project contents
+
+class Sensor:
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+
+
+class Reference:
+    def __init__(self):
+        self.location = None
+        self.enabled = True
+        self.distance = None
+        self.accuracy = None
+
+
+class Photo:
+    def __init__(self, path):
+        self.path = path
+
+    def copy(self):
+        return Photo(self.path)
+
+
+class Camera:
+    def __init__(self, path, sensor):
+        self.label = os.path.splitext(os.path.basename(path))[0]
+        self._photo = Photo(path)
+        self.sensor = sensor
+        self.transform = None
+        self.enabled = True
+        self.reference = Reference()
+
+    @property
+    def photo(self):
+        """A copy, as in Metashape: changes to it only take once it is set back."""
+        return self._photo.copy()
+
+    @photo.setter
+    def photo(self, photo):
+        self._photo = photo
+
+
+class Marker:
+    def __init__(self, label):
+        self.label = label
+        self.reference = Reference()
+        self.position = Vector([0, 0, 0])
+        self.projections = {}  # camera -> projection
+
+
+class Scalebar:
+    def __init__(self, point0, point1):
+        self.point0 = point0
+        self.point1 = point1
+        self.label = point0.label + "_" + point1.label
+        self.reference = Reference()
+
+
+class Region:
+    def __init__(self):
+        self.center = Vector([0, 0, 0])
+        self.size = Vector([1, 1, 1])
+        self.rot = Matrix.Diag([1, 1, 1])
+
+
+class TiePoints:
+    class Filter:
+        ReconstructionUncertainty = Enum("ReconstructionUncertainty")
+        ReprojectionError = Enum("ReprojectionError")
+        ProjectionAccuracy = Enum("ProjectionAccuracy")
+        ImageCount = Enum("ImageCount")
+
+        def init(self, chunk, criterion):
+            self.chunk = chunk
+            self.criterion = criterion
+
+        def removePoints(self, threshold):
+            _work("removePoints")
+            points = self.chunk.tie_points
+            if points is not None:
+                points.points = points.points[:max(1, int(len(points.points) * 0.9))]
+
+    def __init__(self, count):
+        self.points = list(range(count))
+
+
+PointCloud = TiePoints
+
+
+class DepthMaps(dict):
+    pass
+
+
+class Model:
+    class Criterion:
+        ComponentSize = Enum("ComponentSize")
+
+    def __init__(self, faces):
+        self.faces = list(range(faces))
+        self.vertices = list(range(faces // 2 + 2))
+        self.textures = []
+
+    def cleanModel(self, criterion=None, level=0):
+        _work("cleanModel")
+        self.faces = self.faces[:max(1, len(self.faces) * (100 - level // 2) // 100)]
+
+    def removeComponents(self, max_components=1):
+        _work("removeComponents")
+
+
+class Chunk:
+    def __init__(self):
+        self.label = "Chunk 1"
+        self.cameras = []
+        self.markers = []
+        self.scalebars = []
+        self.sensors = []
+        self.tie_points = None
+        self.point_cloud = None
+        self.depth_maps = None
+        self.model = None
+        self.crs = None
+        self.transform = type("ChunkTransform", (), {})()
+        self.transform.matrix = Matrix()
+        self._region = Region()
+
+    # Like Metashape, chunk.region hands out a copy; assign it back to change the region.
+    @property
+    def region(self):
+        return copy.deepcopy(self._region)
+
+    @region.setter
+    def region(self, value):
+        self._region = copy.deepcopy(value)
+
+    def addPhotos(self, filenames, **kwargs):
+        _work("addPhotos")
+        sensor = Sensor(*CONFIG["sensor"])
+        self.sensors = [sensor]
+        self.cameras.extend(Camera(path, sensor) for path in filenames)
+
+    def detectMarkers(self, **kwargs):
+        _work("detectMarkers")
+        known = set(marker.label for marker in self.markers)
+        self.markers.extend(Marker("target {}".format(i)) for i in range(1, CONFIG["markers"] + 1) if "target {}".format(i) not in known)
+        for marker in self.markers:
+            marker.projections = {camera: Vector([0, 0]) for camera in self.cameras}
+
+    def matchPhotos(self, **kwargs):
+        _work("matchPhotos")
+        self.tie_points = TiePoints(CONFIG["tie_points"] if self.cameras else 0)
+        self._preselected = kwargs.get("reference_preselection", True)
+
+    def alignCameras(self, **kwargs):
+        _work("alignCameras")
+        fraction = CONFIG["align_fraction"]
+        if not getattr(self, "_preselected", True) and CONFIG["rescue_align_fraction"] is not None:
+            fraction = CONFIG["rescue_align_fraction"]
+        aligned = int(round(len(self.cameras) * fraction))
+        for i, camera in enumerate(self.cameras):
+            camera.transform = Matrix() if i < aligned else None
+
+    def importReference(self, path=None, format=None, delimiter=",", columns="nxyz", skip_rows=0, crs=None, **kwargs):
+        _work("importReference")
+        by_label = {marker.label: marker for marker in self.markers}
+        with open(path) as f:
+            lines = f.read().splitlines()[skip_rows:]
+        for line in lines:
+            fields = line.split(delimiter)
+            if fields and fields[0] in by_label:
+                numbers = [float(x) for x in fields[1:] if x.strip()]
+                if len(numbers) >= 3:
+                    by_label[fields[0]].reference.location = Vector(numbers[:3])
+        if crs is not None:
+            self.crs = crs
+
+    def updateTransform(self):
+        _work("updateTransform")
+
+    def addScalebar(self, point0, point1):
+        scalebar = Scalebar(point0, point1)
+        self.scalebars.append(scalebar)
+        return scalebar
+
+    def remove(self, items):
+        for item in list(items):
+            for products in (self.cameras, self.markers, self.scalebars):
+                if item in products:
+                    products.remove(item)
+
+    def optimizeCameras(self, **kwargs):
+        _work("optimizeCameras")
+
+    def buildDepthMaps(self, **kwargs):
+        _work("buildDepthMaps")
+        self.depth_maps = DepthMaps((camera.label, None) for camera in self.cameras if camera.transform is not None)
+
+    def buildModel(self, **kwargs):
+        _work("buildModel")
+        self.model = Model(CONFIG["faces"])
+
+    def buildUV(self, **kwargs):
+        _work("buildUV")
+
+    def buildTexture(self, **kwargs):
+        _work("buildTexture")
+        if self.model is not None:
+            self.model.textures = ["Texture 1"]
+
+    def exportModel(self, path=None, **kwargs):
+        _work("exportModel")
+        _write_obj(path, len(self.model.faces) if self.model is not None else 0)
+
+    def exportReport(self, path=None, title="", **kwargs):
+        _work("exportReport")
+        with open(path, "wb") as f:
+            f.write(b"%PDF-1.4\n% fake Metashape report: " + title.encode() + b"\n%%EOF\n")
+
+
+def _write_obj(path, faces):
+    """A closed, watertight mesh of about `faces` triangles: a UV sphere of radius 2 cm."""
+    mtl = os.path.splitext(path)[0] + ".mtl"
+    rings = max(3, int(math.sqrt(faces / 2.)))
+    segments = max(3, faces // (2 * rings))
+    lines = ["mtllib " + os.path.basename(mtl), "usemtl material0"]
+    lines.append("v 0 0 0.02")
+    for i in range(1, rings):
+        phi = math.pi * i / rings
+        for j in range(segments):
+            theta = 2 * math.pi * j / segments
+            lines.append("v {:.6f} {:.6f} {:.6f}".format(0.02 * math.sin(phi) * math.cos(theta), 0.02 * math.sin(phi) * math.sin(theta),
+                                                          0.02 * math.cos(phi)))
+    lines.append("v 0 0 -0.02")
+    bottom = 2 + (rings - 1) * segments
+
+    def ring(i, j):
+        return 2 + (i - 1) * segments + j % segments
+
+    for j in range(segments):
+        lines.append("f 1 {} {}".format(ring(1, j), ring(1, j + 1)))
+        lines.append("f {} {} {}".format(bottom, ring(rings - 1, j + 1), ring(rings - 1, j)))
+    for i in range(1, rings - 1):
+        for j in range(segments):
+            a, b, c, d = ring(i, j), ring(i, j + 1), ring(i + 1, j), ring(i + 1, j + 1)
+            lines.append("f {} {} {}".format(a, c, d))
+            lines.append("f {} {} {}".format(a, d, b))
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    with open(mtl, "w") as f:
+        f.write("newmtl material0\nKd 1 1 1\n")
+
+
+class Document:
+    def __init__(self):
+        self.chunks = []
+        self.chunk = None
+        self.path = ""
+
+    def addChunk(self):
+        chunk = Chunk()
+        self.chunks.append(chunk)
+        self.chunk = chunk
+        return chunk
+
+    def save(self, path=None, **kwargs):
+        _work("save")
+        if path:
+            self.path = path
+        with open(self.path, "wb") as f:
+            f.write(b"\0" * CONFIG["project_bytes"])
+        _SAVED[os.path.abspath(self.path)] = copy.deepcopy(self.chunks)
+
+    def open(self, path, read_only=False, ignore_lock=False, **kwargs):
+        _work("open")
+        if not os.path.exists(path):
+            raise OSError("Can't open file: " + path)
+        self.path = path
+        self.chunks = copy.deepcopy(_SAVED.get(os.path.abspath(path), []))
+        self.chunk = self.chunks[0] if self.chunks else None
+
+
+# Saved projects, by path, so a document reopened in the same process gets its chunks back.
+_SAVED = {}
+
+
+class Application:
+    version = "2.2.1.20000"
+
+    def __init__(self):
+        self.document = Document()
+        self.cpu_enable = True
+        self.gpu_mask = 0
+
+    def update(self):
+        pass
+
+
+app = Application()
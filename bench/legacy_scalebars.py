@@ -0,0 +1,58 @@
+# PURPOSE: The Create_Scalebars() block that the templates used to paste in (SCALEBARSDEF), kept as is for the scalebar benchmark so the
+# indexed metashape_batch.scalebars module can be compared against it. The chunk and scale file path are arguments instead of globals.
+
+import Metashape
+
+
+def Create_Scalebars(chunk, scalebars_path):
+
+    iNumScaleBars=len(chunk.scalebars)
+    iNumMarkers=len(chunk.markers)
+    if (iNumMarkers == 0):
+        raise Exception("No markers found. Unable to create scalebars")
+    if (iNumScaleBars > 0):
+        print("There are already ",iNumScaleBars," scalebars in this project.")
+
+    file = open(scalebars_path)
+    eof = False
+    line = file.readline()
+    while not eof:
+        point1, point2, dist, acc = line.split(",")
+        scalebarfound=0
+        if (iNumScaleBars > 0):
+            for sbScaleBar in chunk.scalebars:
+                strScaleBarLabel_1=point1+"_"+point2
+                strScaleBarLabel_2=point2+"_"+point1
+                if sbScaleBar.label==strScaleBarLabel_1 or sbScaleBar.label==strScaleBarLabel_2:
+                    scalebarfound=1
+                    sbScaleBar.reference.distance=float(dist)
+                    sbScaleBar.reference.accuracy=float(acc)
+        if (scalebarfound==0):
+            bMarker1Found=0
+            for marker in chunk.markers:
+                if (marker.label == point1):
+                    marker1 = marker
+                    bMarker1Found=1
+                    break
+            bMarker2Found=0
+            for marker in chunk.markers:
+                if (marker.label == point2):
+                    marker2 = marker
+                    bMarker2Found=1
+                    break
+            if bMarker1Found==1 and bMarker2Found==1:
+                sbScaleBar = chunk.addScalebar(marker1,marker2)
+                sbScaleBar.reference.distance=float(dist)
+                sbScaleBar.reference.accuracy=float(acc)
+            else:
+                if (bMarker1Found == 0):
+                    print("Marker "+point1+" was not found")
+                if (bMarker2Found == 0):
+                    print("Marker "+point2+" was not found")
+        line = file.readline()
+        if not len(line):
+            eof = True
+            break
+
+    file.close()
+    Metashape.app.update()
@@ -0,0 +1,215 @@
+# PURPOSE: Time the batch tooling end to end against the fake Metashape module (bench/Metashape), on any Linux box.
+# Covers the orchestration around Metashape rather than Metashape itself: generating a batch (scripts and runner manifests), running a
+# manifest through the batch runner, creating scalebars (metashape_batch.scalebars and the legacy Create_Scalebars block of the templates) and the
+# bounding box math. Each benchmark runs a few times and the median is reported; results can be saved as JSON and compared against a
+# saved baseline to catch regressions.
+#
+# Ex: python3 bench/run_benchmarks.py
+#     python3 bench/run_benchmarks.py --save bench/baseline.json
+#     python3 bench/run_benchmarks.py --compare bench/baseline.json --threshold 1.25
+#     python3 bench/run_benchmarks.py --only runner scalebars --photosets 50
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))  # metashape_batch
+sys.path.insert(0, BENCH_DIR)  # the fake Metashape module
+
+import Metashape  # noqa: E402  (the fake)
+
+from metashape_batch import generate  # noqa: E402
+from metashape_batch import pipeline  # noqa: E402
+from metashape_batch import profiles  # noqa: E402
+from metashape_batch import runner  # noqa: E402
+from metashape_batch import scalebars as scalebar_tools  # noqa: E402
+
+import legacy_scalebars  # noqa: E402
+
+
+def make_tree(root, photosets, images, extension=".bmp", timepoint="010125"):
+    """Source tree of tiny photos: root/source_images/Bench/<timepoint>/<photoset>/<image>. Each holds its own path, so no two photosets
+    look like copies of each other to the generator's fingerprinting."""
+    source = os.path.join(root, "source_images", "Bench", timepoint)
+    for i in range(photosets):
+        photoset = os.path.join(source, "{}_set{:03d}".format(timepoint, i))
+        os.makedirs(photoset)
+        for j in range(images):
+            path = os.path.join(photoset, "IMG_{:04d}{}".format(j, extension))
+            with open(path, "w") as f:
+                f.write(path)
+    return source
+
+
+def bench_profile(root, name="fragram"):
+    return profiles.get_profile(name, project="Bench", source_root=os.path.join(root, "source_images"),
+                                models_root=os.path.join(root, "models"), torun_root=os.path.join(root, "ToRun"))
+
+
+def timed(fn, repeat):
+    """Run fn() `repeat` times. Returns the list of times (s)."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+@contextlib.contextmanager
+def quiet():
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+### Benchmarks. Each takes the parsed options and a scratch directory and returns {name: [times]}.
+
+def bench_generate(args, tmp):
+    make_tree(tmp, args.photosets, args.images)
+    profile = bench_profile(tmp)
+    results = {}
+    for mode in ("scripts", "runner"):
+        def run():
+            with quiet():
+                generate.generate(profile, "010125", slm_dir=tmp, mode=mode, schedule_all=True)
+        results["generate_" + mode] = timed(run, args.repeat)
+    return results
+
+
+def bench_runner(args, tmp):
+    make_tree(tmp, args.photosets, args.images)
+    profile = bench_profile(tmp)
+    with quiet():
+        result = generate.generate(profile, "010125", slm_dir=tmp, mode="runner", schedule_all=True)
+    manifest = runner.load_manifest(result["manifest"])
+    models = result["dirs"]["models_dir"]
+
+    def run():
+        shutil.rmtree(models)
+        with quiet():
+            failed = runner.run_manifest(manifest, resume=False)
+        if failed:
+            raise RuntimeError("Runner benchmark failed for: " + ", ".join(failed))
+
+    def resume():
+        with quiet():
+            runner.run_manifest(manifest, resume=True)
+
+    return {"runner_build": timed(run, args.repeat), "runner_resume_complete": timed(resume, args.repeat)}
+
+
+def _marker_chunk(markers):
+    Metashape.configure(markers=markers)
+    chunk = Metashape.Document().addChunk()
+    chunk.detectMarkers()
+    return chunk
+
+
+def bench_scalebars(args, tmp):
+    # Bars between neighbouring targets; the last few name targets beyond those detected, so both paths also report missing markers.
+    path = os.path.join(tmp, "scalebars.txt")
+    with open(path, "w") as f:
+        f.write("".join("target {},target {},0.1166,0.0005\n".format(i, i + 1) for i in range(1, args.bars + 1)))
+
+    def run_module():
+        scalebar_tools.apply(_marker_chunk(args.markers), scalebar_tools.read(path))
+
+    def run_legacy():
+        chunk = _marker_chunk(args.markers)
+        with quiet():
+            legacy_scalebars.Create_Scalebars(chunk, path)
+
+    return {"scalebars_module": timed(run_module, args.repeat), "scalebars_legacy_template": timed(run_legacy, args.repeat)}
+
+
+def bench_region(args, tmp):
+    profile = profiles.get_profile("fragram")
+    model = pipeline.Model(os.path.join(tmp, "set"), tmp, profile)
+    model.chunk = Metashape.Document().addChunk()
+    model.chunk.crs = Metashape.CoordinateSystem(pipeline.LOCAL_CRS)
+    model.chunk.transform.matrix = Metashape.Matrix.Diag([0.5, 0.5, 0.5, 1])
+
+    def run():
+        with quiet():
+            for _ in range(args.region_repeat):
+                pipeline.region(model)
+
+    return {"region_x{}".format(args.region_repeat): timed(run, args.repeat)}
+
+
+BENCHMARKS = {
+    "generate": bench_generate,
+    "runner": bench_runner,
+    "scalebars": bench_scalebars,
+    "region": bench_region,
+}
+
+
+def summarise(times):
+    return {"median": statistics.median(times), "min": min(times), "max": max(times), "n": len(times)}
+
+
+def compare(results, baseline, threshold):
+    """Names of the benchmarks whose median is more than `threshold` times the baseline's."""
+    slower = []
+    for name, stats in sorted(results.items()):
+        if name in baseline and stats["median"] > baseline[name]["median"] * threshold:
+            slower.append(name)
+    return slower
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Benchmark the batch tooling against the fake Metashape module.")
+    parser.add_argument("--only", nargs="+", choices=sorted(BENCHMARKS), help="benchmarks to run (default: all)")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per benchmark (default: 5)")
+    parser.add_argument("--photosets", type=int, default=20, help="photosets in the synthetic timepoint (default: 20)")
+    parser.add_argument("--images", type=int, default=60, help="images per photoset (default: 60)")
+    parser.add_argument("--markers", type=int, default=200, help="markers in the scalebar benchmark chunk (default: 200)")
+    parser.add_argument("--bars", type=int, default=205, help="lines in the scalebar benchmark scale file (default: 205)")
+    parser.add_argument("--region-repeat", type=int, default=1000, help="region calculations per run (default: 1000)")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds each fake processing call takes (default: 0)")
+    parser.add_argument("--save", metavar="JSON", help="write the results to this file")
+    parser.add_argument("--compare", metavar="JSON", help="compare against results saved with --save")
+    parser.add_argument("--threshold", type=float, default=1.25, help="slow down (median ratio) that counts as a regression")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    Metashape.configure(default_latency=args.latency)
+    results = {}
+    for name in args.only or sorted(BENCHMARKS):
+        tmp = tempfile.mkdtemp(prefix="metashape_bench_")
+        try:
+            for bench, times in BENCHMARKS[name](args, tmp).items():
+                results[bench] = summarise(times)
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    print("{:<32} {:>12} {:>12} {:>12}".format("benchmark", "median ms", "min ms", "max ms"))
+    for name, stats in sorted(results.items()):
+        print("{:<32} {:>12.2f} {:>12.2f} {:>12.2f}".format(name, stats["median"] * 1e3, stats["min"] * 1e3, stats["max"] * 1e3))
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            slower = compare(results, json.load(f), args.threshold)
+        if slower:
+            print("Slower than {} (x{}): {}".format(args.compare, args.threshold, ", ".join(slower)))
+            return 1
+        print("No regressions against {}".format(args.compare))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
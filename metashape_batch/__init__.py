@@ -0,0 +1,8 @@
+"""Batch tooling for the Metashape photogrammetry pipeline.
+
+The modules in this package replace the shell/sed template expansion in
+``buildscripts_*.sh`` and carry the shared logic used when building many
+scaled coral models on the HPC with a single Metashape licence.
+"""
+
+__version__ = "2.1.0"
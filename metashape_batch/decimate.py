@@ -0,0 +1,190 @@
+# PURPOSE: Write a light version (level of detail, LOD) of each exported model next to the full one, so quick QA and trait screening can
+# run on a few hundred thousand faces while the full HighFaceCount model with its 8192 textures is archived.
+# The mesh is simplified by vertex clustering with quadric error metrics, which (unlike edge collapse one edge at a time) is a handful of
+# whole-array numpy passes: the vertices are binned into a grid of cubic cells, each cell becomes one vertex, and that vertex is placed
+# where it best fits the planes of the faces around it (the point minimising the summed squared distances to those planes, weighted by
+# face area; the cell's mean vertex if that point falls outside the cell). Faces whose corners land in fewer than three cells vanish.
+# The cell size is found by bisection so the result has close to the requested number of faces. Coordinates are not transformed, so
+# the LOD keeps the scale of the full model (metres in the local CRS). Vertex colors are averaged per cell; texture coordinates and
+# normals are not carried over (the LOD is geometry for screening, not a textured copy).
+#
+# LODs are written to lod/<name>.obj in the models directory. The batch runner writes one for every finished model with --lod FACES (or
+# generate ... --lod FACES, which stores it in the manifest); by hand:
+#     python3 -m metashape_batch.decimate /scratch1/migomez/3Dmodels/models/SinglePolyp/090425/*.obj --faces 200000
+
+import argparse
+import os
+import sys
+
+import numpy as np
+
+from . import mesh as mesh_tools
+
+
+LOD_DIR = "lod"
+
+# Default LOD size (faces), and how far from it the bisection may stop.
+FACES = 200000
+TOLERANCE = 0.05
+MAX_ITERATIONS = 24
+
+# Weight pulling each cell's vertex towards the cell's mean vertex (relative to the quadric's size), so flat or linear cells, where the
+# plane fit has no single best point, stay well defined.
+REGULARISATION = 1e-3
+
+
+def lod_path(obj):
+    return os.path.join(os.path.dirname(os.path.abspath(obj)), LOD_DIR, os.path.basename(obj))
+
+
+def _cells(vertices, origin, cell):
+    """Cell of every vertex, numbered 0..n-1 over the cells that hold a vertex. Returns (cell index per vertex, number of cells)."""
+    grid = np.floor((vertices - origin) / cell).astype(np.int64)
+    dims = grid.max(axis=0) + 1
+    key = (grid[:, 0] * dims[1] + grid[:, 1]) * dims[2] + grid[:, 2]
+    _, index = np.unique(key, return_inverse=True)
+    return index.ravel(), int(index.max()) + 1 if len(index) else 0
+
+
+def _cluster_faces(faces, cells):
+    """The faces with their corners moved to their cells: degenerate faces (two corners in one cell) and repeats dropped."""
+    f = cells[faces]
+    keep = (f[:, 0] != f[:, 1]) & (f[:, 1] != f[:, 2]) & (f[:, 2] != f[:, 0])
+    f = f[keep]
+    _, first = np.unique(np.sort(f, axis=1), axis=0, return_index=True)
+    return f[np.sort(first)]
+
+
+def face_count(m, cell):
+    """Faces left after clustering a Mesh with cells of the given size (m)."""
+    cells, _ = _cells(m.vertices, m.vertices.min(axis=0), cell)
+    return len(_cluster_faces(m.faces, cells))
+
+
+def cluster(m, cell):
+    """Simplify a Mesh by clustering its vertices into cubic cells of the given size (m). Returns a new Mesh."""
+    origin = m.vertices.min(axis=0)
+    cells, n = _cells(m.vertices, origin, cell)
+    faces = _cluster_faces(m.faces, cells)
+
+    # Plane of every face (unit normal u, offset d) weighted by its area; the error of a point x is sum w (u . x + d)^2, whose minimum
+    # solves A x = -g with A = sum w u u^T and g = sum w d u, summed over the faces touching the cell.
+    a, b, c = (m.vertices[m.faces[:, k]] for k in range(3))
+    normal = np.cross(b - a, c - a)
+    double_area = np.linalg.norm(normal, axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        u = np.where(double_area[:, None] > 0, normal / double_area[:, None], 0.)
+    w = 0.5 * double_area
+    d = -np.einsum("ij,ij->i", u, a)
+    corner_cells = cells[m.faces].ravel()
+    A = np.zeros((n, 3, 3))
+    for i in range(3):
+        for j in range(i, 3):
+            A[:, i, j] = A[:, j, i] = np.bincount(corner_cells, np.repeat(w * u[:, i] * u[:, j], 3), n)
+    g = np.stack([np.bincount(corner_cells, np.repeat(w * d * u[:, i], 3), n) for i in range(3)], axis=1)
+
+    counts = np.bincount(cells, minlength=n)
+    mean = np.stack([np.bincount(cells, m.vertices[:, i], n) for i in range(3)], axis=1) / counts[:, None]
+    scale = np.trace(A, axis1=1, axis2=2) / 3
+    regularisation = REGULARISATION * np.where(scale > 0, scale, 1.)
+    A += regularisation[:, None, None] * np.eye(3)
+    vertices = np.linalg.solve(A, (-g + regularisation[:, None] * mean)[:, :, None])[:, :, 0]
+    low = origin + np.floor((mean - origin) / cell) * cell
+    outside = ((vertices < low) | (vertices > low + cell)).any(axis=1)
+    vertices[outside] = mean[outside]
+
+    colors = None
+    if m.colors is not None:
+        colors = (np.stack([np.bincount(cells, m.colors[:, i], n) for i in range(3)], axis=1) / counts[:, None]).astype(np.float32)
+
+    # Only cells that are a corner of a face left become vertices.
+    used = np.unique(faces)
+    remap = np.full(n, -1, dtype=np.int64)
+    remap[used] = np.arange(len(used))
+    return mesh_tools.Mesh(vertices[used], remap[faces].astype(m.faces.dtype), colors[used] if colors is not None else None)
+
+
+def decimate(m, faces=FACES, tolerance=TOLERANCE):
+    """Simplify a Mesh to about `faces` faces (within tolerance, or as close as MAX_ITERATIONS bisection steps get). A mesh that is
+    already small enough is returned as is. Returns (Mesh, cell size used or None)."""
+    if m.n_faces <= faces:
+        return m, None
+    m = mesh_tools.Mesh(m.vertices, m.faces, m.colors)
+    used = np.unique(m.faces)
+    if len(used) < m.n_vertices:  # unreferenced vertices would each add a cell
+        remap = np.zeros(m.n_vertices, dtype=np.int64)
+        remap[used] = np.arange(len(used))
+        m = mesh_tools.Mesh(m.vertices[used], remap[m.faces].astype(m.faces.dtype), m.colors[used] if m.colors is not None else None)
+
+    # A surface cut into cells of size h has about 2 * area / h^2 faces, which gives the first guess; then bisect (in log h) between
+    # cells that leave too many faces and cells that leave too few.
+    area = 0.5 * np.linalg.norm(np.cross(*(m.vertices[m.faces[:, k]] - m.vertices[m.faces[:, 0]] for k in (1, 2))), axis=1).sum()
+    cell = (2 * area / faces) ** 0.5
+    small, large = None, None
+    best = None
+    for _ in range(MAX_ITERATIONS):
+        n = face_count(m, cell)
+        if best is None or abs(n - faces) < abs(best[1] - faces):
+            best = (cell, n)
+        if abs(n - faces) <= tolerance * faces:
+            break
+        if n > faces:
+            small = cell
+            cell = cell * 2 if large is None else (cell * large) ** 0.5
+        else:
+            large = cell
+            cell = cell / 2 if small is None else (cell * small) ** 0.5
+    return cluster(m, best[0]), best[0]
+
+
+def write_obj(m, path, comment=None):
+    """Write a Mesh (vertices, with colors if it has them, and faces) as an OBJ, atomically."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        if comment:
+            f.write("# {}\n".format(comment))
+        if m.colors is not None:
+            f.write(("v %.6f %.6f %.6f %.4f %.4f %.4f\n" * m.n_vertices) % tuple(np.hstack([m.vertices, m.colors]).ravel()))
+        else:
+            f.write(("v %.6f %.6f %.6f\n" * m.n_vertices) % tuple(m.vertices.ravel()))
+        f.write(("f %d %d %d\n" * m.n_faces) % tuple((m.faces.astype(np.int64) + 1).ravel()))
+    os.replace(tmp, path)
+
+
+def decimate_file(obj, faces=FACES, out=None, cache=True):
+    """Write the LOD of an exported OBJ (default: lod/<name>.obj next to it). Returns (path written, faces before, faces after)."""
+    m = mesh_tools.load(obj, cache)
+    lod, cell = decimate(m, faces)
+    out = out or lod_path(obj)
+    write_obj(lod, out, "LOD of {}: {} of {} faces{}".format(os.path.basename(obj), lod.n_faces, m.n_faces,
+                                                            ", {:.3g} m cells".format(cell) if cell else ""))
+    return out, m.n_faces, lod.n_faces
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python3 -m metashape_batch.decimate", description="Write a decimated LOD of exported OBJs.")
+    parser.add_argument("objs", nargs="+", help="exported .obj files")
+    parser.add_argument("--faces", type=int, default=FACES, help="faces in the LOD (default: {})".format(FACES))
+    parser.add_argument("--out-dir", help="write the LODs here (default: lod/ next to each OBJ)")
+    parser.add_argument("--no-cache", action="store_false", dest="cache", help="do not read or write the .mesh.npz caches")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    failed = 0
+    for obj in args.objs:
+        try:
+            out, before, after = decimate_file(obj, args.faces, os.path.join(args.out_dir, os.path.basename(obj)) if args.out_dir else None,
+                                               args.cache)
+        except (OSError, ValueError) as e:
+            print("FAILED {}: {}".format(obj, e), file=sys.stderr)
+            failed += 1
+        else:
+            print("{}: {} -> {} faces, {}".format(os.path.basename(obj), before, after, out))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
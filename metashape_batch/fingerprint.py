@@ -0,0 +1,216 @@
+# PURPOSE: Fingerprint the photos of a timepoint by content, so changed photosets are rebuilt, unchanged ones are skipped and a photoset
+# copied into two tag folders by mistake is caught before hours of processing are spent on it.
+# The generator used to trust directory names alone. Here every photo of the timepoint is walked once and its size, mtime and sha1 are
+# recorded; the sha1 is only recomputed for photos whose size or mtime changed since the last walk (the hashes are cached in
+# image_hashes.json in the models directory), so regenerating a batch costs a stat per photo. Each photoset gets a digest over its photo
+# names and hashes. The batch runner stores the digest a model was built from in the status index, so a photoset whose photos changed
+# since its last successful build is scheduled again ("changed") and one that did not is skipped. Photos with the same content in
+# different photosets are reported, and photosets that are entire copies of each other are held back from the batch.
+#
+# The generator does this for every batch (see metashape_batch/generate.py, --no-fingerprint to skip it). By hand:
+#     python3 -m metashape_batch.fingerprint /scratch1/migomez/3Dmodels/source_images/SinglePolyp/090425 --models-dir /scratch1/migomez/3Dmodels/models/SinglePolyp/090425
+
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import os
+import sys
+
+from . import imageindex
+from . import profiles
+from . import status
+
+
+CACHE_NAME = "image_hashes.json"
+
+# Hashing threads (hashlib releases the GIL, so reads and hashing of several photos overlap).
+WORKERS = 4
+
+
+def image_hash(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def list_images(photoset, extensions, index=None):
+    """(name, size, mtime_ns) of the photos in a photoset directory, sorted by name. Every photo is checked, even with an index."""
+    photos = (index or imageindex.ImageIndex()).photos(photoset, extensions, verify=True)
+    return [(photo["name"], photo["size"], photo["mtime"]) for photo in photos]
+
+
+def photoset_digest(hashes):
+    """sha1 over a photoset's (name, hash) pairs."""
+    h = hashlib.sha1()
+    for name, digest in sorted(hashes.items()):
+        h.update("{}\0{}\n".format(name, digest).encode())
+    return h.hexdigest()
+
+
+class HashCache:
+    """Image hashes keyed by path, valid while the image's size and mtime are unchanged."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def lookup(self, path, size, mtime):
+        entry = self.entries.get(path)
+        if entry and entry[0] == size and entry[1] == mtime:
+            self.hits += 1
+            return entry[2]
+        return None
+
+    def store(self, path, size, mtime, digest):
+        self.misses += 1
+        self.entries[path] = [size, mtime, digest]
+
+    def save(self):
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.entries, f, sort_keys=True)
+        os.replace(tmp, self.path)
+
+
+class Fingerprints:
+    """Photo hashes of a set of photosets: photosets maps each photoset to {"images", "bytes", "digest", "hashes": {name: sha1}}."""
+
+    def __init__(self, photosets):
+        self.photosets = photosets
+
+    def digests(self):
+        return {photoset: info["digest"] for photoset, info in self.photosets.items()}
+
+    def duplicate_images(self):
+        """Photos found in more than one photoset: [(sha1, [(photoset, name), ...])], largest groups first."""
+        seen = {}
+        for photoset, info in sorted(self.photosets.items()):
+            for name, digest in info["hashes"].items():
+                seen.setdefault(digest, []).append((photoset, name))
+        groups = [(digest, places) for digest, places in seen.items() if len(set(photoset for photoset, _ in places)) > 1]
+        return sorted(groups, key=lambda group: (-len(group[1]), group[1]))
+
+    def duplicate_photosets(self):
+        """Groups of photosets with identical photos (same names and contents)."""
+        groups = {}
+        for photoset, info in sorted(self.photosets.items()):
+            if info["images"]:
+                groups.setdefault(info["digest"], []).append(photoset)
+        return [group for group in groups.values() if len(group) > 1]
+
+    def overlaps(self):
+        """{(photoset, photoset): shared photos} for photosets sharing some photos without being copies of each other."""
+        copies = set(frozenset(group) for group in self.duplicate_photosets())
+        shared = {}
+        for _, places in self.duplicate_images():
+            sets = sorted(set(photoset for photoset, _ in places))
+            for i, a in enumerate(sets):
+                for b in sets[i + 1:]:
+                    if not any(a in group and b in group for group in copies):
+                        shared[(a, b)] = shared.get((a, b), 0) + 1
+        return shared
+
+    def unchanged(self, models_dir):
+        """Photosets whose digest matches the one recorded when their model was last built successfully."""
+        records = status.StatusIndex(models_dir).load()
+        return sorted(photoset for photoset, info in self.photosets.items()
+                      if records.get(photoset, {}).get("status") == status.DONE
+                      and records[photoset].get("photoset_digest") == info["digest"])
+
+    def write(self, path):
+        """Write the fingerprint manifest (per photoset: image count, bytes, digest and photo hashes)."""
+        with open(path, "w") as f:
+            json.dump({"photosets": self.photosets,
+                       "duplicate_photosets": self.duplicate_photosets()}, f, indent=1, sort_keys=True)
+
+
+def fingerprint(photosets, extensions, cache=None, workers=WORKERS, index=None):
+    """Hash the photos of every photoset (only those not in the cache, in `workers` threads). Returns Fingerprints."""
+    cache = cache or HashCache()
+    listing = {photoset: list_images(photoset, extensions, index) for photoset in photosets}
+    hashes = {photoset: {} for photoset in photosets}
+    todo = []
+    for photoset, images in listing.items():
+        for name, size, mtime in images:
+            path = os.path.join(photoset, name)
+            digest = cache.lookup(path, size, mtime)
+            if digest is None:
+                todo.append((photoset, name, size, mtime))
+            else:
+                hashes[photoset][name] = digest
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        paths = [os.path.join(photoset, name) for photoset, name, _, _ in todo]
+        for (photoset, name, size, mtime), digest in zip(todo, pool.map(image_hash, paths)):
+            cache.store(os.path.join(photoset, name), size, mtime, digest)
+            hashes[photoset][name] = digest
+    cache.save()
+
+    return Fingerprints({photoset: {"images": len(listing[photoset]), "bytes": sum(size for _, size, _ in listing[photoset]),
+                                    "digest": photoset_digest(hashes[photoset]), "hashes": hashes[photoset]}
+                         for photoset in photosets})
+
+
+def fingerprint_timepoint(photosets, extensions, models_dir, workers=WORKERS, index=None):
+    """fingerprint() with the hash cache and image index of a models directory."""
+    index = index or imageindex.ImageIndex(models_dir)
+    prints = fingerprint(photosets, extensions, HashCache(os.path.join(models_dir, CACHE_NAME)), workers, index)
+    index.save()
+    return prints
+
+
+def report(prints, out=sys.stdout):
+    """Print the duplicated photosets and the photosets that share photos. Returns the number of problems found."""
+    copies = prints.duplicate_photosets()
+    for group in copies:
+        print("DUPLICATE photosets (identical photos): " + ", ".join(os.path.basename(p) for p in group), file=out)
+    overlaps = prints.overlaps()
+    for (a, b), n in sorted(overlaps.items()):
+        print("WARNING: {} and {} share {} photo(s)".format(os.path.basename(a), os.path.basename(b), n), file=out)
+    return len(copies) + len(overlaps)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python3 -m metashape_batch.fingerprint",
+                                     description="Hash the photos of a timepoint, report duplicates and photosets unchanged since their last build.")
+    parser.add_argument("source_dir", help="timepoint directory that holds the photosets")
+    parser.add_argument("--models-dir", help="models directory of the timepoint (hash cache and status index; default: no cache)")
+    parser.add_argument("--profile", choices=sorted(profiles.PROFILES), default="fragram", help="profile whose photo types to hash")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="hashing threads (default: {})".format(WORKERS))
+    parser.add_argument("--write", metavar="JSON", help="write the fingerprint manifest to this file")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    from .generate import list_photosets
+    photosets = list_photosets(args.source_dir)
+    extensions = profiles.get_profile(args.profile)["photo_extensions"]
+    cache = HashCache(os.path.join(args.models_dir, CACHE_NAME) if args.models_dir else None)
+    index = imageindex.ImageIndex(args.models_dir)
+    prints = fingerprint(photosets, extensions, cache, args.workers, index)
+    index.save()
+    print("{} photosets, {} photos ({} hashed, {} from the cache)".format(
+        len(photosets), sum(info["images"] for info in prints.photosets.values()), cache.misses, cache.hits))
+    problems = report(prints)
+    if args.models_dir:
+        unchanged = prints.unchanged(args.models_dir)
+        print("{} of {} photosets unchanged since their last successful build".format(len(unchanged), len(photosets)))
+    if args.write:
+        prints.write(args.write)
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,348 @@
+# PURPOSE: Build one Metashape script per photoset within a TIMEPOINT directory & generate the slurm script that processes them all.
+# This replaces the echo/sed loop in buildscripts_*.sh. The template is read and expanded once (with indentation preserved, so the
+# REPLACEME / ALSOREPLACE / SCALEBARSDEF re-injection hack is no longer needed), every per-photoset script is rendered in memory, and
+# PhotosetDirs.txt, listofscripts.txt, ToDo.txt and the .slm are all written in a single pass.
+# With --mode runner no per-photoset scripts are written at all: the photosets go into manifest.json and ToDo.txt holds a single call to
+# scripts/run_batch.py, which builds every model inside one Metashape process (see metashape_batch/runner.py).
+# With --mode array the manifest is instead built by a slurm job array, one task per photoset, with at most --array-cap tasks running at
+# once and a walltime sized from earlier build times. A submit script chains licence activation, the array and deactivate_Metashape.slm
+# (see metashape_batch/slurm.py). With --pack HOURS the photosets are grouped into tasks of up to HOURS predicted hours each, using the
+# runtime model fit to earlier builds (see metashape_batch/predict.py).
+# Only photosets that still need building are scheduled: the batch status index in the models directory (see metashape_batch/status.py)
+# is consulted so models whose .obj and _report.pdf exist and were built with the same template and scale files are skipped. Pass --all to
+# schedule every photoset regardless. The photos of the timepoint are fingerprinted by content first (see metashape_batch/fingerprint.py):
+# photosets whose photos changed since they were built are rebuilt, and photosets that are copies of each other are reported and all but
+# one left out of the batch (--allow-duplicates to build them anyway, --no-fingerprint to skip the check). With --preflight the photos of the scheduled
+# photosets are checked for blur, bad exposure and truncation before the batch is written (see metashape_batch/preflight.py).
+#
+# Ex: python3 -m metashape_batch.generate fragram 090425
+#     python3 -m metashape_batch.generate scoupr DRTO_REDO_Dec2025 --scoupr 1A
+#     python3 -m metashape_batch.generate fragram 090425 --mode runner
+#     python3 -m metashape_batch.generate fragram 090425 --mode runner --slots 2   (build two models at once, see metashape_batch/scheduler.py)
+#     python3 -m metashape_batch.generate fragram 090425 --mode array --array-cap 4
+#     python3 -m metashape_batch.generate scoupr DRTO_REDO_Dec2025 --scoupr 1A --mode array --pack 24
+
+import argparse
+import os
+import stat
+import sys
+
+from . import fingerprint
+from . import imageindex
+from . import predict
+from . import preflight
+from . import profiles
+from . import runner
+from . import slurm
+from . import status
+
+
+# Blocks that used to be re-injected with sed after the template was echoed (which stripped all tabs). They are now expanded once, at the
+# indentation of the line that holds the placeholder.
+EXPANSIONS = {
+    "REPLACEME": '''\
+if found_major_version != compatible_major_version:
+    raise Exception("Incompatible Metashape version: {} != {}".format(found_major_version, compatible_major_version))
+''',
+    "ALSOREPLACE": '''\
+if chunk.crs:
+    m = chunk.crs.localframe(v_t)
+else:
+    m = Metashape.Matrix().Diag([1, 1, 1, 1])
+''',
+    # Scalebars are created by metashape_batch.scalebars (indexed, one pass, the scale file is checked first); see that module.
+    "SCALEBARSDEF": '''\
+import sys
+if "BATCHROOT" not in sys.path:
+    sys.path.insert(0, "BATCHROOT")
+from metashape_batch import scalebars as scalebar_tools
+scalebar_tools.create_scalebars(chunk, scalebars_path)
+Metashape.app.update()
+''',
+}
+
+# The variable that is swapped for the absolute path of each photoset.
+PHOTOSET = "PHOTOSET"
+
+# Swapped for the location of this repository, so generated scripts can import metashape_batch (ex. the stage log, see instrument.py).
+BATCHROOT = "BATCHROOT"
+
+TODO_LINE = "bash metashape.sh -r {script} -platform offscreen\n"
+
+RUN_BATCH = os.path.join(profiles.REPO_ROOT, "scripts", "run_batch.py")
+
+SCHEDULER_LINE = "PYTHONPATH={root} python3 -m metashape_batch.scheduler {manifest} --slots {slots}\n"
+
+
+def expand_placeholders(text, expansions=EXPANSIONS):
+    """Replace every line that holds only a placeholder with its block, indented to match the placeholder."""
+    out = []
+    for line in text.splitlines(True):
+        key = line.strip()
+        if key in expansions:
+            indent = line[:len(line) - len(line.lstrip())]
+            out.extend(indent + block_line if block_line.strip() else block_line
+                       for block_line in expansions[key].splitlines(True))
+        else:
+            out.append(line)
+    return "".join(out)
+
+
+def load_template(path, expansions=EXPANSIONS):
+    """Read and expand a template once. Returns the pieces around each PHOTOSET so rendering is a single join per photoset."""
+    with open(path) as f:
+        text = f.read()
+    return expand_placeholders(text, expansions).replace(BATCHROOT, profiles.REPO_ROOT).split(PHOTOSET)
+
+
+def render(parts, photoset):
+    """Render the per-photoset script from pieces returned by load_template()."""
+    return photoset.join(parts)
+
+
+def list_photosets(source_dir):
+    """Absolute paths of every photoset directory within a timepoint (sorted, hidden directories skipped)."""
+    return sorted(entry.path for entry in os.scandir(source_dir) if entry.is_dir() and not entry.name.startswith("."))
+
+
+def _write(path, text, executable=False):
+    with open(path, "w") as f:
+        f.write(text)
+    if executable:
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+
+def write_scripts(profile, photosets, dirs):
+    """Render one script per photoset. Returns the script paths and their ToDo.txt lines."""
+    parts = load_template(profile["template"])
+    scripts = []
+    todo = []
+    for photoset in photosets:
+        name = os.path.basename(photoset) + ".py"
+        script = os.path.join(dirs["torun_dir"], name)
+        _write(script, render(parts, photoset), executable=True)
+        scripts.append(script)
+        todo.append(TODO_LINE.format(script=dirs["todo_dir"] + "/" + name))
+    _write(os.path.join(dirs["torun_dir"], "listofscripts.txt"), "".join(s + "\n" for s in scripts))
+    return scripts, todo
+
+
+def generate(profile, timepoint, scoupr=None, source_root=None, models_root=None, torun_root=None, slm_dir=".", mode="scripts",
+             schedule_all=False, slots=1, array_cap=2, pack_hours=None, check_photos=True, allow_duplicates=False, scan_photos=False,
+             lod=None, depth_budget=None):
+    """Write the batch for one timepoint: PhotosetDirs.txt, ToDo.txt and the .slm, plus either one script per photoset and
+    listofscripts.txt (mode "scripts") or a manifest.json for the batch runner (mode "runner"). Unless schedule_all is set, photosets
+    that are already built and up to date are left out of the batch. With more than one slot the runner batch is run by the node-local
+    scheduler, building that many models at once. Mode "array" writes the manifest, a slurm job array over it (at most array_cap tasks at
+    once) and the submit script that chains licence activation, the array and deactivation. With pack_hours the array's tasks are groups
+    of photosets packed up to that many predicted hours. With check_photos the photos are fingerprinted (fingerprints.json in the ToRun
+    directory): photosets that changed since they were built are scheduled again and, unless allow_duplicates, of photosets that are
+    copies of each other only one is kept (see held_duplicates()). With scan_photos the scheduled photosets are pre-flight scanned (see
+    preflight.py). With lod (a face count) the runner also writes a decimated copy of each model (see decimate.py). With depth_budget
+    (hours per model) the runner chooses each model's depth map downscale and max_neighbors to fit it (see policy.py).
+
+    Returns a dict with the resolved directories, the photosets, the scheduled (photoset, reason) pairs and the written scripts/manifest
+    (and, for an array, the per-task walltime and the submit script), plus the Fingerprints, the held back duplicates and those of them
+    that needed building.
+    """
+    dirs = profiles.resolve_dirs(profile, timepoint, scoupr, source_root, models_root, torun_root)
+    out = dirs["torun_dir"]
+    os.makedirs(out, exist_ok=True)
+    os.makedirs(dirs["models_dir"], exist_ok=True)
+
+    photosets = list_photosets(dirs["source_dir"])
+    _write(os.path.join(out, "PhotosetDirs.txt"), "".join(p + "\n" for p in photosets))
+
+    # Photo listings and headers, shared by the fingerprints, the pre-flight scan and the runtime predictor.
+    photo_index = imageindex.ImageIndex(dirs["models_dir"])
+    prints = None
+    digests = None
+    held = []
+    if check_photos:
+        prints = fingerprint.fingerprint_timepoint(photosets, profile["photo_extensions"], dirs["models_dir"], index=photo_index)
+        prints.write(os.path.join(out, "fingerprints.json"))
+        digests = prints.digests()
+        if not allow_duplicates:
+            held = held_duplicates(prints.duplicate_photosets(), status.StatusIndex(dirs["models_dir"]).load())
+
+    if schedule_all:
+        todo_sets = [(photoset, "all") for photoset in photosets]
+    else:
+        # Generated scripts are tied to their template and the scale files it reads; the runner to its processing settings and the
+        # profile's scale files.
+        if mode == "scripts":
+            template_hash, scale_hash = status.file_hash(profile["template"]), status.template_scale_hash(profile["template"])
+        else:
+            template_hash, scale_hash = status.settings_hash(profile), status.scale_hash(profile)
+        todo_sets, _ = status.StatusIndex(dirs["models_dir"]).pending(photosets, template_hash, scale_hash, digests)
+    held_todo = [photoset for photoset, _ in todo_sets if photoset in held]
+    todo_sets = [(photoset, reason) for photoset, reason in todo_sets if photoset not in held]
+    scheduled = [photoset for photoset, _ in todo_sets]
+    preflight_rows = preflight.scan(scheduled, profile["photo_extensions"], dirs["models_dir"], index=photo_index) if scan_photos else {}
+
+    scripts = []
+    manifest = None
+    slm_path = os.path.join(slm_dir, dirs["slm_name"])
+    settings = {"depth_policy": {"budget_hours": depth_budget}} if depth_budget else None
+    result = {"dirs": dirs, "photosets": photosets, "scheduled": todo_sets, "scripts": scripts, "slm": slm_path, "fingerprints": prints,
+              "held": held, "held_todo": held_todo, "preflight": preflight_rows}
+    if mode == "array":
+        result.update(write_array(profile, scheduled, dirs, timepoint, scoupr, slm_path, array_cap, pack_hours, digests, photo_index, lod,
+                                  settings))
+        photo_index.save()
+        return result
+    if mode == "runner":
+        manifest = os.path.join(out, "manifest.json")
+        runner.write_manifest(manifest, profile["name"], scheduled, dirs["models_dir"], profile["project"], timepoint, scoupr,
+                              settings=settings, upload_dest=profile.get("upload"), digests=digests, lod=lod)
+        if slots > 1:
+            todo = [SCHEDULER_LINE.format(root=profiles.REPO_ROOT, manifest=manifest, slots=slots)]
+        else:
+            todo = [TODO_LINE.format(script=RUN_BATCH + " " + manifest)]
+        if not scheduled:
+            todo = []
+    else:
+        scripts, todo = write_scripts(profile, scheduled, dirs)
+    # ToDo.txt is rewritten (not appended to), so regenerating a batch never duplicates lines.
+    _write(os.path.join(out, "ToDo.txt"), "".join(todo))
+
+    with open(profile["slm_template"]) as f:
+        slm = f.read()
+    _write(slm_path, slm + "".join(todo), executable=True)
+
+    photo_index.save()
+    result.update(scripts=scripts, manifest=manifest)
+    return result
+
+
+def held_duplicates(groups, records):
+    """Photosets to hold back from groups of copies of each other: all of each group but one, the copy already built (or at least in
+    the status index records) if there is one, otherwise the first."""
+    held = []
+    for group in groups:
+        recorded = [photoset for photoset in group if photoset in records]
+        built = [photoset for photoset in recorded if records[photoset].get("status") == status.DONE]
+        keep = (built or recorded or group)[0]
+        held.extend(photoset for photoset in group if photoset != keep)
+    return sorted(held)
+
+
+def plan_tasks(profile, photosets, models_dir, pack_hours=None, index=None):
+    """Array tasks and their walltime (s). With pack_hours and enough history to predict build times, photosets are packed into tasks of
+    up to pack_hours predicted hours and the walltime covers the largest task; otherwise each photoset is a task of its own and the
+    walltime comes from past build times."""
+    predictor = predict.Predictor.fit(predict.load_history(models_dir)) if pack_hours else None
+    if predictor is None:
+        if pack_hours:
+            print("No build history to predict from; one photoset per task.")
+        return None, slurm.history_walltime(slurm.elapsed_history(models_dir))
+    bins = predict.pack(predict.predict_photosets(predictor, profile, photosets, index), pack_hours * 3600)
+    return [sorted(items) for _, items in bins], slurm.pad_walltime(bins[0][0] + predictor.error)
+
+
+def write_array(profile, photosets, dirs, timepoint, scoupr, slm_path, cap, pack_hours=None, digests=None, index=None, lod=None,
+                settings=None):
+    """Write manifest.json, the job array over it (slm_path), the licence activation job and the submit script that chains them."""
+    out = dirs["torun_dir"]
+    manifest = os.path.join(out, "manifest.json")
+    tasks, walltime = plan_tasks(profile, photosets, dirs["models_dir"], pack_hours, index) if photosets else (None, None)
+    runner.write_manifest(manifest, profile["name"], photosets, dirs["models_dir"], profile["project"], timepoint, scoupr, settings,
+                          tasks=tasks, upload_dest=profile.get("upload"), digests=digests, lod=lod)
+    task_line = slurm.TASK_LINE.format(run_batch=RUN_BATCH, manifest=manifest)
+    _write(os.path.join(out, "ToDo.txt"), task_line if photosets else "")
+    if not photosets:
+        return {"manifest": manifest, "tasks": 0, "walltime": None, "submit": None}
+
+    n_tasks = len(tasks) if tasks else len(photosets)
+    _write(slm_path, slurm.array_script(profile["slm_template"], n_tasks, cap, walltime, task_line), executable=True)
+    base = os.path.splitext(slm_path)[0]
+    activate = base + "_activate.slm"
+    _write(activate, slurm.activate_script(profile["deactivate_slm"]), executable=True)
+    submit = base + "_submit.sh"
+    _write(submit, slurm.submit_script(os.path.abspath(slm_path), os.path.abspath(activate), profile["deactivate_slm"]), executable=True)
+    return {"manifest": manifest, "tasks": n_tasks, "walltime": walltime, "submit": submit}
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python3 -m metashape_batch.generate",
+                                     description="Build a Metashape script for each photoset in a timepoint and the slurm script that runs them.")
+    parser.add_argument("profile", choices=sorted(profiles.PROFILES), help="template set to use")
+    parser.add_argument("timepoint", help="directory that holds photosets from a specific timepoint (ex. ORCC_October2022)")
+    parser.add_argument("--scoupr", help="scoupr directory within the timepoint (scoupr profile only, ex. 1A)")
+    parser.add_argument("--project", help="project directory (default comes from the profile)")
+    parser.add_argument("--template", help="template script to duplicate (default comes from the profile)")
+    parser.add_argument("--slm-template", help="slurm header that ToDo.txt is appended to")
+    parser.add_argument("--source-root", help="root of the source_images tree")
+    parser.add_argument("--models-root", help="root of the models tree")
+    parser.add_argument("--torun-root", help="root of the ToRun tree")
+    parser.add_argument("--slm-dir", default=".", help="where to write the .slm (default: current directory)")
+    parser.add_argument("--mode", choices=("scripts", "runner", "array"), default="scripts",
+                        help="one generated script per photoset (default), one manifest for the batch runner, or a slurm job array over a manifest")
+    parser.add_argument("--all", action="store_true", dest="schedule_all",
+                        help="schedule every photoset, even those already built with the same template and scale files")
+    parser.add_argument("--slots", type=int, default=1, help="models to build at once on the node (runner mode only, default: 1)")
+    parser.add_argument("--array-cap", type=int, default=2, help="array tasks to run at once (array mode only, default: 2)")
+    parser.add_argument("--upload", metavar="DEST", help="have the runner copy each finished model to DEST (runner and array modes)")
+    parser.add_argument("--pack", type=float, metavar="HOURS", dest="pack_hours",
+                        help="group photosets into array tasks of up to HOURS predicted hours (array mode only)")
+    parser.add_argument("--no-fingerprint", action="store_false", dest="check_photos",
+                        help="do not hash the photos (changed photosets are then not detected, nor duplicated ones)")
+    parser.add_argument("--allow-duplicates", action="store_true", help="build photosets that are copies of each other anyway")
+    parser.add_argument("--preflight", action="store_true", dest="scan_photos",
+                        help="check the scheduled photos for blur, bad exposure and truncation (runner and array modes apply the results)")
+    parser.add_argument("--lod", type=int, metavar="FACES",
+                        help="have the runner also write a decimated copy of each model with about FACES faces (runner and array modes)")
+    parser.add_argument("--depth-budget", type=float, metavar="HOURS",
+                        help="have the runner choose each model's depth map downscale to fit HOURS (runner and array modes)")
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.slots > 1 and args.mode != "runner":
+        parser.error("--slots needs --mode runner")
+    if args.pack_hours and args.mode != "array":
+        parser.error("--pack needs --mode array")
+    if args.lod and args.mode == "scripts":
+        parser.error("--lod needs --mode runner or array")
+    if args.depth_budget and args.mode == "scripts":
+        parser.error("--depth-budget needs --mode runner or array")
+    profile = profiles.get_profile(args.profile, project=args.project, template=args.template, slm_template=args.slm_template,
+                                   upload=args.upload)
+    try:
+        result = generate(profile, args.timepoint, args.scoupr, args.source_root, args.models_root, args.torun_root, args.slm_dir,
+                          args.mode, args.schedule_all, args.slots, args.array_cap, args.pack_hours, args.check_photos,
+                          args.allow_duplicates, args.scan_photos, args.lod, args.depth_budget)
+    except (OSError, ValueError) as e:
+        print("ERROR: {}".format(e), file=sys.stderr)
+        return 1
+    if result["fingerprints"]:
+        fingerprint.report(result["fingerprints"])
+    if result["held"]:
+        print("Held back {} duplicated photosets (--allow-duplicates to build them)".format(len(result["held"])))
+    for photoset, rows in sorted(result["preflight"].items()):
+        print("Pre-flight {}: {}".format(os.path.basename(photoset), preflight.summary(rows)))
+    reasons = {}
+    for _, reason in result["scheduled"]:
+        reasons[reason] = reasons.get(reason, 0) + 1
+    print("Scheduled {} of {} photosets ({} already built){}".format(
+        len(result["scheduled"]), len(result["photosets"]), len(result["photosets"]) - len(result["scheduled"]) - len(result["held_todo"]),
+        "".join(", {} {}".format(n, reason) for reason, n in sorted(reasons.items()))))
+    if result["manifest"]:
+        print("Wrote a manifest of {} photosets to {}".format(len(result["scheduled"]), result["manifest"]))
+    else:
+        print("Wrote {} scripts to {}".format(len(result["scripts"]), result["dirs"]["torun_dir"]))
+    if args.mode != "array":
+        print("Submit with: sbatch {}".format(result["slm"]))
+    elif result["submit"]:
+        print("Array of {} tasks ({} at once), {} per task".format(result["tasks"], args.array_cap,
+                                                               slurm.format_walltime(result["walltime"])))
+        print("Submit with: bash {}".format(result["submit"]))
+    else:
+        print("Nothing to submit.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
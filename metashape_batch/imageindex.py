@@ -0,0 +1,245 @@
+# PURPOSE: One index of the photos of a timepoint (file names, sizes, pixel dimensions and camera metadata), read from the file headers once
+# and cached, so the generator, the runtime predictor, the pre-flight scan and the batch runner stop listing and opening the same
+# directories on the shared filesystem over and over.
+# The templates glob "*.bmp" or "*.JPG" depending on the profile, so a photoset saved as .jpg or .JPEG is silently empty. Here photos are
+# found whatever the case of their extension (and .jpeg counts as .jpg). For each photo only the header is read: JPEG markers up to the
+# frame header (plus the EXIF block), the BMP info header, the PNG IHDR chunk or the TIFF IFDs. From these come the width and height and,
+# where the camera wrote EXIF, the make, model, focal length (and its 35 mm equivalent) and when the photo was taken.
+#
+# The index is image_index.json in the models directory of the timepoint, one compact record list per photoset. A photoset is listed
+# again only when its directory changed (photos added, removed or renamed), and a photo's header is read again only when its size or
+# mtime changed. verify=True also checks the size and mtime of every photo (ex. for fingerprinting, which must see photos rewritten in place).
+#
+# Ex: python3 -m metashape_batch.imageindex /scratch1/migomez/3Dmodels/source_images/SinglePolyp/090425 /scratch1/migomez/3Dmodels/models/SinglePolyp/090425
+
+import argparse
+import json
+import os
+import struct
+import sys
+
+
+INDEX_NAME = "image_index.json"
+
+# Photo types the index knows (compared in lower case).
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".bmp", ".png", ".tif", ".tiff")
+
+# The fields of each record, in the order they are stored.
+FIELDS = ("name", "size", "mtime", "width", "height", "make", "model", "focal_length", "focal_length_35mm", "taken")
+
+# Bytes read from the start of a TIFF for its tags (the first IFD is almost always within them).
+TIFF_HEADER = 1 << 16
+
+# EXIF tags read (IFD0 and the Exif sub-IFD).
+TAGS = {0x0100: "width", 0x0101: "height", 0x010F: "make", 0x0110: "model", 0x0132: "datetime", 0x8769: "exif_ifd",
+        0x9003: "taken", 0x920A: "focal_length", 0xA405: "focal_length_35mm"}
+
+
+def normalise_extension(extension):
+    extension = extension.lower()
+    return ".jpg" if extension == ".jpeg" else extension
+
+
+def matches(name, extensions):
+    """True if a file name has one of the extensions, in any case (.jpeg counts as .jpg)."""
+    return normalise_extension(os.path.splitext(name)[1]) in set(normalise_extension(e) for e in extensions)
+
+
+### Header readers. Each takes an open file positioned at 0 and returns a dict of what it found.
+
+def _tiff_value(data, endian, kind, count, offset_or_value, base):
+    sizes = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 7: 1, 13: 4}
+    size = sizes.get(kind, 0) * count
+    raw = offset_or_value if size <= 4 else data[base + struct.unpack(endian + "I", offset_or_value)[0]:][:size]
+    if kind == 2:
+        return raw[:count].split(b"\0", 1)[0].decode("ascii", "replace").strip()
+    if kind == 3:
+        return struct.unpack(endian + "H", raw[:2])[0]
+    if kind in (4, 13):
+        return struct.unpack(endian + "I", raw[:4])[0]
+    if kind == 5 and len(raw) >= 8:
+        num, den = struct.unpack(endian + "II", raw[:8])
+        return round(num / den, 3) if den else None
+    return None
+
+
+def read_tiff(data, base=0):
+    """Tags (named in TAGS) of the TIFF structure starting at data[base:] (a TIFF file or a JPEG's EXIF block)."""
+    endian = "<" if data[base:base + 2] == b"II" else ">"
+    found = {}
+    offsets = [struct.unpack(endian + "I", data[base + 4:base + 8])[0]]
+    seen = set()
+    while offsets:
+        offset = offsets.pop()
+        if offset in seen or base + offset + 2 > len(data):
+            continue
+        seen.add(offset)
+        count = struct.unpack(endian + "H", data[base + offset:base + offset + 2])[0]
+        for i in range(count):
+            entry = data[base + offset + 2 + 12 * i:][:12]
+            if len(entry) < 12:
+                break
+            tag, kind, n = struct.unpack(endian + "HHI", entry[:8])
+            if tag not in TAGS:
+                continue
+            try:
+                value = _tiff_value(data, endian, kind, n, entry[8:12], base)
+            except (struct.error, ZeroDivisionError):
+                continue
+            if TAGS[tag] == "exif_ifd":
+                offsets.append(value)
+            elif value not in (None, ""):
+                found.setdefault(TAGS[tag], value)
+    return found
+
+
+def read_jpeg(f):
+    info = {}
+    f.seek(2)
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            break
+        if marker[1] in (0xD8, 0x01) or 0xD0 <= marker[1] <= 0xD7:
+            continue
+        length = struct.unpack(">H", f.read(2))[0]
+        if marker[1] == 0xE1 and "make" not in info:
+            block = f.read(length - 2)
+            if block[:6] == b"Exif\0\0":
+                info.update(read_tiff(block, 6))
+            continue
+        if 0xC0 <= marker[1] <= 0xCF and marker[1] not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack(">xHH", f.read(5))
+            info["width"], info["height"] = width, height
+            break
+        if marker[1] == 0xDA:  # image data starts; no frame header found
+            break
+        f.seek(length - 2, 1)
+    return info
+
+
+def read_bmp(f):
+    header = f.read(26)
+    width, height = struct.unpack("<ii", header[18:26])
+    return {"width": width, "height": abs(height)}
+
+
+def read_png(f):
+    header = f.read(24)
+    width, height = struct.unpack(">II", header[16:24])
+    return {"width": width, "height": height}
+
+
+def read_header(path):
+    """Width, height and (JPEG/TIFF EXIF) make, model, focal length and time taken of a photo, from its header only."""
+    with open(path, "rb") as f:
+        magic = f.read(8)
+        f.seek(0)
+        if magic[:2] == b"\xff\xd8":
+            info = read_jpeg(f)
+        elif magic[:2] == b"BM":
+            info = read_bmp(f)
+        elif magic == b"\x89PNG\r\n\x1a\n":
+            info = read_png(f)
+        elif magic[:4] in (b"II*\0", b"MM\0*"):
+            info = read_tiff(f.read(TIFF_HEADER))
+        else:
+            info = {}
+    # Prefer when the photo was taken (Exif DateTimeOriginal) over when the file was last written (IFD0 DateTime).
+    modified = info.pop("datetime", None)
+    info.setdefault("taken", modified)
+    return info
+
+
+class ImageIndex:
+    """The image_index.json of one timepoint: per photoset, the directory mtime and a record per photo (see FIELDS)."""
+
+    def __init__(self, models_dir=None, path=None):
+        self.path = path or (os.path.join(models_dir, INDEX_NAME) if models_dir else None)
+        self.photosets = {}
+        self.changed = False
+        if self.path and os.path.exists(self.path):
+            with open(self.path) as f:
+                self.photosets = json.load(f).get("photosets", {})
+
+    def _scan(self, photoset, cached):
+        by_name = {record[0]: record for record in cached.get("photos", [])} if cached else {}
+        records = []
+        for entry in os.scandir(photoset):
+            if not entry.is_file() or normalise_extension(os.path.splitext(entry.name)[1]) not in IMAGE_EXTENSIONS:
+                continue
+            st = entry.stat()
+            record = by_name.get(entry.name)
+            if record is None or record[1] != st.st_size or record[2] != st.st_mtime_ns:
+                try:
+                    info = read_header(entry.path)
+                except (OSError, struct.error, ValueError):
+                    info = {}
+                record = [entry.name, st.st_size, st.st_mtime_ns] + [info.get(field) for field in FIELDS[3:]]
+            records.append(record)
+        return sorted(records)
+
+    def photos(self, photoset, extensions=None, verify=False):
+        """Records (dicts of FIELDS) of the photos in a photoset with one of the extensions (any case; default: every photo type)."""
+        photoset = os.path.abspath(photoset)
+        cached = self.photosets.get(photoset)
+        mtime = os.stat(photoset).st_mtime_ns
+        if verify or cached is None or cached.get("mtime") != mtime:
+            records = self._scan(photoset, cached)
+            if cached is None or cached.get("photos") != records or cached.get("mtime") != mtime:
+                self.photosets[photoset] = {"mtime": mtime, "photos": records}
+                self.changed = True
+        else:
+            records = cached["photos"]
+        return [dict(zip(FIELDS, record)) for record in records if extensions is None or matches(record[0], extensions)]
+
+    def paths(self, photoset, extensions=None):
+        photoset = os.path.abspath(photoset)
+        return [os.path.join(photoset, photo["name"]) for photo in self.photos(photoset, extensions)]
+
+    def save(self):
+        """Write the index if anything changed (atomically, so a reader never sees half of it)."""
+        if not self.path or not self.changed:
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp = "{}.{}.tmp".format(self.path, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump({"fields": FIELDS, "photosets": self.photosets}, f, separators=(",", ":"))
+        os.replace(tmp, self.path)
+        self.changed = False
+
+
+def summarise(photos):
+    """Count, bytes, megapixels and the distinct cameras of a list of photo records."""
+    cameras = sorted(set(" ".join(str(photo[key]) for key in ("make", "model") if photo.get(key)) for photo in photos) - {""})
+    return {
+        "images": len(photos),
+        "bytes": sum(photo["size"] for photo in photos),
+        "megapixels": round(sum((photo["width"] or 0) * (photo["height"] or 0) for photo in photos) / 1e6, 1),
+        "cameras": cameras,
+    }
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python3 -m metashape_batch.imageindex",
+                                     description="Index the photos of a timepoint (dimensions and camera metadata from their headers).")
+    parser.add_argument("source_dir", help="timepoint directory that holds the photosets")
+    parser.add_argument("models_dir", help="models directory the index is kept in")
+    parser.add_argument("--verify", action="store_true", help="check every photo's size and mtime, not just the directories")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    index = ImageIndex(args.models_dir)
+    photosets = sorted(entry.path for entry in os.scandir(args.source_dir) if entry.is_dir() and not entry.name.startswith("."))
+    for photoset in photosets:
+        stats = summarise(index.photos(photoset, verify=args.verify))
+        print("{}: {} photos, {:.1f} MB, {} MP{}".format(os.path.basename(photoset), stats["images"], stats["bytes"] / 1e6,
+                                                       stats["megapixels"], " ({})".format(", ".join(stats["cameras"])) if stats["cameras"] else ""))
+    index.save()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,180 @@
+# PURPOSE: Record how long each processing stage takes and how much memory it needs, so we can tell where a 72h job goes.
+# Wrap each chunk call (and the doc.save() after it) in a stage:
+#     log = instrument.StageLog(output + swd[-1] + "_stages.jsonl", photoset=swd[-1])
+#     with log.stage("buildDepthMaps", doc.path):
+#         chunk.buildDepthMaps(...)
+#         doc.save()
+# and one JSON line is appended to the log (next to the .psz) when the stage ends: photoset, stage, wall time, CPU time, peak resident
+# memory during the stage and the size of the stage's output files. The generated 2.2.1 scripts and the batch runner both write these logs.
+# Peak memory is per stage on Linux (the high water mark is reset through /proc/self/clear_refs when a stage starts); elsewhere it is the
+# peak of the whole process so far. The log only uses the standard library, so it can be imported inside Metashape.
+#
+# Summarise the logs of a timepoint into per-stage percentiles:
+#     python3 -m metashape_batch.instrument /scratch1/migomez/3Dmodels/models/SinglePolyp/090425
+
+import argparse
+import contextlib
+import glob
+import json
+import os
+import resource
+import sys
+import time
+
+
+LOG_SUFFIX = "_stages.jsonl"
+
+PERCENTILES = (50, 90, 95)
+
+
+def _cpu_seconds():
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return self_usage.ru_utime + self_usage.ru_stime + children.ru_utime + children.ru_stime
+
+
+def _reset_peak():
+    """Reset the process's memory high water mark (Linux 4.0+). Returns False if it cannot be reset."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak_mb():
+    """Peak resident memory (MB) since the last reset, or of the whole process if the high water mark is not available."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024. * 1024) if sys.platform == "darwin" else peak / 1024.
+
+
+def path_size(path):
+    """Size (bytes) of a file, or of everything under a directory (ex. a .files project directory). 0 if it does not exist."""
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+class StageLog:
+    """JSON lines log of the stages of one model."""
+
+    def __init__(self, path, photoset):
+        self.path = path
+        self.photoset = photoset
+        self.records = []
+
+    @contextlib.contextmanager
+    def stage(self, name, *outputs):
+        """Time the enclosed block as stage `name`; `outputs` are the files it writes (their sizes are recorded once it ends)."""
+        reset = _reset_peak()
+        wall = time.time()
+        cpu = _cpu_seconds()
+        record = {"photoset": self.photoset, "stage": name, "started": time.strftime("%Y-%m-%d %H:%M:%S")}
+        try:
+            yield record
+        except BaseException as e:
+            record["error"] = repr(e)
+            raise
+        finally:
+            record.update(wall=round(time.time() - wall, 2), cpu=round(_cpu_seconds() - cpu, 2), peak_mb=round(_peak_mb(), 1),
+                          peak_scope="stage" if reset else "process",
+                          outputs={os.path.basename(path): path_size(path) for path in outputs if path})
+            self.records.append(record)
+            self.write(record)
+
+    def write(self, record):
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record, sort_keys=True) + "\n")
+
+
+def load_logs(models_dir):
+    records = []
+    for path in sorted(glob.glob(os.path.join(models_dir, "*" + LOG_SUFFIX))):
+        with open(path) as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    return records
+
+
+def percentile(values, q):
+    """Linearly interpolated percentile of a list of numbers."""
+    values = sorted(values)
+    k = (len(values) - 1) * q / 100.
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def summarise(records, percentiles=PERCENTILES):
+    """Per-stage count, percentiles of wall time, CPU time and peak memory, and total wall time. Stages are kept in the order first seen."""
+    stages = {}
+    for record in records:
+        if "error" not in record:
+            stages.setdefault(record["stage"], []).append(record)
+    summary = []
+    for stage, rows in stages.items():
+        row = {"stage": stage, "n": len(rows), "total_h": sum(r["wall"] for r in rows) / 3600.}
+        for key in ("wall", "cpu", "peak_mb"):
+            values = [r[key] for r in rows]
+            for q in percentiles:
+                row["{}_p{}".format(key, q)] = percentile(values, q)
+            row[key + "_max"] = max(values)
+        summary.append(row)
+    return summary
+
+
+def _minutes(seconds):
+    return "{:.1f}".format(seconds / 60.)
+
+
+def print_summary(summary, percentiles=PERCENTILES):
+    header = ["stage", "n", "total h"] + ["wall p{} min".format(q) for q in percentiles] + ["wall max min", "cpu p50 min",
+                                                                                          "peak p50 MB", "peak max MB"]
+    print("\t".join(header))
+    for row in summary:
+        print("\t".join([row["stage"], str(row["n"]), "{:.1f}".format(row["total_h"])] +
+                        [_minutes(row["wall_p{}".format(q)]) for q in percentiles] +
+                        [_minutes(row["wall_max"]), _minutes(row["cpu_p50"]), "{:.0f}".format(row["peak_mb_p50"]),
+                         "{:.0f}".format(row["peak_mb_max"])]))
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python3 -m metashape_batch.instrument",
+                                     description="Summarise the per-stage logs (*_stages.jsonl) of one or more models directories.")
+    parser.add_argument("models_dirs", nargs="+", metavar="models_dir", help="models directory (ex. a timepoint)")
+    parser.add_argument("--json", action="store_true", help="print the summary as JSON instead of a table")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    records = []
+    for models_dir in args.models_dirs:
+        records.extend(load_logs(models_dir))
+    if not records:
+        print("No stage logs (*{}) found".format(LOG_SUFFIX))
+        return 1
+    summary = summarise(records)
+    if args.json:
+        print(json.dumps(summary, indent=1))
+    else:
+        print_summary(summary)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
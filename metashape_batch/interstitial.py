@@ -0,0 +1,193 @@
+# PURPOSE: Estimate the interstitial space of a coral (the empty space between its branches, inside its convex hull) from the exported mesh.
+# The model and its convex hull are both voxelised on the same grid (resolution in metres, as the models are scaled in the local CRS),
+# and the interstitial space is the hull voxels the coral does not fill. The grid is kept sparse: for every column of voxels (one per x, y
+# cell) only the runs of filled voxels are stored, as (start, stop) voxel indices, so memory follows the coral's footprint and surface rather
+# than the full bounding box.
+#     coral   a vertical ray through the centre of each column is intersected with every face (faces are taken in chunks, and each face
+#             only with the columns under its footprint); sorted along the ray, the crossings alternate entering / leaving the coral,
+#             so consecutive pairs are the runs inside it. Columns with an odd number of crossings (through a hole in the mesh) are
+#             counted as open; they are left empty, or, given a cap height (ex. the region floor an open mesh was cut at), closed there
+#             by one more crossing at that height.
+#     hull    the intersection of the half spaces d . p <= max over the vertices of d . p for directions d spread evenly over the sphere,
+#             which is the convex hull to within a fraction of a percent of its size, and meets each column in one run.
+# Used by metashape_batch.phenotype (the interstitial columns of phenotypes.csv); by hand:
+#     from metashape_batch import interstitial, mesh
+#     space = interstitial.estimate(mesh.load("/scratch1/migomez/3Dmodels/models/SinglePolyp/090425/090425_3-E-B.obj"), resolution=0.0005)
+
+import numpy as np
+
+from .mesh import hemisphere
+
+
+RESOLUTION = 0.001  # m (1 mm voxels)
+
+# Faces intersected with their columns per chunk, directions used for the hull and columns bounded by them per block.
+FACE_CHUNK = 1 << 18
+HULL_DIRECTIONS = 1024
+COLUMN_BLOCK = 1 << 13
+
+# Columns are cast a hair off the grid centres, so a ray never runs exactly through a shared edge or vertex (and is counted twice).
+JITTER = (0.5 + 1.3e-4 * 2 ** 0.5, 0.5 + 1.7e-4 * 3 ** 0.5)
+
+
+class Occupancy:
+    """Sparse voxel grid: for each column (i, j) a run of filled voxels [start, stop) along z. Voxel (i, j, k) is the cube whose
+    corner is origin + (i, j, k) * resolution."""
+
+    def __init__(self, origin, resolution, shape, columns, starts, stops):
+        self.origin = origin
+        self.resolution = resolution
+        self.shape = shape          # (nx, ny, nz)
+        self.columns = columns      # column index i * ny + j of each run
+        self.starts = starts
+        self.stops = stops
+
+    @property
+    def voxels(self):
+        return int((self.stops - self.starts).sum())
+
+    @property
+    def volume(self):
+        return self.voxels * self.resolution ** 3
+
+
+class Grid:
+    """The voxel grid laid over a set of points, one voxel of margin on every side."""
+
+    def __init__(self, points, resolution):
+        self.resolution = resolution
+        self.origin = points.min(axis=0) - resolution
+        self.shape = tuple(int(n) for n in np.ceil((points.max(axis=0) + resolution - self.origin) / resolution))
+
+    def column_centres(self, i, j):
+        return (self.origin[0] + (i + JITTER[0]) * self.resolution, self.origin[1] + (j + JITTER[1]) * self.resolution)
+
+    def voxel_runs(self, low, high):
+        """[start, stop) voxel indices of the voxels whose centres lie between heights low and high."""
+        h = self.resolution
+        starts = np.ceil((low - self.origin[2]) / h - 0.5).astype(np.int64)
+        stops = np.floor((high - self.origin[2]) / h - 0.5).astype(np.int64) + 1
+        return starts, np.maximum(stops, starts)
+
+
+def _crossings(grid, a, b, c):
+    """(column index, z) of every crossing of the column rays with the triangles (a, b, c are face x 3 corner arrays)."""
+    h = grid.resolution
+    ny = grid.shape[1]
+    low = np.minimum(np.minimum(a, b), c)
+    high = np.maximum(np.maximum(a, b), c)
+    i0 = np.ceil((low[:, 0] - grid.origin[0]) / h - JITTER[0]).astype(np.int64)
+    i1 = np.floor((high[:, 0] - grid.origin[0]) / h - JITTER[0]).astype(np.int64)
+    j0 = np.ceil((low[:, 1] - grid.origin[1]) / h - JITTER[1]).astype(np.int64)
+    j1 = np.floor((high[:, 1] - grid.origin[1]) / h - JITTER[1]).astype(np.int64)
+    ni = np.maximum(i1 - i0 + 1, 0)
+    nj = np.maximum(j1 - j0 + 1, 0)
+    counts = ni * nj
+    # Every (face, column under the face's footprint) pair.
+    face = np.repeat(np.arange(len(a)), counts)
+    if not len(face):
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+    local = np.arange(len(face)) - np.repeat(np.cumsum(counts) - counts, counts)
+    i = i0[face] + local // nj[face]
+    j = j0[face] + local % nj[face]
+    px, py = grid.column_centres(i, j)
+
+    a, b, c = a[face], b[face], c[face]
+    e1x, e1y = b[:, 0] - a[:, 0], b[:, 1] - a[:, 1]
+    e2x, e2y = c[:, 0] - a[:, 0], c[:, 1] - a[:, 1]
+    qx, qy = px - a[:, 0], py - a[:, 1]
+    det = e1x * e2y - e2x * e1y
+    with np.errstate(divide="ignore", invalid="ignore"):
+        u = (qx * e2y - e2x * qy) / det
+        w = (e1x * qy - qx * e1y) / det
+        hit = (det != 0) & (u >= 0) & (w >= 0) & (u + w <= 1)
+    z = a[hit, 2] + u[hit] * (b[hit, 2] - a[hit, 2]) + w[hit] * (c[hit, 2] - a[hit, 2])
+    return i[hit] * ny + j[hit], z
+
+
+def voxelise(m, grid, chunk=FACE_CHUNK, cap=None):
+    """Occupancy of the inside of a Mesh, with the open columns (an odd number of crossings) left empty or, if given a cap height,
+    closed at it. Returns (Occupancy, number of columns the mesh crosses, number of open columns)."""
+    columns, heights = [], []
+    for start in range(0, m.n_faces, chunk):
+        faces = m.faces[start:start + chunk]
+        col, z = _crossings(grid, *(m.vertices[faces[:, k]] for k in range(3)))
+        columns.append(col)
+        heights.append(z)
+    columns = np.concatenate(columns) if columns else np.zeros(0, dtype=np.int64)
+    heights = np.concatenate(heights) if heights else np.zeros(0)
+    order = np.lexsort((heights, columns))
+    columns, heights = columns[order], heights[order]
+
+    crossed, counts = np.unique(columns, return_counts=True)
+    odd = counts % 2 == 1
+    if cap is None:
+        keep = np.repeat(~odd, counts)
+        columns, heights = columns[keep], heights[keep]
+    else:
+        columns = np.concatenate([columns, crossed[odd]])
+        heights = np.concatenate([heights, np.full(int(odd.sum()), float(cap))])
+        order = np.lexsort((heights, columns))
+        columns, heights = columns[order], heights[order]
+    starts, stops = grid.voxel_runs(heights[0::2], heights[1::2])
+    filled = stops > starts
+    occupancy = Occupancy(grid.origin, grid.resolution, grid.shape, columns[0::2][filled], starts[filled], stops[filled])
+    return occupancy, len(crossed), int(odd.sum())
+
+
+def hull_occupancy(points, grid, directions=HULL_DIRECTIONS, block=COLUMN_BLOCK):
+    """Occupancy of the convex hull of the points (as the intersection of their support half spaces along `directions` directions)."""
+    half = hemisphere(directions // 2)
+    d = np.concatenate([half, -half])
+    support = np.full(len(d), -np.inf)
+    for start in range(0, len(points), block):
+        np.maximum(support, (points[start:start + block] @ d.T).max(axis=0), out=support)
+
+    nx, ny, _ = grid.shape
+    columns, starts, stops = [], [], []
+    up, down = d[:, 2] > 0, d[:, 2] < 0
+    for start in range(0, nx * ny, block):
+        col = np.arange(start, min(start + block, nx * ny))
+        px, py = grid.column_centres(col // ny, col % ny)
+        # Along the ray, d . p <= support bounds z from above where d_z > 0 and from below where d_z < 0.
+        limit = (support[None, :] - px[:, None] * d[None, :, 0] - py[:, None] * d[None, :, 1]) / d[None, :, 2]
+        high = limit[:, up].min(axis=1)
+        low = limit[:, down].max(axis=1)
+        run_start, run_stop = grid.voxel_runs(low, high)
+        inside = run_stop > run_start
+        columns.append(col[inside])
+        starts.append(run_start[inside])
+        stops.append(run_stop[inside])
+    return Occupancy(grid.origin, grid.resolution, grid.shape, np.concatenate(columns), np.concatenate(starts), np.concatenate(stops))
+
+
+class Interstitial:
+    def __init__(self, coral, hull, columns, open_columns):
+        self.coral = coral
+        self.hull = hull
+        self.columns = columns
+        self.open_columns = open_columns
+
+    @property
+    def volume(self):
+        """Interstitial volume (m^3): hull voxels the coral does not fill."""
+        return max(0, self.hull.voxels - self.coral.voxels) * self.coral.resolution ** 3
+
+    @property
+    def fraction(self):
+        """Share of the hull that is interstitial space."""
+        return self.volume / self.hull.volume if self.hull.voxels else None
+
+    @property
+    def open_fraction(self):
+        """Share of the columns crossing the mesh that were open (left empty or capped)."""
+        return self.open_columns / float(self.columns) if self.columns else None
+
+
+def estimate(m, resolution=RESOLUTION, cap=None):
+    """Voxelise a Mesh and its convex hull at `resolution` (m), closing the open columns at height `cap` if given. Returns an
+    Interstitial."""
+    used = m.vertices[np.unique(m.faces)]
+    grid = Grid(used, resolution)
+    coral, columns, open_columns = voxelise(m, grid, cap=cap)
+    return Interstitial(coral, hull_occupancy(used, grid), columns, open_columns)
@@ -0,0 +1,280 @@
+# PURPOSE: Load the exported models (.obj/.mtl) into numpy arrays on the HPC, so phenotypes can be computed right after export instead of
+# reloading multi-million face OBJs in MeshLab.
+# The OBJ is read in blocks of lines: each block's lines are sorted by type (v, vn, vt, f, usemtl) and every type is parsed in one
+# numpy call, so memory beyond the finished arrays is bounded by the block size and there is no per-number Python work. The result is a
+# Mesh of contiguous arrays: vertices (float64, n x 3), vertex colors (float32, n x 3, if the OBJ has them), normals and texture
+# coordinates (float32), faces (n x 3 vertex indices, 0 based), the faces' texture coordinate / normal indices and material, and the
+# materials of the .mtl. Polygons with more than 3 corners are split into triangles (fans).
+# A loaded mesh is cached next to the OBJ in <name>.mesh.npz (uncompressed), which is reused for as long as the OBJ is unchanged, so
+# loading it again is a single read.
+#
+# Ex: from metashape_batch import mesh
+#     m = mesh.load("/scratch1/migomez/3Dmodels/models/SinglePolyp/090425/090425_3-E-B.obj")
+#     python3 -m metashape_batch.mesh /scratch1/migomez/3Dmodels/models/SinglePolyp/090425/090425_3-E-B.obj
+
+import argparse
+import os
+import sys
+
+import numpy as np
+
+
+SIDECAR_SUFFIX = ".mesh.npz"
+
+# Lines parsed per block.
+BLOCK_LINES = 1 << 20
+
+# Arrays saved in the sidecar (those that are None are left out).
+ARRAYS = ("vertices", "colors", "normals", "texcoords", "faces", "face_texcoords", "face_normals", "face_materials")
+
+
+class Mesh:
+    """A triangle mesh as numpy arrays (see ARRAYS). materials lists the material names in the order face_materials refers to them;
+    textures maps a material name to its texture image (from the .mtl)."""
+
+    def __init__(self, vertices, faces, colors=None, normals=None, texcoords=None, face_texcoords=None, face_normals=None,
+                 face_materials=None, materials=None, textures=None, path=None):
+        self.vertices = vertices
+        self.faces = faces
+        self.colors = colors
+        self.normals = normals
+        self.texcoords = texcoords
+        self.face_texcoords = face_texcoords
+        self.face_normals = face_normals
+        self.face_materials = face_materials
+        self.materials = materials or []
+        self.textures = textures or {}
+        self.path = path
+
+    @property
+    def n_vertices(self):
+        return len(self.vertices)
+
+    @property
+    def n_faces(self):
+        return len(self.faces)
+
+    def triangles(self):
+        """(faces x 3 x 3) corner coordinates of every face."""
+        return self.vertices[self.faces]
+
+    def bounds(self):
+        """(min, max) corners of the axis aligned bounding box."""
+        return self.vertices.min(axis=0), self.vertices.max(axis=0)
+
+    def __repr__(self):
+        return "<Mesh {} vertices, {} faces>".format(self.n_vertices, self.n_faces)
+
+
+def hemisphere(n):
+    """n unit vectors spread evenly over the upper hemisphere (a Fibonacci spiral), ex. directions to measure a mesh along."""
+    i = np.arange(n) + 0.5
+    z = 1 - i / n
+    r = np.sqrt(1 - z * z)
+    theta = np.pi * (1 + 5 ** 0.5) * i
+    return np.stack([r * np.cos(theta), r * np.sin(theta), z], axis=1)
+
+
+def read_mtl(path):
+    """{material name: texture file (map_Kd) or None} of a .mtl, in the order the materials are defined."""
+    textures = {}
+    name = None
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if not fields:
+                continue
+            if fields[0] == "newmtl" and len(fields) > 1:
+                name = " ".join(fields[1:])
+                textures[name] = None
+            elif fields[0] == "map_Kd" and name is not None and len(fields) > 1:
+                textures[name] = fields[-1]
+    return textures
+
+
+def _parse_floats(lines, columns):
+    """Parse lines of whitespace separated numbers into an array of the given columns (extra columns are dropped)."""
+    values = np.fromstring(" ".join(lines), sep=" ")
+    width = len(lines[0].split())
+    if len(values) == len(lines) * width:
+        return values.reshape(len(lines), width)[:, :columns]
+    # Lines of different widths (ex. only some vertices with colors): line by line, keeping the columns every line has.
+    rows = [line.split() for line in lines]
+    columns = min(columns, min(len(row) for row in rows))
+    return np.array([[float(x) for x in row[:columns]] for row in rows])
+
+
+def _parse_faces(lines, counts):
+    """Parse face lines (without the "f ") into a (triangles x 3 x 3) array of vertex, texcoord and normal indices, 1 based as in the
+    file (0 where the file gives none). Polygons are split into fans; corners then lists each line's corner count (None if every face
+    is a triangle). counts are the vertex, texcoord and normal counts read so far, for negative (relative) indices."""
+    first = lines[0].split()[0]
+    text = " ".join(lines)
+    if "//" in first:  # v//vn
+        text = text.replace("//", "/0/")
+    per_corner = first.count("/") + 1 if "//" not in first else 3  # v, v/vt, v/vt/vn
+    values = np.fromstring(text.replace("/", " "), sep=" ", dtype=np.int64)
+    corners = None
+    if len(values) == len(lines) * 3 * per_corner:  # every face has at least 3 corners, so this means all are triangles
+        tri = values.reshape(len(lines), 3, per_corner)
+    else:
+        corners = np.array([len(line.split()) for line in lines])
+        starts = np.concatenate([[0], np.cumsum(corners)[:-1]])
+        polys = values.reshape(-1, per_corner)
+        first_corner = np.repeat(starts, corners - 2)
+        offsets = np.concatenate([np.arange(1, n - 1) for n in corners])
+        tri = np.stack([polys[first_corner], polys[first_corner + offsets], polys[first_corner + offsets + 1]], axis=1)
+    if per_corner < 3:  # v or v/vt: no normal (or texcoord) indices
+        tri = np.concatenate([tri, np.zeros(tri.shape[:2] + (3 - per_corner,), dtype=np.int64)], axis=2)
+    for k in range(3):
+        negative = tri[:, :, k] < 0
+        if negative.any():
+            tri[:, :, k][negative] += counts[k] + 1
+    return tri, corners
+
+
+def load_obj(path, block_lines=BLOCK_LINES):
+    """Parse an OBJ (and the .mtl it names) into a Mesh, block_lines lines at a time."""
+    parts = {"v": [], "vn": [], "vt": [], "f": [], "m": []}
+    counts = [0, 0, 0]
+    materials = []
+    material = 0
+    mtllib = None
+
+    def flush(block):
+        nonlocal material, mtllib
+        v, vn, vt, f = [], [], [], []
+        face_materials = []
+        for line in block:
+            c = line[:2]
+            if c == "v ":
+                v.append(line[2:])
+            elif c == "f ":
+                f.append(line[2:])
+                face_materials.append(material)
+            elif c == "vn":
+                vn.append(line[3:])
+            elif c == "vt":
+                vt.append(line[3:])
+            elif line.startswith("usemtl"):
+                name = line[6:].strip()
+                if name not in materials:
+                    materials.append(name)
+                material = materials.index(name)
+            elif line.startswith("mtllib"):
+                mtllib = line[6:].strip()
+        if v:
+            parts["v"].append(_parse_floats(v, 6 if len(v[0].split()) >= 6 else 3))
+            counts[0] += len(v)
+        if vt:
+            parts["vt"].append(_parse_floats(vt, 2).astype(np.float32))
+            counts[1] += len(vt)
+        if vn:
+            parts["vn"].append(_parse_floats(vn, 3).astype(np.float32))
+            counts[2] += len(vn)
+        if f:
+            tri, corners = _parse_faces(f, counts)
+            parts["f"].append(tri)
+            face_materials = np.array(face_materials, dtype=np.int16)
+            parts["m"].append(face_materials if corners is None else np.repeat(face_materials, corners - 2))
+
+    with open(path) as f:
+        block = []
+        for line in f:
+            block.append(line)
+            if len(block) >= block_lines:
+                flush(block)
+                block = []
+        flush(block)
+
+    if parts["v"]:
+        v = np.concatenate(parts["v"])
+    else:
+        v = np.zeros((0, 3))
+    vertices = np.ascontiguousarray(v[:, :3], dtype=np.float64)
+    colors = np.ascontiguousarray(v[:, 3:6], dtype=np.float32) if v.shape[1] >= 6 else None
+    if parts["f"]:
+        tri = np.concatenate(parts["f"])
+    else:
+        tri = np.zeros((0, 3, 3), dtype=np.int64)
+    index_type = np.int32 if len(vertices) < 2 ** 31 else np.int64
+    faces = np.ascontiguousarray(tri[:, :, 0] - 1, dtype=index_type)
+    face_texcoords = np.ascontiguousarray(tri[:, :, 1] - 1, dtype=index_type) if tri[:, :, 1].any() else None
+    face_normals = np.ascontiguousarray(tri[:, :, 2] - 1, dtype=index_type) if tri[:, :, 2].any() else None
+    face_materials = np.concatenate(parts["m"]) if parts["m"] and materials else None
+
+    textures = {}
+    if mtllib:
+        mtl = os.path.join(os.path.dirname(path), mtllib)
+        if os.path.exists(mtl):
+            textures = read_mtl(mtl)
+    return Mesh(vertices, faces, colors,
+                np.concatenate(parts["vn"]) if parts["vn"] else None,
+                np.concatenate(parts["vt"]) if parts["vt"] else None,
+                face_texcoords, face_normals, face_materials, materials, textures, path)
+
+
+def sidecar_path(path):
+    return os.path.splitext(path)[0] + SIDECAR_SUFFIX
+
+
+def save_sidecar(mesh, path):
+    """Write a mesh to an .npz (with the size and mtime of its OBJ, so a stale sidecar is recognised)."""
+    arrays = {name: getattr(mesh, name) for name in ARRAYS if getattr(mesh, name) is not None}
+    source = os.stat(mesh.path) if mesh.path else None
+    tmp = path + ".tmp.npz"
+    np.savez(tmp, source=np.array([source.st_size, source.st_mtime_ns] if source else [0, 0], dtype=np.int64),
+             materials=np.array(mesh.materials, dtype=str), texture_names=np.array(list(mesh.textures), dtype=str),
+             texture_files=np.array([mesh.textures[name] or "" for name in mesh.textures], dtype=str), **arrays)
+    os.replace(tmp, path)
+
+
+def load_sidecar(path, obj=None):
+    """The mesh cached in an .npz, or None if it does not exist or (with obj) was written for another version of the OBJ."""
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        if obj is not None:
+            st = os.stat(obj)
+            if list(data["source"]) != [st.st_size, st.st_mtime_ns]:
+                return None
+        arrays = {name: data[name] if name in data else None for name in ARRAYS}
+        textures = {name: file or None for name, file in zip(data["texture_names"].tolist(), data["texture_files"].tolist())}
+        return Mesh(materials=data["materials"].tolist(), textures=textures, path=obj, **arrays)
+
+
+def load(path, cache=True, block_lines=BLOCK_LINES):
+    """Load an OBJ, from its sidecar if that is up to date. With cache, a freshly parsed mesh is saved to the sidecar."""
+    sidecar = sidecar_path(path)
+    mesh = load_sidecar(sidecar, path) if cache else None
+    if mesh is None:
+        mesh = load_obj(path, block_lines)
+        if cache:
+            try:
+                save_sidecar(mesh, sidecar)
+            except OSError as e:  # ex. a read-only models directory; the mesh is still usable
+                print("Could not cache {}: {}".format(path, e), file=sys.stderr)
+    return mesh
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python3 -m metashape_batch.mesh", description="Load exported OBJs and cache them as .mesh.npz.")
+    parser.add_argument("objs", nargs="+", help="exported .obj files")
+    parser.add_argument("--no-cache", action="store_false", dest="cache", help="do not read or write the .mesh.npz sidecars")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    for path in args.objs:
+        m = load(path, args.cache)
+        low, high = m.bounds() if m.n_vertices else (np.zeros(3), np.zeros(3))
+        print("{}: {} vertices, {} faces{}{}, extent {} m".format(
+            os.path.basename(path), m.n_vertices, m.n_faces, ", colors" if m.colors is not None else "",
+            ", {} texture(s)".format(sum(1 for t in m.textures.values() if t)) if m.textures else "",
+            " x ".join("{:.4f}".format(x) for x in high - low)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,294 @@
+# PURPOSE: Compute the coral traits (volume, surface area, convexity, size and linear extension) from the exported models, instead of by
+# hand in MeshLab.
+# Each model is loaded with metashape_batch.mesh (the .mesh.npz cache is used when up to date) and every trait is computed over the whole
+# face or vertex arrays at once:
+#     surface area      sum of the triangle areas (half the norm of each edge cross product)
+#     volume            sum of the signed volumes of the tetrahedra from the centroid to each face. "closed" says whether every edge is
+#                       shared by exactly two faces; an open mesh (ex. cut at the region floor) is measured from the middle of its open
+#                       boundary instead, so the tetrahedra on the missing cap are flat and the volume is that of the mesh capped there
+#     hull volume       volume of the convex hull of the vertices (quickhull in numpy)
+#     convexity         volume / hull volume (1 for a convex shape, lower the more branched or concave the coral)
+#     extent x, y, z    size of the bounding box in the model's coordinate system (z is up, the models are scaled in metres)
+#     linear extension  the longest dimension of the model: its largest width measured over directions spread evenly on a hemisphere
+#     interstitial      the empty space between the branches: convex hull voxels the coral does not fill (see
+#                       metashape_batch/interstitial.py; --resolution sets the voxel size, 0 to skip it). An open mesh is capped at the
+#                       lowest point of its open boundary (the region floor for a mesh cut there), and open_column_fraction is the share
+#                       of its voxel columns that had to be capped
+# Traits are written in cm, cm^2 and cm^3.
+#
+# The batch CLI does a whole models/{project}/{timepoint} directory (every .obj) in a process pool and writes one CSV (default:
+# phenotypes.csv in that directory). With --db the traits are also upserted into the trait database that follows colonies across timepoints
+# (see metashape_batch/traitdb.py):
+#     python3 -m metashape_batch.phenotype /scratch1/migomez/3Dmodels/models/SinglePolyp/090425 --db /project2/ckenkel_26/migomez/traits.sqlite
+
+import argparse
+import csv
+import glob
+import itertools
+import multiprocessing
+import os
+import sys
+
+import numpy as np
+
+from . import interstitial
+from . import mesh as mesh_tools
+
+
+CSV_NAME = "phenotypes.csv"
+
+# Directions the linear extension is measured along (spread evenly over a hemisphere), and vertices projected per block.
+DIRECTIONS = 256
+BLOCK = 1 << 15
+
+FIELDS = ("model", "timepoint", "vertices", "faces", "closed", "surface_area_cm2", "volume_cm3", "hull_volume_cm3", "convexity",
+          "extent_x_cm", "extent_y_cm", "extent_z_cm", "linear_extension_cm", "interstitial_cm3", "interstitial_fraction",
+          "open_column_fraction")
+
+CM = 100.
+
+
+def surface_area(m):
+    a, b, c = (m.vertices[m.faces[:, i]] for i in range(3))
+    return 0.5 * np.linalg.norm(np.cross(b - a, c - a), axis=1).sum()
+
+
+def volume(m, apex=None):
+    """Enclosed volume from the signed tetrahedra from `apex` (default: the centroid) to each face, positive whichever way the faces are
+    wound. With the apex on the flat opening of an open mesh, this is the volume of the mesh capped across the opening."""
+    a, b, c = (m.vertices[m.faces[:, i]] for i in range(3))
+    # Relative to a point on the model, so the terms stay small for models far from the origin.
+    centre = m.vertices.mean(axis=0) if apex is None else apex
+    a, b, c = a - centre, b - centre, c - centre
+    return abs(np.einsum("ij,ij->i", a, np.cross(b, c)).sum()) / 6.
+
+
+def _edges(m):
+    """The distinct edges of the faces and the number of faces sharing each."""
+    edges = np.concatenate([m.faces[:, [0, 1]], m.faces[:, [1, 2]], m.faces[:, [2, 0]]])
+    edges.sort(axis=1)
+    return np.unique(edges, axis=0, return_counts=True)
+
+
+def is_closed(m):
+    """True if every edge is shared by exactly two faces (watertight)."""
+    if not m.n_faces:
+        return False
+    return bool((_edges(m)[1] == 2).all())
+
+
+def boundary(m):
+    """Indices of the vertices on the open boundary of the mesh (on edges of one face only)."""
+    if not m.n_faces:
+        return np.zeros(0, dtype=np.int64)
+    edges, counts = _edges(m)
+    return np.unique(edges[counts == 1])
+
+
+def convex_hull(points):
+    """Faces (n x 3 indices into the points, wound outwards) of the convex hull of the points, by quickhull, or None if the points are
+    flat. Each face keeps the points outside it; the farthest of them is added in turn, replacing the faces it sees with a fan of new faces
+    over the horizon, and the points of the replaced faces are shared out between the new ones."""
+    points = points - points.mean(axis=0)
+    if len(points) < 4:
+        return None
+    eps = 1e-9 * max(float(np.abs(points).max()), 1e-12)
+    # Starting tetrahedron: the extremes along x, the point farthest from their line and the point farthest from their plane.
+    i0, i1 = int(points[:, 0].argmin()), int(points[:, 0].argmax())
+    line = points[i1] - points[i0]
+    if np.linalg.norm(line) <= eps:
+        return None
+    i2 = int(np.linalg.norm(np.cross(points - points[i0], line), axis=1).argmax())
+    normal = np.cross(line, points[i2] - points[i0])
+    if np.linalg.norm(normal) <= eps * np.linalg.norm(line):
+        return None
+    heights = (points - points[i0]) @ normal / np.linalg.norm(normal)
+    i3 = int(np.abs(heights).argmax())
+    if abs(heights[i3]) <= eps:
+        return None
+    if heights[i3] > 0:
+        i1, i2 = i2, i1
+
+    faces = {}      # id: (a, b, c), normal, offset, indices of the points outside
+    edges = {}      # directed edge (a, b): id of the face it belongs to
+    pending = []    # ids of faces with points outside (some may since have been replaced)
+    ids = itertools.count()
+
+    def add(corners, candidates):
+        """Add faces (k x 3 corners) and give each candidate point to the face it is farthest outside of."""
+        a, b, c = (points[corners[:, i]] for i in range(3))
+        normals = np.cross(b - a, c - a)
+        normals /= np.linalg.norm(normals, axis=1)[:, None]
+        offsets = np.einsum("ij,ij->i", normals, a)
+        distance = points[candidates] @ normals.T - offsets
+        owner = distance.argmax(axis=1)
+        outside = distance[np.arange(len(candidates)), owner] > eps
+        candidates, owner = candidates[outside], owner[outside]
+        for k, face in enumerate(corners.tolist()):
+            face_id = next(ids)
+            faces[face_id] = (tuple(face), normals[k], offsets[k], candidates[owner == k])
+            for edge in _face_edges(face):
+                edges[edge] = face_id
+            if len(faces[face_id][3]):
+                pending.append(face_id)
+
+    rest = np.setdiff1d(np.arange(len(points)), [i0, i1, i2, i3])
+    add(np.array([(i0, i1, i2), (i0, i3, i1), (i1, i3, i2), (i2, i3, i0)]), rest)
+
+    while pending:
+        face = pending.pop()
+        if face not in faces:
+            continue
+        _, normal, offset, outside = faces[face]
+        apex = int(outside[(points[outside] @ normal).argmax()])
+        # The faces the apex sees (a connected patch, found by walking across edges) and the horizon around them.
+        visible, stack = {face}, [face]
+        while stack:
+            for a, b in _face_edges(faces[stack.pop()][0]):
+                other = edges[(b, a)]
+                if other not in visible and points[apex] @ faces[other][1] - faces[other][2] > eps:
+                    visible.add(other)
+                    stack.append(other)
+        horizon = [(a, b) for face in visible for a, b in _face_edges(faces[face][0]) if edges[(b, a)] not in visible]
+        candidates = np.concatenate([faces[face][3] for face in visible])
+        for face in visible:
+            for edge in _face_edges(faces[face][0]):
+                if edges.get(edge) == face:
+                    del edges[edge]
+            del faces[face]
+        add(np.array([(a, b, apex) for a, b in horizon]), candidates[candidates != apex])
+    return np.array([corners for corners, _, _, _ in faces.values()], dtype=np.int64)
+
+
+def _face_edges(corners):
+    a, b, c = corners
+    return (a, b), (b, c), (c, a)
+
+
+def hull_volume(points):
+    """Volume of the convex hull of the points (0 if they are flat)."""
+    hull = convex_hull(points)
+    if hull is None:
+        return 0.
+    centre = points.mean(axis=0)
+    a, b, c = (points[hull[:, i]] - centre for i in range(3))
+    return abs(np.einsum("ij,ij->i", a, np.cross(b, c)).sum()) / 6.
+
+
+def linear_extension(points, directions=DIRECTIONS, block=BLOCK):
+    """Largest width of the points over `directions` directions (a hemisphere covers every axis, as the width along d and -d is the same)."""
+    d = mesh_tools.hemisphere(directions)
+    high = np.full(directions, -np.inf)
+    low = np.full(directions, np.inf)
+    for start in range(0, len(points), block):
+        projected = points[start:start + block] @ d.T
+        np.maximum(high, projected.max(axis=0), out=high)
+        np.minimum(low, projected.min(axis=0), out=low)
+    return float((high - low).max()) if len(points) else 0.
+
+
+def traits(m, resolution=interstitial.RESOLUTION):
+    """The traits of one Mesh (see FIELDS), in cm. The interstitial space is voxelised at `resolution` (m; None or 0 to skip it)."""
+    used = m.vertices[np.unique(m.faces)] if m.n_faces else m.vertices
+    closed = is_closed(m)
+    rim = boundary(m) if not closed else []
+    vol = volume(m, m.vertices[rim].mean(axis=0) if len(rim) else None) if m.n_faces else None
+    hull = hull_volume(used)
+    extent = used.max(axis=0) - used.min(axis=0) if len(used) else np.zeros(3)
+    cap = m.vertices[rim, 2].min() if len(rim) else None
+    space = interstitial.estimate(m, resolution, cap) if m.n_faces and resolution else None
+    return {
+        "vertices": m.n_vertices,
+        "faces": m.n_faces,
+        "closed": closed,
+        "surface_area_cm2": round(surface_area(m) * CM ** 2, 4),
+        "volume_cm3": round(vol * CM ** 3, 4) if vol is not None else None,
+        "hull_volume_cm3": round(hull * CM ** 3, 4) if hull else None,
+        "convexity": round(vol / hull, 4) if vol is not None and hull else None,
+        "extent_x_cm": round(extent[0] * CM, 3),
+        "extent_y_cm": round(extent[1] * CM, 3),
+        "extent_z_cm": round(extent[2] * CM, 3),
+        "linear_extension_cm": round(linear_extension(used) * CM, 3),
+        "interstitial_cm3": round(space.volume * CM ** 3, 4) if space else None,
+        "interstitial_fraction": round(space.fraction, 4) if space and space.fraction is not None else None,
+        "open_column_fraction": round(space.open_fraction, 4) if space and space.open_fraction is not None else None,
+    }
+
+
+def model_traits(obj, cache=True, resolution=interstitial.RESOLUTION, timepoint=None):
+    """Traits of one exported model (.obj path), with its name and timepoint (default: the name of its directory)."""
+    row = {"model": os.path.splitext(os.path.basename(obj))[0],
+           "timepoint": timepoint or os.path.basename(os.path.dirname(os.path.abspath(obj)))}
+    row.update(traits(mesh_tools.load(obj, cache), resolution))
+    return row
+
+
+def _worker(args):
+    obj, cache, resolution, timepoint = args
+    try:
+        return model_traits(obj, cache, resolution, timepoint), None
+    except Exception as e:  # one bad model must not stop the batch
+        return None, "{}: {!r}".format(obj, e)
+
+
+def phenotype_dir(models_dir, out=None, workers=None, cache=True, resolution=interstitial.RESOLUTION, timepoint=None):
+    """Traits of every .obj in a models directory, computed in a process pool and written to one CSV. Returns (rows, errors)."""
+    objs = sorted(glob.glob(os.path.join(models_dir, "*.obj")))
+    workers = min(workers or len(os.sched_getaffinity(0)), max(1, len(objs)))
+    rows, errors = [], []
+    with multiprocessing.Pool(workers) as pool:
+        for row, error in pool.imap(_worker, [(obj, cache, resolution, timepoint) for obj in objs]):
+            if row is not None:
+                rows.append(row)
+            else:
+                errors.append(error)
+    out = out or os.path.join(models_dir, CSV_NAME)
+    with open(out, "w", newline="") as f:
+        writer = csv.DictWriter(f, FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    return rows, errors
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python3 -m metashape_batch.phenotype",
+                                     description="Compute volume, surface area, convexity and size of every model in a models directory.")
+    parser.add_argument("models_dir", help="models directory (ex. models/SinglePolyp/090425)")
+    parser.add_argument("--out", help="CSV to write (default: phenotypes.csv in the models directory)")
+    parser.add_argument("--workers", type=int, help="processes (default: all CPUs)")
+    parser.add_argument("--no-cache", action="store_false", dest="cache", help="do not read or write the .mesh.npz caches")
+    parser.add_argument("--resolution", type=float, default=interstitial.RESOLUTION,
+                        help="voxel size (m) for the interstitial space, 0 to skip it (default: {})".format(interstitial.RESOLUTION))
+    parser.add_argument("--db", help="also upsert the traits into this trait database (SQLite, created if missing)")
+    parser.add_argument("--project", help="project (default: from the models directory path)")
+    parser.add_argument("--timepoint", help="timepoint (default: from the models directory path)")
+    parser.add_argument("--scoupr", help="scoupr (default: from the models directory path)")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    from . import traitdb
+    project, timepoint, scoupr = traitdb.locate(args.models_dir)
+    timepoint = args.timepoint or timepoint
+    rows, errors = phenotype_dir(args.models_dir, args.out, args.workers, args.cache, args.resolution, timepoint)
+    for error in errors:
+        print("FAILED " + error, file=sys.stderr)
+    open_meshes = [row["model"] for row in rows if not row["closed"]]
+    if open_meshes:
+        print("Volume and interstitial space of {} open mesh(es) taken with their opening capped: {}".format(
+            len(open_meshes), ", ".join(open_meshes)))
+    print("Wrote traits of {} models to {}".format(len(rows), args.out or os.path.join(args.models_dir, CSV_NAME)))
+    if args.db:
+        db = traitdb.connect(args.db)
+        try:
+            n = traitdb.ingest(db, args.models_dir, args.project if args.project is not None else project, timepoint,
+                               args.scoupr if args.scoupr is not None else scoupr, rows)
+        finally:
+            db.close()
+        print("Upserted {} models into {}".format(n, args.db))
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
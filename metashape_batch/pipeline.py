@@ -0,0 +1,413 @@
+# PURPOSE: The processing stages of the Metashape templates as functions, so that one Metashape process can build many models in a row.
+# Each stage takes a Model (one photoset) and calls the same chunk methods as the templates, with keyword arguments taken from the profile
+# (see metashape_batch/profiles.py). The order of the stages comes from the profile too, since fragram and scoupr/rack models detect
+# markers at different points. This module must be imported from within Metashape (it imports the Metashape module).
+#
+# Runs can be resumed: if the model's .psz already exists (ex. the job hit the 72h --time limit) it is reopened, the products it already
+# holds (photos, markers, tie points, alignment, reference, scalebars, depth maps, model, texture, exports) are inspected and processing
+# picks up right after the last completed stage, so no finished alignment or depth map work is redone.
+# run() logs the time and peak memory of every stage next to the .psz (see metashape_batch/instrument.py) and measures the finished model
+# (cameras, megapixels, faces) for the runtime history.
+
+import os
+
+import Metashape
+import numpy as np
+
+from . import imageindex
+from . import instrument
+from . import policy as policy_tools
+from . import preflight
+from . import profiles
+from . import region as region_tools
+from . import scalebars as scalebar_tools
+
+
+# Local coordinate system in metres (instead of WGS 84, EPSG::4326).
+LOCAL_CRS = 'LOCAL_CS["Local Coordinates (m)",LOCAL_DATUM["Local Datum",0],UNIT["metre",1,AUTHORITY["EPSG","9001"]]]'
+
+# Keyword arguments whose values are given by name in the profiles and need to be swapped for the Metashape enum of that name.
+ENUM_ARGS = ("target_type", "filter_mode", "surface_type", "interpolation", "face_count", "source_data", "mapping_mode", "blending_mode",
+             "format")
+
+
+def metashape_args(params):
+    """Swap enum names (ex. "MildFiltering") for the Metashape values."""
+    args = {}
+    for key, value in params.items():
+        if key in ENUM_ARGS and isinstance(value, str):
+            value = getattr(Metashape, value)
+        args[key] = value
+    return args
+
+
+def list_photos(photoset, extensions):
+    """Photos within a photoset directory with one of the given extensions (ex. [".JPG"], in any case), sorted by name."""
+    return sorted(entry.path for entry in os.scandir(photoset) if entry.is_file() and imageindex.matches(entry.name, extensions))
+
+
+def read_scalebars(path):
+    """Read and check a scalebar file (Marker_1_label,Marker_2_label,distance,accuracy per line) into a list of tuples."""
+    return scalebar_tools.read(path)
+
+
+class Model:
+    """One photoset and the Metashape project (.psz) that is built from it."""
+
+    def __init__(self, photoset, output_dir, profile, scalebars=None, photo_actions=None, policy=None, source=None):
+        self.photoset = photoset.rstrip("/")
+        # With staging, photoset is a node-local copy and source the photoset it was copied from: saved projects point at source.
+        self.source = source.rstrip("/") if source else None
+        self.name = os.path.basename(self.photoset)
+        self.output_dir = output_dir
+        self.psz = os.path.join(output_dir, self.name + ".psz")
+        self.obj = os.path.join(output_dir, self.name + ".obj")
+        self.report = os.path.join(output_dir, self.name + "_report.pdf")
+        self.log = instrument.StageLog(os.path.join(output_dir, self.name + instrument.LOG_SUFFIX), self.name)
+        self.profile = profile
+        self.scalebars = scalebars
+        self.doc = None
+        self.chunk = None
+        self.stats = {}
+        self.photo_actions = photo_actions or {}  # photo file name -> "exclude" / "disable" (see metashape_batch/preflight.py)
+        self.policy = policy  # chooses the depth map settings (see metashape_batch/policy.py)
+        self.depth_decision = None
+        self.scalebar_result = None
+        self.quality = {}  # metrics of the quality gates (see metashape_batch/quality.py)
+
+    def params(self, stage):
+        return metashape_args(profiles.stage_params(self.profile, stage))
+
+    def open(self, resume=True):
+        """Open the existing project (if resuming and there is one) or start a new one. Returns True if an existing project was opened."""
+        self.doc = Metashape.Document()
+        if resume and os.path.exists(self.psz):
+            try:
+                self.doc.open(self.psz, ignore_lock=True)  # a job killed mid-run leaves its lock behind
+            except Exception as e:
+                print("[{}] Could not reopen {} ({}). Starting over.".format(self.name, self.psz, e))
+                self.doc = Metashape.Document()
+            else:
+                if self.doc.chunk is not None:
+                    self.chunk = self.doc.chunk
+                    self.relink(self.photoset)  # the project may have been saved pointing at another copy of the photos
+                    return True
+        self.chunk = self.doc.addChunk()
+        return False
+
+    def relink(self, photoset):
+        """Point every camera's photo at the file of the same name in another directory (ex. the staged copy of the photoset)."""
+        for camera in self.chunk.cameras:
+            if camera.photo is None:
+                continue
+            # camera.photo is a copy: change it and set it back.
+            photo = camera.photo.copy()
+            photo.path = os.path.join(photoset, os.path.basename(photo.path))
+            camera.photo = photo
+
+    def save(self, path=None):
+        """Save the project. A staged model's project is saved pointing at the source photoset, so copies of it (checkpoints and the
+        pushed outputs) can be reopened once the local copy is gone."""
+        if self.source:
+            self.relink(self.source)
+        try:
+            if path:
+                self.doc.save(path)
+            else:
+                self.doc.save()
+        finally:
+            if self.source:
+                self.relink(self.photoset)
+
+    def close(self):
+        self.doc = None
+        self.chunk = None
+
+
+### Stages
+
+def add_photos(model):
+    """Add the photos (leaving out those the pre-flight scan excluded, and disabling the cameras of those it flagged)."""
+    actions = model.photo_actions
+    photos = [photo for photo in list_photos(model.photoset, model.profile["photo_extensions"])
+              if actions.get(os.path.basename(photo)) != preflight.EXCLUDE]
+    model.chunk.addPhotos(photos)
+    disabled = 0
+    for camera in model.chunk.cameras:
+        if actions.get(os.path.basename(camera.photo.path)) == preflight.DISABLE:
+            camera.enabled = False
+            disabled += 1
+    if actions:
+        print("[{}] Pre-flight: {} photos excluded, {} cameras disabled".format(
+            model.name, sum(1 for action in actions.values() if action == preflight.EXCLUDE), disabled))
+    model.save(model.psz)  # names the Metashape Project file after the photoset
+    model.chunk.label = model.name
+
+
+def detect_markers(model):
+    model.chunk.detectMarkers(**model.params("detectMarkers"))
+
+
+def match_photos(model):
+    model.chunk.matchPhotos(**model.params("matchPhotos"))
+
+
+def align_cameras(model):
+    model.chunk.alignCameras(**model.params("alignCameras"))
+
+
+def import_reference(model):
+    crs_local = Metashape.CoordinateSystem(LOCAL_CRS)
+    model.chunk.importReference(path=model.profile["coords"], crs=crs_local, **model.params("importReference"))
+    model.chunk.updateTransform()
+
+
+def scalebars(model):
+    """Create (or update) scalebars between marker pairs listed in the scalebar file."""
+    result = scalebar_tools.apply(model.chunk, model.scalebars)
+    model.scalebar_result = result
+    print("[{}] {}".format(model.name, result.summary()))
+
+
+def clear_scalebars(model):
+    """Remove the scalebars (a model rescued without them, see metashape_batch/rescue.py)."""
+    if model.chunk.scalebars:
+        model.chunk.remove(list(model.chunk.scalebars))
+
+
+def optimize_cameras(model):
+    """Remove poor tie points, then optimize camera locations based on all distortion parameters."""
+    chunk = model.chunk
+    # Metashape 2.0+ changed "PointCloud" to "TiePoints".
+    tie_points = getattr(Metashape, "TiePoints", None) or Metashape.PointCloud
+    for criterion, threshold in profiles.stage_params(model.profile, "filterTiePoints").items():
+        if threshold is None:  # filter switched off
+            continue
+        f = tie_points.Filter()
+        f.init(chunk, getattr(tie_points.Filter, criterion))
+        f.removePoints(float(threshold))
+    chunk.optimizeCameras(**model.params("optimizeCameras"))
+
+
+def _tie_point_cloud(chunk, T):
+    """(n x 3) CRS coordinates of the chunk's valid tie points (T as a numpy array)."""
+    tie_points = _tie_points(chunk)
+    coords = [point.coord for point in getattr(tie_points, "points", None) or []
+              if getattr(point, "valid", True) and hasattr(point, "coord")]
+    if not coords:
+        return np.zeros((0, 3))
+    c = np.array([[v[0], v[1], v[2], v[3]] for v in coords])
+    points = region_tools.transform_points(T, c[:, :3] / c[:, 3:])
+    crs = chunk.crs
+    if crs is not None and not crs.wkt.startswith("LOCAL_CS"):  # geocentric -> geographic CRS coordinates
+        points = np.array([list(crs.project(Metashape.Vector(point))) for point in points])
+    return points
+
+
+def region(model):
+    """Rotate the bounding box in line with the coordinate system, then set its center and size in CRS coordinates: a preset, the
+    profile's box or one fitted to the tie points (see metashape_batch/region.py). The tie points are saved for checking boxes later."""
+    chunk = model.chunk
+    crs = chunk.crs
+    T = chunk.transform.matrix
+    T_array = region_tools.to_array(T)
+
+    points = _tie_point_cloud(chunk, T_array)
+    if len(points):
+        region_tools.save_cloud(os.path.join(model.output_dir, model.name + region_tools.TIEPOINTS_SUFFIX), points)
+    center, size, fitted = region_tools.choose(profiles.stage_params(model.profile, "region"), points)
+
+    identity = np.eye(4)
+    origin_frame = region_tools.to_array(crs.localframe(T.mulp(Metashape.Vector([0, 0, 0])))) if crs else identity
+    unprojected = list(crs.unproject(Metashape.Vector(list(center)))) if crs else list(center)
+    frame = region_tools.to_array(crs.localframe(Metashape.Vector(unprojected))) if crs else identity
+    inside, inside_size = region_tools.internal_box(T_array, frame, unprojected, size)
+    reg = chunk.region
+    reg.rot = Metashape.Matrix(region_tools.rotation(T_array, origin_frame).tolist())
+    reg.center = Metashape.Vector(inside.tolist())
+    reg.size = Metashape.Vector(inside_size.tolist())
+    chunk.region = reg
+    print("[{}] Region center ({}) size ({}){}".format(model.name, ", ".join("{:.3f}".format(x) for x in center),
+                                                      ", ".join("{:.3f}".format(x) for x in size),
+                                                      " fitted to {} tie points".format(len(points)) if fitted else ""))
+
+
+def depth_inputs(chunk):
+    """(aligned cameras, their megapixels, share of the tie points inside the region) for the depth map policy."""
+    cameras = [camera for camera in chunk.cameras if camera.transform and camera.enabled]
+    megapixels = sum(camera.sensor.width * camera.sensor.height for camera in cameras if camera.sensor is not None) / 1e6
+    coords = [point.coord for point in getattr(_tie_points(chunk), "points", None) or []
+              if getattr(point, "valid", True) and hasattr(point, "coord")]
+    share = 1.
+    if coords:
+        c = np.array([[v[0], v[1], v[2], v[3]] for v in coords])
+        reg = chunk.region
+        # The region's axes are the columns of rot, so (p - center) @ rot are the points in the region's frame.
+        local = (c[:, :3] / c[:, 3:] - np.array(list(reg.center))) @ region_tools.to_array(reg.rot, 3)
+        share = float((np.abs(local) <= np.array(list(reg.size)) / 2).all(axis=1).mean())
+    return len(cameras), megapixels, share
+
+
+def build_depth_maps(model):
+    """Build the depth maps, with the downscale and max_neighbors the policy chooses if the model has one."""
+    params = model.params("buildDepthMaps")
+    if model.policy is not None:
+        model.depth_decision = model.policy.choose(*depth_inputs(model.chunk))
+        params.update(downscale=model.depth_decision["downscale"], max_neighbors=model.depth_decision["max_neighbors"])
+        print("[{}] Depth maps: {}".format(model.name, policy_tools.describe(model.depth_decision)))
+    model.chunk.buildDepthMaps(**params)
+
+
+def build_model(model):
+    model.chunk.buildModel(**model.params("buildModel"))
+
+
+def clean_model(model):
+    """Remove shards and leave only the big coral mesh behind (Metashape 2.2.1 only)."""
+    if hasattr(model.chunk.model, "cleanModel"):
+        model.chunk.model.cleanModel(criterion=Metashape.Model.Criterion.ComponentSize, **model.params("cleanModel"))
+
+
+def build_uv(model):
+    model.chunk.buildUV(**model.params("buildUV"))
+
+
+def build_texture(model):
+    model.chunk.buildTexture(**model.params("buildTexture"))
+
+
+def clear_depth_maps(model):
+    if model.chunk.depth_maps:
+        model.chunk.depth_maps.clear()
+
+
+def export_model(model):
+    model.chunk.exportModel(model.obj, **model.params("exportModel"))
+
+
+def export_report(model):
+    model.chunk.exportReport(path=model.report, title=model.name, **model.params("exportReport"))
+
+
+STAGES = {
+    "addPhotos": add_photos,
+    "detectMarkers": detect_markers,
+    "matchPhotos": match_photos,
+    "alignCameras": align_cameras,
+    "importReference": import_reference,
+    "scalebars": scalebars,
+    "clearScalebars": clear_scalebars,
+    "optimizeCameras": optimize_cameras,
+    "region": region,
+    "buildDepthMaps": build_depth_maps,
+    "buildModel": build_model,
+    "cleanModel": clean_model,
+    "buildUV": build_uv,
+    "buildTexture": build_texture,
+    "clearDepthMaps": clear_depth_maps,
+    "exportModel": export_model,
+    "exportReport": export_report,
+}
+
+
+# Files whose size is logged after each stage (the project, unless the stage exports something).
+OUTPUTS = {
+    "exportModel": lambda model: [model.obj, os.path.splitext(model.obj)[0] + ".mtl"],
+    "exportReport": lambda model: [model.report],
+}
+
+
+### Checks for whether a stage's product already exists in the project. None means the stage leaves nothing to check for (it is cheap
+### and is simply rerun if processing resumes before it).
+
+def _tie_points(chunk):
+    # Metashape 2.0+ keeps tie points in chunk.tie_points (chunk.point_cloud is the dense cloud); 1.8 kept them in chunk.point_cloud.
+    if hasattr(chunk, "tie_points"):
+        return chunk.tie_points
+    return chunk.point_cloud
+
+
+def _has_texture(chunk):
+    return len(getattr(chunk.model, "textures", None) or []) > 0
+
+
+DONE = {
+    "addPhotos": lambda model: len(model.chunk.cameras) > 0,
+    "detectMarkers": lambda model: len(model.chunk.markers) > 0,
+    "matchPhotos": lambda model: _tie_points(model.chunk) is not None,
+    "alignCameras": lambda model: any(camera.transform for camera in model.chunk.cameras),
+    "importReference": lambda model: model.chunk.crs is not None and any(marker.reference.location for marker in model.chunk.markers),
+    "scalebars": lambda model: len(model.chunk.scalebars) > 0,
+    "clearScalebars": None,
+    "optimizeCameras": None,
+    "region": None,
+    "buildDepthMaps": lambda model: model.chunk.depth_maps is not None,
+    "buildModel": lambda model: model.chunk.model is not None,
+    "cleanModel": None,
+    "buildUV": None,
+    "buildTexture": lambda model: model.chunk.model is not None and _has_texture(model.chunk),
+    "clearDepthMaps": None,
+    "exportModel": lambda model: os.path.exists(model.obj),
+    "exportReport": lambda model: os.path.exists(model.report),
+}
+
+
+def resume_point(model, stages):
+    """Index of the first stage to run: the one right after the last stage whose product is already in the project."""
+    for i in range(len(stages) - 1, -1, -1):
+        done = DONE.get(stages[i])
+        if done is not None and done(model):
+            return i + 1
+    return 0
+
+
+def measure(model):
+    """Inputs and size of the built model, kept in model.stats for the runtime history (see metashape_batch/predict.py)."""
+    chunk = model.chunk
+    cameras = list(chunk.cameras)
+    pixels = 0
+    for camera in cameras:
+        if camera.sensor is not None:
+            pixels += camera.sensor.width * camera.sensor.height
+    return {
+        "cameras": len(cameras),
+        "megapixels": round(pixels / 1e6, 1),
+        "aligned": sum(1 for camera in cameras if camera.transform),
+        "faces": len(chunk.model.faces) if chunk.model is not None else None,
+    }
+
+
+def run(model, stages, resume=True, after_stage=None, restart=None, check=None):
+    """Build one model, saving the project after every stage. With resume, an existing project is reopened and only the stages after
+    the last completed one are run. With restart (a stage), the existing project is reopened and processing starts at that stage.
+    after_stage(model, stage) and then check(model, stage), if given, are called once each stage is saved; check raises to stop the
+    build. Returns (stage, seconds) for each stage that was run."""
+    unknown = [stage for stage in stages if stage not in STAGES]
+    if unknown:
+        raise ValueError("Unknown stage(s): {}".format(", ".join(unknown)))
+    reopened = model.open(resume or restart is not None)
+    try:
+        start = resume_point(model, stages) if reopened else 0
+        if reopened and restart is not None:
+            start = stages.index(restart)
+            print("[{}] Restarting {} at {}".format(model.name, model.psz, restart))
+        elif reopened:
+            if start == len(stages):
+                print("[{}] Already complete in {}".format(model.name, model.psz))
+            else:
+                print("[{}] Resuming {} at {}".format(model.name, model.psz, stages[start]))
+        timings = []
+        for stage in stages[start:]:
+            print("[{}] {}".format(model.name, stage))
+            with model.log.stage(stage, *OUTPUTS.get(stage, lambda model: [model.psz])(model)) as record:
+                STAGES[stage](model)
+                model.save()
+            timings.append((stage, record["wall"]))
+            if after_stage is not None:
+                after_stage(model, stage)
+            if check is not None:
+                check(model, stage)
+        model.stats = measure(model)
+        return timings
+    finally:
+        model.close()
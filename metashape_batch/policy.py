@@ -0,0 +1,152 @@
+# PURPOSE: Choose the depth map downscale and max_neighbors of each photoset from its size and a time budget, instead of building every
+# photoset at the templates' downscale 2 and hand-editing a template to downscale 4 when a big set does not finish.
+# Depth map and meshing time grows with the pixels matched: the megapixels of the aligned cameras, divided by downscale^2, times the
+# neighbours each camera is matched with, times the share of the images the region covers (taken as the share of tie points inside the
+# region). These are "work units":
+#     units = megapixels * share / downscale^2 * max_neighbors / 16
+# The seconds per unit come from the runtime history of the project (buildDepthMaps + buildModel time of past builds, see
+# metashape_batch/predict.py), or RATE without history. The policy tries the settings from best to cheapest (downscale from finest to
+# coarsest, and for each the max_neighbors in NEIGHBORS) and takes the first whose predicted time fits the budget; if none does, the
+# cheapest. So a small BMP fragrameter set keeps full quality and a large in-water set is coarsened to finish.
+#
+# It is switched on by a "depth_policy" entry in the profile or the manifest's settings, ex. {"depth_policy": {"budget_hours": 12}}
+# (generate ... --depth-budget 12 writes it), and applied in the buildDepthMaps stage once the cameras are aligned and the region is set.
+# Each decision is printed, stored in the status index ("depth") and recorded in the runtime history. A dry run over a timepoint's
+# photosets (every photo taken as aligned, the whole image as covered):
+#     python3 -m metashape_batch.policy /scratch1/migomez/3Dmodels/source_images/SinglePolyp/090425 /scratch1/migomez/3Dmodels/models/SinglePolyp/090425 --budget 12
+
+import argparse
+import os
+import sys
+
+from . import imageindex
+from . import predict
+from . import profiles
+
+
+# Defaults of the "depth_policy" options.
+BUDGET_HOURS = 24
+FINEST = 2
+COARSEST = 8
+NEIGHBORS = (16, 8)
+
+# Seconds per work unit without history to calibrate from.
+RATE = 20.
+
+# Stages whose time the work units account for.
+STAGES = ("buildDepthMaps", "buildModel")
+
+DOWNSCALES = (1, 2, 4, 8, 16)
+
+
+def units(megapixels, share, downscale, neighbors):
+    return megapixels * share / (downscale * downscale) * neighbors / 16.
+
+
+def rates(records):
+    """Seconds per work unit of each history record with depth map and meshing times and the inputs to count its work units."""
+    found = []
+    for record in records:
+        seconds = sum(record.get("stages", {}).get(stage, 0) for stage in STAGES)
+        work = record.get("depth_units")
+        if work is None and record.get("megapixels"):
+            # Builds from before the policy: the whole image, with the templates' 16 neighbours.
+            work = units(record["megapixels"], 1., record.get("downscale", 1), record.get("max_neighbors", 16))
+        if seconds > 0 and work:
+            found.append(seconds / work)
+    return found
+
+
+def calibrate(records):
+    """Median seconds per work unit over history records with depth map and meshing times. None without any."""
+    found = sorted(rates(records))
+    return found[len(found) // 2] if found else None
+
+
+class Policy:
+    """Chooses buildDepthMaps downscale and max_neighbors to fit a time budget (s)."""
+
+    def __init__(self, budget=BUDGET_HOURS * 3600, finest=FINEST, coarsest=COARSEST, neighbors=NEIGHBORS, rate=None, samples=0):
+        self.budget = budget
+        self.finest = finest
+        self.coarsest = coarsest
+        self.neighbors = tuple(neighbors)
+        self.rate = rate or RATE
+        self.samples = samples  # history records that gave a rate (0: the default RATE)
+
+    @classmethod
+    def from_profile(cls, profile, records=()):
+        """The profile's policy, calibrated on history records, or None if the profile has no "depth_policy"."""
+        options = profile.get("depth_policy")
+        if not options:
+            return None
+        options = dict(options) if isinstance(options, dict) else {}
+        found = rates(records)
+        return cls(options.get("budget_hours", BUDGET_HOURS) * 3600, options.get("finest", FINEST), options.get("coarsest", COARSEST),
+                   options.get("neighbors", NEIGHBORS), options.get("rate", calibrate(records)),
+                   0 if "rate" in options else len(found))
+
+    def ladder(self, cameras):
+        """(downscale, max_neighbors) from best to cheapest."""
+        scales = [d for d in DOWNSCALES if self.finest <= d <= self.coarsest] or [self.finest]
+        most = max(1, cameras - 1)
+        steps = []
+        for d in scales:
+            for n in self.neighbors:
+                step = (d, min(n, most))
+                if step not in steps:
+                    steps.append(step)
+        return steps
+
+    def choose(self, cameras, megapixels, share=1.):
+        """Decision for a photoset of `cameras` aligned cameras of `megapixels` in total, `share` of which the region covers: a dict of
+        downscale, max_neighbors, units, predicted seconds, budget and the reason."""
+        steps = self.ladder(cameras)
+        for d, n in steps:
+            work = units(megapixels, share, d, n)
+            if work * self.rate <= self.budget:
+                reason = "best that fits the budget" if (d, n) == steps[0] else "coarsened to fit the budget"
+                break
+        else:
+            d, n = steps[-1]
+            work = units(megapixels, share, d, n)
+            reason = "over budget at the cheapest settings"
+        return {"downscale": d, "max_neighbors": n, "units": round(work, 2), "predicted": round(work * self.rate),
+                "budget": round(self.budget), "cameras": cameras, "megapixels": round(megapixels, 1), "share": round(share, 3),
+                "reason": reason}
+
+
+def describe(decision):
+    return "downscale {downscale}, max_neighbors {max_neighbors}: {predicted:.0f} s predicted of {budget:.0f} s ({reason})".format(**decision)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python3 -m metashape_batch.policy",
+                                     description="Show the depth map settings the policy would choose for each photoset of a timepoint.")
+    parser.add_argument("source_dir", help="timepoint directory that holds the photosets")
+    parser.add_argument("models_dir", help="models directory of the timepoint (runtime history and image index)")
+    parser.add_argument("--profile", choices=sorted(profiles.PROFILES), default="fragram", help="profile whose photo types to count")
+    parser.add_argument("--budget", type=float, default=BUDGET_HOURS, help="hours per model (default: {})".format(BUDGET_HOURS))
+    parser.add_argument("--finest", type=int, default=FINEST, help="finest downscale allowed (default: {})".format(FINEST))
+    parser.add_argument("--coarsest", type=int, default=COARSEST, help="coarsest downscale allowed (default: {})".format(COARSEST))
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    from .generate import list_photosets
+    profile = profiles.get_profile(args.profile, depth_policy={"budget_hours": args.budget, "finest": args.finest, "coarsest": args.coarsest})
+    policy = Policy.from_profile(profile, predict.load_history(args.models_dir))
+    print("{:.1f} s per work unit ({})".format(policy.rate, "from {} builds".format(policy.samples) if policy.samples else "default"))
+    index = imageindex.ImageIndex(args.models_dir)
+    for photoset in list_photosets(args.source_dir):
+        photos = index.photos(photoset, profile["photo_extensions"])
+        megapixels = sum((photo["width"] or 0) * (photo["height"] or 0) for photo in photos) / 1e6
+        print("{}: {} photos, {:.0f} MP: {}".format(os.path.basename(photoset), len(photos), megapixels,
+                                                   describe(policy.choose(len(photos), megapixels))))
+    index.save()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,157 @@
+# PURPOSE: Predict how long a model will take to build from its inputs, and pack photosets into array tasks by predicted cost.
+# Photosets vary a lot in size (a SinglePolyp set of a few dozen BMPs vs. a DRTO scoupr set of hundreds of JPGs), so splitting batches by
+# directory leaves some jobs nearly empty and others short of time. The batch runner appends one record per model to runtime_history.jsonl in
+# the models directory: its inputs (image count, bytes on disk, camera megapixels, depth map downscale, face count) and how long each stage took.
+# From the complete builds in those files a least squares model
+#     seconds = a + b * images + c * image_MB / downscale^2
+# is fit (image bytes stand in for pixel count, since they are known before Metashape has opened the photos). The generator's array mode
+# then packs photosets into tasks, first fit decreasing, so each task fills its walltime with as little idle time as possible.
+#
+# Ex: python3 -m metashape_batch.predict /scratch1/migomez/3Dmodels/models/SinglePolyp/090425     (fit and print the model)
+
+import argparse
+import json
+import os
+import sys
+
+from . import imageindex
+from . import profiles
+from . import status
+
+
+HISTORY_NAME = "runtime_history.jsonl"
+
+# Fewest complete builds to fit all three terms; with fewer, a per-image rate is used.
+MIN_FIT = 6
+
+
+def photoset_inputs(photoset, extensions, index=None):
+    """(image count, total bytes) of the photos in a photoset directory (from the timepoint's imageindex.ImageIndex, if given)."""
+    photos = (index or imageindex.ImageIndex()).photos(photoset, extensions)
+    return len(photos), sum(photo["size"] for photo in photos)
+
+
+def downscale(profile):
+    return profiles.stage_params(profile, "buildDepthMaps").get("downscale", 1)
+
+
+def append_history(models_dir, record):
+    """Add one model's record to the models directory's runtime history."""
+    with open(os.path.join(models_dir, HISTORY_NAME), "a") as f:
+        f.write(json.dumps(record, sort_keys=True) + "\n")
+
+
+def load_history(models_dir):
+    """Complete builds recorded in this models directory and its siblings (other timepoints or scouprs of the project)."""
+    records = []
+    for path in status.sibling_files(models_dir, HISTORY_NAME):
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    if record.get("complete") and record.get("status") == status.DONE:
+                        records.append(record)
+    return records
+
+
+def terms(images, size, scale):
+    return [1., float(images), size / (1024. * 1024) / (scale * scale)]
+
+
+def _solve(a, b):
+    """Solve the square system a x = b (Gaussian elimination with partial pivoting). Returns None if it is singular."""
+    n = len(b)
+    m = [row[:] + [b[i]] for i, row in enumerate(a)]
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda r: abs(m[r][col]))
+        if abs(m[pivot][col]) < 1e-12:
+            return None
+        m[col], m[pivot] = m[pivot], m[col]
+        for r in range(col + 1, n):
+            f = m[r][col] / m[col][col]
+            for c in range(col, n + 1):
+                m[r][c] -= f * m[col][c]
+    x = [0.] * n
+    for r in range(n - 1, -1, -1):
+        x[r] = (m[r][n] - sum(m[r][c] * x[c] for c in range(r + 1, n))) / m[r][r]
+    return x
+
+
+class Predictor:
+    """Build time (s) of a photoset from its image count, image bytes and depth map downscale."""
+
+    def __init__(self, coefficients, samples, error=None):
+        self.coefficients = coefficients
+        self.samples = samples
+        self.error = error  # root mean square error of the fit (s)
+
+    @classmethod
+    def fit(cls, records):
+        """Fit from history records. Returns None when there is no history."""
+        rows = [(terms(r["images"], r["bytes"], r.get("downscale", 1)), r["elapsed"]) for r in records if r.get("images")]
+        if not rows:
+            return None
+        coefficients = None
+        if len(rows) >= MIN_FIT:
+            ata = [[sum(x[i] * x[j] for x, _ in rows) for j in range(3)] for i in range(3)]
+            aty = [sum(x[i] * y for x, y in rows) for i in range(3)]
+            coefficients = _solve(ata, aty)
+        if coefficients is None or any(c < 0 for c in coefficients[1:]):
+            # Too little (or too uniform) history for the full model: seconds per image.
+            coefficients = [0., sum(y for _, y in rows) / sum(x[1] for x, _ in rows), 0.]
+        predictor = cls(coefficients, len(rows))
+        predictor.error = (sum((predictor._predict(x) - y) ** 2 for x, y in rows) / len(rows)) ** 0.5
+        return predictor
+
+    def _predict(self, x):
+        return max(0., sum(c * v for c, v in zip(self.coefficients, x)))
+
+    def predict(self, images, size, scale=1):
+        return self._predict(terms(images, size, scale))
+
+
+def pack(costs, capacity):
+    """Group items into bins whose summed cost fits capacity, first fit decreasing. costs maps item -> cost.
+
+    An item that alone exceeds the capacity gets a bin of its own. Returns a list of (load, [items]), largest load first.
+    """
+    bins = []
+    for item in sorted(costs, key=lambda item: costs[item], reverse=True):
+        for b in bins:
+            if b[0] + costs[item] <= capacity:
+                b[0] += costs[item]
+                b[1].append(item)
+                break
+        else:
+            bins.append([costs[item], [item]])
+    return sorted(((load, items) for load, items in bins), key=lambda b: b[0], reverse=True)
+
+
+def predict_photosets(predictor, profile, photosets, index=None):
+    """Predicted build time (s) of each photoset."""
+    scale = downscale(profile)
+    return {photoset: predictor.predict(*photoset_inputs(photoset, profile["photo_extensions"], index), scale=scale)
+            for photoset in photosets}
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python3 -m metashape_batch.predict",
+                                     description="Fit the runtime model from the history next to a models directory and print it.")
+    parser.add_argument("models_dir", help="models directory (its siblings' history is used too)")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    predictor = Predictor.fit(load_history(args.models_dir))
+    if predictor is None:
+        print("No complete builds recorded near {}".format(args.models_dir))
+        return 1
+    a, b, c = predictor.coefficients
+    print("seconds = {:.0f} + {:.1f} * images + {:.2f} * image_MB / downscale^2".format(a, b, c))
+    print("Fit to {} models, RMS error {:.0f} s".format(predictor.samples, predictor.error))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
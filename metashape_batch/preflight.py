@@ -0,0 +1,205 @@
+# PURPOSE: Check every photo of a batch before Metashape sees it, so bad frames are left out of alignment instead of being found in the report.
+# Motion blur underwater, dark frames and photos that were only partly copied all degrade matchPhotos/alignCameras silently. The scan
+# decodes each photo at thumbnail size (JPEGs are decoded straight at a reduced scale), and measures its sharpness (variance of the
+# Laplacian), exposure (mean level and share of clipped pixels) and whether the file is complete (JPEG end marker, BMP size in its header,
+# PNG IEND chunk) and decodes at all. Photos are scanned in a process pool as one stream across all photosets, and each photoset's table is
+# written as soon as its last photo is done: <models dir>/<photoset>_preflight.csv. Photosets whose table is newer than all their photos
+# are not scanned again.
+#
+# Sharpness depends on the subject and the lens, so a photo is blurry when it is well below the median of its own photoset. Photos that
+# cannot be used at all (unreadable or truncated) get action "exclude" and are not added to the project; blurry, dark or overexposed
+# photos get "disable" and are added as disabled cameras (unless that would disable most of the photoset, which means the thresholds do
+# not suit it and only a warning is given). The batch runner applies the table of each photoset when it adds the photos.
+#
+# Needs Pillow and numpy (the runner only reads the tables).
+#     python3 -m metashape_batch.preflight /scratch1/migomez/3Dmodels/source_images/SinglePolyp/090425 /scratch1/migomez/3Dmodels/models/SinglePolyp/090425
+# or let the generator do it for the photosets it schedules: python3 -m metashape_batch.generate fragram 090425 --mode runner --preflight
+
+import argparse
+import csv
+import multiprocessing
+import os
+import struct
+import sys
+
+from . import imageindex
+from . import profiles
+
+
+SUFFIX = "_preflight.csv"
+
+EXCLUDE = "exclude"
+DISABLE = "disable"
+
+THUMBNAIL = 512         # longest side (px) photos are measured at
+BLUR_RATIO = 0.35       # blurry below this fraction of the photoset's median sharpness
+DARK_LEVEL = 35         # dark below this mean level (0-255)
+CLIPPED_LEVEL = 250
+CLIPPED_SHARE = 0.3     # overexposed when this share of pixels is at or above CLIPPED_LEVEL
+MAX_DISABLE = 0.5       # never disable more than this share of a photoset
+
+FIELDS = ("photo", "width", "height", "sharpness", "brightness", "clipped", "flags", "action")
+
+
+def truncated(path):
+    """True if a JPEG, BMP or PNG file is cut short (checked from its header and end, without decoding it)."""
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        head = f.read(26)
+        if head[:2] == b"\xff\xd8":
+            f.seek(max(0, size - 64))
+            return b"\xff\xd9" not in f.read()
+        if head[:2] == b"BM" and len(head) >= 6:
+            return size < struct.unpack("<I", head[2:6])[0]
+        if head[:8] == b"\x89PNG\r\n\x1a\n":
+            f.seek(max(0, size - 12))
+            return b"IEND" not in f.read()
+    return size == 0
+
+
+def scan_image(path):
+    """Measure one photo. Returns a row of FIELDS (flags and action are filled in by judge())."""
+    from PIL import Image
+    import numpy as np
+
+    row = {"photo": os.path.basename(path), "flags": []}
+    try:
+        if truncated(path):
+            row["flags"].append("truncated")
+        with Image.open(path) as im:
+            row["width"], row["height"] = im.size
+            im.draft("L", (THUMBNAIL, THUMBNAIL))  # JPEG: decode at 1/2, 1/4 or 1/8 scale
+            im = im.convert("L")
+            im.thumbnail((THUMBNAIL, THUMBNAIL))
+            a = np.asarray(im, dtype=np.float32)
+    except Exception as e:  # any decoder error means Metashape cannot use the photo either
+        row["flags"].append("unreadable")
+        row["error"] = repr(e)
+        return row
+    lap = a[1:-1, :-2] + a[1:-1, 2:] + a[:-2, 1:-1] + a[2:, 1:-1] - 4 * a[1:-1, 1:-1]
+    row["sharpness"] = round(float(lap.var()), 2)
+    row["brightness"] = round(float(a.mean()), 2)
+    row["clipped"] = round(float((a >= CLIPPED_LEVEL).mean()), 4)
+    return row
+
+
+def judge(rows, blur_ratio=BLUR_RATIO, dark_level=DARK_LEVEL, clipped_share=CLIPPED_SHARE, max_disable=MAX_DISABLE):
+    """Flag the rows of one photoset (blurry relative to its median sharpness, dark, overexposed) and set each row's action."""
+    sharpness = sorted(row["sharpness"] for row in rows if "sharpness" in row)
+    median = sharpness[len(sharpness) // 2] if sharpness else 0
+    for row in rows:
+        if "sharpness" not in row:
+            continue
+        if row["sharpness"] < blur_ratio * median:
+            row["flags"].append("blurry")
+        if row["brightness"] < dark_level:
+            row["flags"].append("dark")
+        if row["clipped"] > clipped_share:
+            row["flags"].append("overexposed")
+    for row in rows:
+        if "unreadable" in row["flags"] or "truncated" in row["flags"]:
+            row["action"] = EXCLUDE
+        elif row["flags"]:
+            row["action"] = DISABLE
+        else:
+            row["action"] = ""
+    disabled = [row for row in rows if row["action"] == DISABLE]
+    if rows and len(disabled) > max_disable * len(rows):
+        for row in disabled:
+            row["action"] = ""
+    return rows
+
+
+def table_path(models_dir, photoset):
+    return os.path.join(models_dir, os.path.basename(photoset.rstrip("/")) + SUFFIX)
+
+
+def write_table(path, rows):
+    with open(path + ".tmp", "w", newline="") as f:
+        writer = csv.DictWriter(f, FIELDS, extrasaction="ignore")
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(dict(row, flags=";".join(row["flags"])))
+    os.replace(path + ".tmp", path)
+
+
+def load_actions(models_dir, photoset):
+    """{photo file name: action} for the photos of a photoset that are to be excluded or disabled ({} if it was not scanned)."""
+    path = table_path(models_dir, photoset)
+    if not os.path.exists(path):
+        return {}
+    with open(path, newline="") as f:
+        return {row["photo"]: row["action"] for row in csv.DictReader(f) if row["action"]}
+
+
+def up_to_date(path, photos):
+    return os.path.exists(path) and all(os.path.getmtime(photo) <= os.path.getmtime(path) for photo in photos)
+
+
+def scan(photosets, extensions, models_dir, workers=None, rescan=False, index=None):
+    """Scan the photos of the photosets in a pool of `workers` processes (default: the CPUs this process may use), writing each
+    photoset's table as soon as it is complete. Returns {photoset: rows} for the photosets scanned (those with an up to date table are
+    skipped unless rescan). Photos are found through the timepoint's image index (see imageindex.py)."""
+    index = index or imageindex.ImageIndex(models_dir)
+    todo = []
+    for photoset in photosets:
+        photos = index.paths(photoset, extensions)
+        if rescan or not up_to_date(table_path(models_dir, photoset), photos):
+            todo.append((photoset, photos))
+    index.save()
+    if not todo:
+        return {}
+
+    os.makedirs(models_dir, exist_ok=True)
+    workers = workers or len(os.sched_getaffinity(0))
+    results = {}
+    with multiprocessing.Pool(workers) as pool:
+        stream = pool.imap(scan_image, (photo for _, photos in todo for photo in photos), chunksize=4)
+        for photoset, photos in todo:
+            rows = judge([next(stream) for _ in photos])
+            flagged = sum(1 for row in rows if row["flags"] and not row["action"])
+            if flagged:
+                print("WARNING: {}: {} of {} photos flagged, too many to disable (check the thresholds)".format(
+                    os.path.basename(photoset), flagged, len(rows)))
+            write_table(table_path(models_dir, photoset), rows)
+            results[photoset] = rows
+    return results
+
+
+def summary(rows):
+    counts = {}
+    for row in rows:
+        for flag in row["flags"]:
+            counts[flag] = counts.get(flag, 0) + 1
+    excluded = sum(1 for row in rows if row["action"] == EXCLUDE)
+    disabled = sum(1 for row in rows if row["action"] == DISABLE)
+    text = "{} photos, {} excluded, {} disabled".format(len(rows), excluded, disabled)
+    if counts:
+        text += " ({})".format(", ".join("{} {}".format(n, flag) for flag, n in sorted(counts.items())))
+    return text
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python3 -m metashape_batch.preflight",
+                                     description="Check the photos of a timepoint for blur, bad exposure and truncated files.")
+    parser.add_argument("source_dir", help="timepoint directory that holds the photosets")
+    parser.add_argument("models_dir", help="models directory the tables are written to")
+    parser.add_argument("--profile", choices=sorted(profiles.PROFILES), default="fragram", help="profile whose photo types to scan")
+    parser.add_argument("--workers", type=int, help="scanning processes (default: all CPUs)")
+    parser.add_argument("--rescan", action="store_true", help="scan photosets again even if their table is up to date")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    from .generate import list_photosets
+    extensions = profiles.get_profile(args.profile)["photo_extensions"]
+    results = scan(list_photosets(args.source_dir), extensions, args.models_dir, args.workers, args.rescan)
+    for photoset, rows in sorted(results.items()):
+        print("{}: {}".format(os.path.basename(photoset), summary(rows)))
+    print("Scanned {} photosets".format(len(results)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,174 @@
+# PURPOSE: Named batch profiles (fragram / scoupr / rack). A profile holds everything that used to be hard coded at the top of a
+# buildscripts_*.sh file: which template to duplicate, where the photosets live, where the generated scripts and models go and how the
+# slurm submission script is named. Paths are format strings filled in with the project, timepoint and (for scoupr) scoupr directory.
+# Each profile also carries the processing settings used by the batch runner (metashape_batch.runner): which photos to load, the scale and
+# coordinate files, the order of the processing stages and the keyword arguments handed to each Metashape call. These mirror the
+# templates in scripts/. Metashape enums are given by name (ex. "MildFiltering") so profiles and manifests stay plain JSON.
+
+import copy
+import os
+
+
+# Root of this repository (used to locate the templates that ship with it).
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Default HPC locations. All you should need to do is change migomez to your username (or pass --source-root etc. on the command line).
+SOURCE_ROOT = "/scratch1/migomez/3Dmodels/source_images"
+MODELS_ROOT = "/scratch1/migomez/3Dmodels/models"
+TORUN_ROOT = "/scratch1/migomez/metashape-pro_2_2_1/ToRun"
+SCALES_ROOT = os.path.join(REPO_ROOT, "scales")
+
+
+## Keyword arguments for each Metashape call. See the templates for notes on each setting.
+
+MATCH_PHOTOS = dict(downscale=1, keypoint_limit_per_mpx=300, generic_preselection=True, reference_preselection=True, filter_mask=False,
+                    mask_tiepoints=True, filter_stationary_points=True, keypoint_limit=40000, tiepoint_limit=4000, keep_keypoints=False,
+                    guided_matching=False, reset_matches=False, subdivide_task=True, workitem_size_cameras=20, workitem_size_pairs=80,
+                    max_workgroup_size=100)
+
+ALIGN_CAMERAS = dict(adaptive_fitting=True, min_image=2, reset_alignment=False, subdivide_task=True)
+
+DETECT_MARKERS = dict(target_type="CircularTarget12bit", tolerance=50, filter_mask=False, inverted=False, noparity=False, maximum_residual=5,
+                      minimum_size=0, minimum_dist=5)
+
+IMPORT_REFERENCE = dict(format="ReferenceFormatCSV", delimiter=",", columns="nXYZxyz", skip_rows=2, ignore_labels=False, create_markers=False,
+                        threshold=0.1, shutter_lag=0)
+
+# Tie points above these thresholds are removed before optimizeCameras.
+FILTER_TIE_POINTS = {"ReconstructionUncertainty": 25, "ProjectionAccuracy": 15}
+
+OPTIMIZE_CAMERAS = dict(fit_f=True, fit_cx=True, fit_cy=True, fit_b1=True, fit_b2=True, fit_k1=True, fit_k2=True, fit_k3=True, fit_k4=True,
+                        fit_p1=True, fit_p2=True, fit_corrections=True, adaptive_fitting=False, tiepoint_covariance=False)
+
+BUILD_DEPTH_MAPS = dict(downscale=2, filter_mode="MildFiltering", reuse_depth=True, max_neighbors=16, subdivide_task=True,
+                        workitem_size_cameras=20, max_workgroup_size=100)
+
+BUILD_MODEL = dict(surface_type="Arbitrary", interpolation="EnabledInterpolation", face_count="HighFaceCount", face_count_custom=1000000,
+                   source_data="DepthMapsData", keep_depth=False)
+
+CLEAN_MODEL = dict(level=99)
+
+BUILD_UV = dict(mapping_mode="GenericMapping")
+
+BUILD_TEXTURE = dict(blending_mode="MosaicBlending", texture_size=8192, fill_holes=True)
+
+EXPORT_MODEL = dict(binary=True, precision=6, save_normals=True, save_colors=True, save_cameras=True, save_markers=True, save_udim=False,
+                    strip_extensions=False)
+
+EXPORT_REPORT = dict(font_size=12, page_numbers=True, include_system_info=True)
+
+# Shared by every profile unless overridden.
+PARAMS = {
+    "matchPhotos": MATCH_PHOTOS,
+    "alignCameras": ALIGN_CAMERAS,
+    "detectMarkers": DETECT_MARKERS,
+    "importReference": IMPORT_REFERENCE,
+    "filterTiePoints": FILTER_TIE_POINTS,
+    "optimizeCameras": OPTIMIZE_CAMERAS,
+    "buildDepthMaps": BUILD_DEPTH_MAPS,
+    "buildModel": BUILD_MODEL,
+    "cleanModel": CLEAN_MODEL,
+    "buildUV": BUILD_UV,
+    "buildTexture": BUILD_TEXTURE,
+    "exportModel": EXPORT_MODEL,
+    "exportReport": EXPORT_REPORT,
+}
+
+
+PROFILES = {
+    # In-air fragrameter models (Metashape 2.2.1). Photosets live in source_images/{project}/{timepoint}/{photoset}.
+    "fragram": {
+        "template": os.path.join(REPO_ROOT, "scripts", "2_2_1", "fragram_template.py"),
+        "slm_template": os.path.join(REPO_ROOT, "scripts", "2_2_1", "template_MetashapeJobSubmit.slm"),
+        "deactivate_slm": os.path.join(REPO_ROOT, "scripts", "deactivate_Metashape.slm"),
+        "project": "SinglePolyp",
+        "source_dir": "{source_root}/{project}/{timepoint}",
+        "models_dir": "{models_root}/{project}/{timepoint}",
+        "torun_dir": "{torun_root}/{project}/{timepoint}",
+        "todo_dir": "ToRun/{project}/{timepoint}",
+        "slm_name": "{project}_{timepoint}_MetashapeJobSubmit.slm",
+        "photo_extensions": [".bmp"],
+        "scalebars": os.path.join(SCALES_ROOT, "fragrameter", "FragramScale_050625.txt"),
+        "coords": os.path.join(SCALES_ROOT, "fragrameter", "FragramCoords_050625.txt"),
+        # Markers are detected before alignment because the cameras are fixed and the stage moves.
+        "stages": ["addPhotos", "detectMarkers", "matchPhotos", "alignCameras", "importReference", "scalebars", "region", "buildDepthMaps",
+                   "buildModel", "cleanModel", "buildUV", "buildTexture", "clearDepthMaps", "exportModel", "exportReport"],
+        # Region box in CRS coordinates; a preset ({"preset": "fragram-my-block"}) or a box fitted to the tie points ({"auto": True}) can be
+        # given instead (see metashape_batch/region.py).
+        "params": {"region": {"center": [0, 0, 0], "size": [0.1, 0.1, 0.11]}},
+    },
+    # In-water scoupr models (Metashape 2.2.1). Photosets live in source_images/{project}/{timepoint}/{scoupr}/{photoset}.
+    "scoupr": {
+        "template": os.path.join(REPO_ROOT, "scripts", "2_2_1", "scoupr_template.py"),
+        "slm_template": os.path.join(REPO_ROOT, "scripts", "2_2_1", "template_MetashapeJobSubmit.slm"),
+        "deactivate_slm": os.path.join(REPO_ROOT, "scripts", "deactivate_Metashape.slm"),
+        "project": "AcroFLaT",
+        "source_dir": "{source_root}/{project}/{timepoint}/{scoupr}",
+        "models_dir": "{models_root}/{project}/{timepoint}/{scoupr}",
+        "torun_dir": "{torun_root}/{project}/{timepoint}/{scoupr}",
+        "todo_dir": "ToRun/{project}/{timepoint}/{scoupr}",
+        "slm_name": "{project}_{timepoint}_{scoupr}_MetashapeJobSubmit.slm",
+        "photo_extensions": [".JPG"],
+        "scalebars": os.path.join(SCALES_ROOT, "scoupr", "scoupr_3_BARSTICKERS_060123.txt"),
+        "coords": None,
+        "stages": ["addPhotos", "matchPhotos", "alignCameras", "detectMarkers", "scalebars", "optimizeCameras", "buildDepthMaps", "buildModel",
+                   "cleanModel", "buildUV", "buildTexture", "clearDepthMaps", "exportModel", "exportReport"],
+        "params": {},
+    },
+    # Rack models (Metashape 1.8.3). Photosets live in source_images/{timepoint}/Rack/{photoset}.
+    "rack": {
+        "template": os.path.join(REPO_ROOT, "scripts", "1_8_3", "rackfull_template_coords.py"),
+        "slm_template": os.path.join(REPO_ROOT, "scripts", "1_8_3", "template_MetashapeJobSubmit.slm"),
+        "deactivate_slm": os.path.join(REPO_ROOT, "scripts", "1_8_3", "deactivate_Metashape.slm"),
+        "project": "",
+        "source_dir": "{source_root}/{timepoint}/Rack",
+        "models_dir": "{models_root}/{timepoint}/Rack",
+        "torun_dir": "{torun_root}/{timepoint}/Rack",
+        "todo_dir": "ToRun/{timepoint}/Rack",
+        "slm_name": "{timepoint}_Rack_MetashapeJobSubmit.slm",
+        "torun_root": "/project/ckenkel_26/software/metashape-pro/ToRun",
+        "photo_extensions": [".JPG"],
+        "scalebars": None,
+        "coords": os.path.join(SCALES_ROOT, "rack", "RackCoords_011723.txt"),
+        "stages": ["addPhotos", "matchPhotos", "alignCameras", "detectMarkers", "importReference", "optimizeCameras", "buildDepthMaps",
+                   "buildModel", "buildUV", "buildTexture", "clearDepthMaps", "exportModel", "exportReport"],
+        "params": {"matchPhotos": {"generic_preselection": False}},
+    },
+}
+
+
+def get_profile(name, **overrides):
+    """Return a copy of the named profile with any non-None overrides applied."""
+    if name not in PROFILES:
+        raise ValueError("Unknown profile {!r}. Choose from: {}".format(name, ", ".join(sorted(PROFILES))))
+    profile = copy.deepcopy(PROFILES[name])
+    profile["name"] = name
+    for key, value in overrides.items():
+        if value is not None:
+            profile[key] = value
+    return profile
+
+
+def stage_params(profile, stage):
+    """Keyword arguments for one stage: the shared defaults updated with the profile's (or manifest's) overrides."""
+    params = dict(PARAMS.get(stage, {}))
+    params.update(profile.get("params", {}).get(stage, {}))
+    return params
+
+
+def resolve_dirs(profile, timepoint, scoupr=None, source_root=None, models_root=None, torun_root=None):
+    """Fill in the profile's path patterns for one timepoint (and scoupr directory, if the profile has one).
+
+    Roots that are not given fall back to the profile's own root (if it has one) and then to the module defaults.
+    """
+    if "{scoupr}" in profile["source_dir"] and not scoupr:
+        raise ValueError("The {} profile needs a scoupr directory (ex. 1A)".format(profile["name"]))
+    fields = {
+        "project": profile["project"],
+        "timepoint": timepoint,
+        "scoupr": scoupr or "",
+        "source_root": (source_root or profile.get("source_root", SOURCE_ROOT)).rstrip("/"),
+        "models_root": (models_root or profile.get("models_root", MODELS_ROOT)).rstrip("/"),
+        "torun_root": (torun_root or profile.get("torun_root", TORUN_ROOT)).rstrip("/"),
+    }
+    return {key: profile[key].format(**fields) for key in ("source_dir", "models_dir", "torun_dir", "todo_dir", "slm_name")}
@@ -0,0 +1,197 @@
+# PURPOSE: Quality gates after alignment and after scaling, so a photoset whose cameras did not align is stopped (or rescued) right away
+# instead of running through depth maps, meshing, texturing and the report before anyone notices.
+# The gates measure the model after the stages where it can go wrong:
+#     alignCameras   aligned_ratio      share of the enabled cameras that aligned
+#                    tie_points         valid tie points
+#     detectMarkers  markers            markers detected
+#     scalebars      scalebars          scalebars made (their markers found)
+#     scale          projected_markers  markers projected on at least MIN_PROJECTIONS aligned cameras (so they can be located)
+#                    scalebar_error     largest |measured - reference| / reference of the scalebars (scalebar_rms, in m, is reported too)
+# The scale gate comes once the scale is set: after optimizeCameras if it follows the reference coordinates or scalebars, otherwise right
+# after the last of them. Each metric has two limits. Past the "fail" limit the model is doomed (ex. a quarter of its cameras aligned) and
+# is stopped: the build raises Rejected and the runner marks it failed in the status index. Past the "rescue" limit the build raises
+# rescue.Failure, and the runner retries it down the rescue ladder (see metashape_batch/rescue.py), or marks it failed if no rung is left
+# or rescue is off (--no-rescue). The metrics are printed, kept in the status index ("quality") and the runtime history, and listed with:
+#     python3 -m metashape_batch.quality /scratch1/migomez/3Dmodels/models/SinglePolyp/090425
+# Limits can be changed with a "quality" entry in the profile or the manifest's settings, ex. {"quality": {"aligned_ratio": {"rescue": 0.9,
+# "fail": 0.5}, "tie_points": {"fail": null}}}, or the gates switched off with {"quality": false}.
+
+import argparse
+import copy
+import os
+import sys
+
+import numpy as np
+
+from . import region as region_tools
+from . import rescue
+from . import status
+
+
+# Gate of each metric: whether it is a lower ("min") or upper ("max") bound, its rescue and fail limits (None: not gated) and the kind of
+# failure a rescue addresses.
+GATES = {
+    "aligned_ratio": {"bound": "min", "rescue": 0.8, "fail": 0.25, "kind": "alignment"},
+    "tie_points": {"bound": "min", "rescue": 1000, "fail": 100, "kind": "alignment"},
+    "markers": {"bound": "min", "rescue": 3, "fail": None, "kind": "markers"},
+    "scalebars": {"bound": "min", "rescue": 2, "fail": None, "kind": "markers"},
+    "projected_markers": {"bound": "min", "rescue": 3, "fail": None, "kind": "markers"},
+    "scalebar_error": {"bound": "max", "rescue": 0.02, "fail": None, "kind": "scale"},
+}
+
+# Aligned cameras a marker must be projected on to be located.
+MIN_PROJECTIONS = 2
+
+# Order the metrics are listed in.
+METRICS = ("aligned_ratio", "tie_points", "markers", "scalebars", "projected_markers", "scalebar_error", "scalebar_rms")
+
+
+class Rejected(Exception):
+    """A model past a fail limit: not worth building further."""
+
+
+def options(profile):
+    """The gates with the profile's "quality" limits applied, or None if the gates are switched off."""
+    given = profile.get("quality", {})
+    if given is False:
+        return None
+    gates = copy.deepcopy(GATES)
+    for metric, limits in (given or {}).items():
+        if metric not in gates:
+            raise ValueError("Unknown quality metric {!r}. Choose from: {}".format(metric, ", ".join(GATES)))
+        gates[metric].update(limits if isinstance(limits, dict) else {"rescue": limits})
+    return gates
+
+
+### Metrics
+
+def _tie_points(chunk):
+    tie_points = chunk.tie_points if hasattr(chunk, "tie_points") else chunk.point_cloud
+    return getattr(tie_points, "points", None) or []
+
+
+def aligned_ratio(chunk):
+    cameras = [camera for camera in chunk.cameras if camera.enabled]
+    return sum(1 for camera in cameras if camera.transform) / float(len(cameras)) if cameras else 0.
+
+
+def projections(marker):
+    """Aligned cameras the marker is projected on."""
+    cameras = getattr(marker, "projections", None)
+    if cameras is None:
+        return 0
+    return sum(1 for camera in cameras.keys() if camera.transform and camera.enabled)
+
+
+def scalebar_errors(chunk):
+    """{scalebar label: (measured - reference) in m} of the scalebars with a reference distance whose markers are both located."""
+    T = getattr(chunk.transform, "matrix", None)
+    if T is None:
+        return {}
+    T = region_tools.to_array(T)
+    errors = {}
+    for bar in chunk.scalebars:
+        reference = bar.reference.distance
+        ends = [getattr(marker, "position", None) for marker in (bar.point0, bar.point1)]
+        if not reference or None in ends:
+            continue
+        ends = np.array([list(end) for end in ends], dtype=float)
+        if np.allclose(ends[0], ends[1]):  # markers not triangulated
+            continue
+        a, b = region_tools.transform_points(T, ends)
+        errors[bar.label] = (float(np.linalg.norm(a - b)) - reference, reference)
+    return errors
+
+
+def scale_stage(stages):
+    """Stage after which the scale is set: optimizeCameras if it follows the reference coordinates or scalebars, otherwise the last of
+    them. None if the stages set no scale."""
+    scaling = [i for i, stage in enumerate(stages) if stage in ("importReference", "scalebars")]
+    if not scaling:
+        return None
+    after = stages[scaling[-1]:]
+    return "optimizeCameras" if "optimizeCameras" in after else stages[scaling[-1]]
+
+
+def measure(model, stage):
+    """Metrics of the gates after the stage ({} if there are none). Metrics that cannot be measured (ex. no scalebar is located) are
+    None."""
+    chunk = model.chunk
+    metrics = {}
+    if stage == "alignCameras":
+        metrics["aligned_ratio"] = round(aligned_ratio(chunk), 3)
+        metrics["tie_points"] = sum(1 for point in _tie_points(chunk) if getattr(point, "valid", True))
+    elif stage == "detectMarkers":
+        metrics["markers"] = len(chunk.markers)
+    elif stage == "scalebars":
+        result = getattr(model, "scalebar_result", None)
+        metrics["scalebars"] = len(result.created) + len(result.updated) if result is not None else None
+    if stage == scale_stage(model.profile["stages"]):
+        metrics["projected_markers"] = sum(1 for marker in chunk.markers if projections(marker) >= MIN_PROJECTIONS)
+        errors = scalebar_errors(chunk)
+        metrics["scalebar_error"] = round(max(abs(d) / ref for d, ref in errors.values()), 4) if errors else None
+        metrics["scalebar_rms"] = round(float(np.sqrt(np.mean([d * d for d, _ in errors.values()]))), 6) if errors else None
+    return metrics
+
+
+def _past(value, gate, limit):
+    if value is None or gate[limit] is None:
+        return False
+    return value < gate[limit] if gate["bound"] == "min" else value > gate[limit]
+
+
+def describe(metrics):
+    return ", ".join("{} {}".format(metric, metrics[metric]) for metric in METRICS if metric in metrics)
+
+
+def gate(model, stage, gates):
+    """Measure the model after the stage (into model.quality) and raise Rejected past a fail limit or rescue.Failure past a rescue limit."""
+    metrics = measure(model, stage)
+    if not metrics:
+        return
+    model.quality.update(metrics)
+    print("[{}] Quality after {}: {}".format(model.name, stage, describe(metrics)))
+    for limit in ("fail", "rescue"):
+        for metric in METRICS:
+            settings = gates.get(metric)
+            if settings is None or metric not in metrics or not _past(metrics[metric], settings, limit):
+                continue
+            message = "{} {} {} the {} limit {}".format(metric, metrics[metric], "below" if settings["bound"] == "min" else "above", limit,
+                                                         settings[limit])
+            if limit == "fail":
+                raise Rejected("Quality gate after {}: {}".format(stage, message))
+            raise rescue.Failure(settings["kind"], stage, message)
+
+
+def checker(gates):
+    """gate() as a check for pipeline.run."""
+    return lambda model, stage: gate(model, stage, gates)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python3 -m metashape_batch.quality", description="List the quality metrics of a timepoint's models.")
+    parser.add_argument("models_dir", help="models directory (with the batch status index)")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    records = status.StatusIndex(args.models_dir).load()
+    if not records:
+        print("No models in {}".format(os.path.join(args.models_dir, status.INDEX_NAME)))
+        return 1
+    for photoset in sorted(records):
+        record = records[photoset]
+        line = "{}: {}".format(os.path.basename(photoset.rstrip("/")), record.get("status"))
+        if record.get("rescue"):
+            line += " (rescued: {})".format(", ".join(record["rescue"]))
+        if record.get("quality"):
+            line += ", " + describe(record["quality"])
+        if record.get("status") == status.FAILED and record.get("error"):
+            line += " - " + record["error"]
+        print(line)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
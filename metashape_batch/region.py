@@ -0,0 +1,223 @@
+# PURPOSE: The bounding box (region) of a model, computed with numpy from the chunk's matrices instead of element by element in section 7
+# of every template, with the boxes of the rigs kept as named presets and a way to size boxes from the tie points rather than constants.
+# The region is set as in the templates: rotated in line with the coordinate system (the rotation of localframe * chunk.transform, with
+# its scale divided out) and given a center and size in CRS coordinates (metres), which are moved into the chunk's internal coordinates.
+# The box comes from the profile's "region" parameters:
+#     {"preset": "fragram-my-block"}               one of PRESETS
+#     {"center": [0, 0, 0.02], "size": [...]}      a box of its own (overrides the preset's values)
+#     {"auto": true, "percentiles": [1, 99]}       fitted to the tie points: the given percentiles of their CRS coordinates on each axis,
+#                                                  widened by "margin" (a share of the size) on every side; the preset or given box is
+#                                                  used when there are too few tie points to fit
+# A fitted box is tight around the coral, so depth maps and meshing only work on its volume. Stray tie points (on the stage, the
+# background or matched wrongly) are dropped first: points further than "trim" robust standard deviations (1.4826 x the median absolute
+# deviation) from the median on any axis are left out before the percentiles are taken. With a preset or center and size as well, the
+# fitted box is kept within that box, so it never grows past the rig's generous one:
+#     {"preset": "fragram-my-block", "auto": true, "margin": 0.05}
+# Oversized boxes inflate depth map and meshing time, so the region stage also saves each model's tie points (CRS coordinates, float32) to
+# <name>_tiepoints.npz in the output directory. The CLI then checks a box against every model of one or more models directories at once
+# (the share of each model's tie points inside it, and how much larger the box is than the model's fitted box) and suggests the smallest
+# box that holds the fitted boxes of them all:
+#     python3 -m metashape_batch.region /scratch1/migomez/3Dmodels/models/SinglePolyp/090425 --preset fragram-my-block
+
+import argparse
+import glob
+import os
+import sys
+
+import numpy as np
+
+
+TIEPOINTS_SUFFIX = "_tiepoints.npz"
+
+# Boxes of the rigs, in CRS coordinates (m). The scoupr has no reference coordinates for a fixed box to refer to, so its box is fitted.
+PRESETS = {
+    "fragram-my-block": {"center": [0, 0, 0.02], "size": [0.13, 0.13, 0.15]},
+    "fragram-CRL": {"center": [0, 0, 0.078], "size": [0.1, 0.1, 0.11]},
+    "rack": {"center": [0, 0, 0], "size": [0.7, 0.7, 0.4]},
+    "scoupr": {"auto": True},
+}
+
+# Tie point percentiles a fitted box spans on each axis, the margin added on every side (share of the spanned size), the distance from
+# the median (in robust standard deviations) past which tie points are dropped as outliers (0 keeps them all) and the fewest tie points
+# a box is fitted to.
+PERCENTILES = (1, 99)
+MARGIN = 0.1
+TRIM = 3.5
+MIN_POINTS = 100
+
+# Median absolute deviation -> standard deviation, for normally distributed points.
+MAD_SCALE = 1.4826
+
+
+def to_array(matrix, n=4):
+    """A Metashape.Matrix (or nested lists) as an n x n numpy array."""
+    return np.array([[matrix[i, j] for j in range(n)] for i in range(n)], dtype=float)
+
+
+def transform_points(T, points):
+    """Apply a 4 x 4 transform to an (n x 3) array of points."""
+    return points @ T[:3, :3].T + T[:3, 3]
+
+
+def rotation(T, frame):
+    """The region rotation in line with the coordinate system: the transposed rotation of frame @ T (frame is the CRS localframe at the
+    chunk's origin), with the scale divided out."""
+    m = frame @ T
+    return (m[:3, :3] / np.linalg.norm(m[0, :3])).T
+
+
+def internal_box(T, frame, center, size):
+    """(center, size) of a box given in CRS coordinates, in the chunk's internal coordinates. center is the unprojected CRS center
+    (geocentric for a geographic CRS, as is for a local one); frame is the CRS localframe there."""
+    inside = transform_points(np.linalg.inv(T), np.asarray(center, dtype=float)[None])[0]
+    m = frame @ T
+    return inside, np.asarray(size, dtype=float) / np.linalg.norm(m[0, :3])
+
+
+def box(params):
+    """The box of a stage's region parameters: a dict with "center" and "size" (if fixed) and "auto" (if fitted)."""
+    preset = params.get("preset")
+    if preset is not None and preset not in PRESETS:
+        raise ValueError("Unknown region preset {!r}. Choose from: {}".format(preset, ", ".join(sorted(PRESETS))))
+    resolved = dict(PRESETS.get(preset, {}))
+    resolved.update((key, value) for key, value in params.items() if key != "preset")
+    return resolved
+
+
+def trim(points, k=TRIM):
+    """The points within k robust standard deviations of the median on every axis (all of them if k is 0)."""
+    if not k or not len(points):
+        return points
+    median = np.median(points, axis=0)
+    deviation = np.abs(points - median)
+    spread = MAD_SCALE * np.median(deviation, axis=0)
+    keep = (deviation <= k * np.where(spread > 0, spread, np.inf)).all(axis=1)
+    return points[keep]
+
+
+def fit(points, percentiles=PERCENTILES, margin=MARGIN, k=TRIM):
+    """(center, size) of the box spanning the given percentiles of the points on each axis (after dropping outliers, see trim),
+    widened by margin on every side."""
+    points = trim(points, k)
+    low, high = np.percentile(points, percentiles, axis=0)
+    size = (high - low) * (1 + 2 * margin)
+    return (low + high) / 2, size
+
+
+def clip(center, size, limit_center, limit_size):
+    """(center, size) of a box cut down to fit within another."""
+    low = np.maximum(np.asarray(center) - np.asarray(size) / 2, np.asarray(limit_center) - np.asarray(limit_size) / 2)
+    high = np.minimum(np.asarray(center) + np.asarray(size) / 2, np.asarray(limit_center) + np.asarray(limit_size) / 2)
+    high = np.maximum(high, low)
+    return (low + high) / 2, high - low
+
+
+def choose(params, points):
+    """(center, size, fitted) of the box for a model: fitted to its tie points (CRS coordinates) if the parameters ask for it and there
+    are enough of them, kept within the fixed box if there is one; otherwise the fixed box. Raises ValueError if there is neither."""
+    params = box(params)
+    fixed = (params["center"], params["size"]) if "center" in params and "size" in params else None
+    if params.get("auto") and len(points) >= params.get("min_points", MIN_POINTS):
+        center, size = fit(points, params.get("percentiles", PERCENTILES), params.get("margin", MARGIN), params.get("trim", TRIM))
+        if fixed:
+            center, size = clip(center, size, *fixed)
+        return [float(x) for x in center], [float(x) for x in size], True
+    if fixed is None:
+        raise ValueError("No region box: too few tie points ({}) to fit one to and no center and size given".format(len(points)))
+    return list(fixed[0]), list(fixed[1]), False
+
+
+def inside(points, center, size):
+    """Which points lie in the box."""
+    return (np.abs(points - np.asarray(center)) <= np.asarray(size) / 2).all(axis=1)
+
+
+def save_cloud(path, points):
+    tmp = path + ".tmp.npz"
+    np.savez(tmp, points=np.asarray(points, dtype=np.float32))
+    os.replace(tmp, path)
+
+
+def load_clouds(models_dirs):
+    """{model name: (n x 3) tie points in CRS coordinates} of every model with a saved cloud in the models directories."""
+    clouds = {}
+    for models_dir in models_dirs:
+        for path in sorted(glob.glob(os.path.join(models_dir, "*" + TIEPOINTS_SUFFIX))):
+            with np.load(path) as data:
+                if len(data["points"]):
+                    clouds[os.path.basename(path)[:-len(TIEPOINTS_SUFFIX)]] = data["points"].astype(float)
+    return clouds
+
+
+def evaluate(clouds, center, size, percentiles=PERCENTILES, margin=MARGIN, k=TRIM):
+    """How a box fits many models at once. clouds is a list of (n x 3) point arrays. Returns (share of each model's points inside the
+    box, box volume / the model's fitted box volume, fitted centers, fitted sizes)."""
+    counts = np.array([len(points) for points in clouds])
+    owner = np.repeat(np.arange(len(clouds)), counts)
+    hits = np.bincount(owner, inside(np.concatenate(clouds), center, size), len(clouds)) if len(clouds) else np.zeros(0)
+    fitted = [fit(points, percentiles, margin, k) for points in clouds]
+    centers = np.array([c for c, _ in fitted]).reshape(-1, 3)
+    sizes = np.array([s for _, s in fitted]).reshape(-1, 3)
+    with np.errstate(divide="ignore"):
+        oversize = np.prod(size) / np.prod(sizes, axis=1)
+    return hits / np.maximum(counts, 1), oversize, centers, sizes
+
+
+def suggest(centers, sizes):
+    """(center, size) of the smallest box that holds every fitted box."""
+    low = (centers - sizes / 2).min(axis=0)
+    high = (centers + sizes / 2).max(axis=0)
+    return (low + high) / 2, high - low
+
+
+def _triple(values):
+    return "({})".format(", ".join("{:.3f}".format(x) for x in values))
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python3 -m metashape_batch.region",
+                                     description="Check a region box against the tie points of built models and suggest one that fits them.")
+    parser.add_argument("models_dirs", nargs="+", help="models directories (with <name>_tiepoints.npz from the region stage)")
+    parser.add_argument("--preset", choices=sorted(PRESETS), help="box to check")
+    parser.add_argument("--center", type=float, nargs=3, metavar=("X", "Y", "Z"), help="box center (CRS coordinates, m)")
+    parser.add_argument("--size", type=float, nargs=3, metavar=("X", "Y", "Z"), help="box size (m)")
+    parser.add_argument("--percentiles", type=float, nargs=2, default=PERCENTILES, metavar=("LOW", "HIGH"),
+                        help="tie point percentiles a fitted box spans (default: {} {})".format(*PERCENTILES))
+    parser.add_argument("--margin", type=float, default=MARGIN, help="margin added to fitted boxes (default: {})".format(MARGIN))
+    parser.add_argument("--trim", type=float, default=TRIM,
+                        help="drop tie points further than this many robust standard deviations from the median, 0 to keep all (default: {})".format(
+                            TRIM))
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    params = {"preset": args.preset} if args.preset else {}
+    params.update((key, value) for key, value in (("center", args.center), ("size", args.size)) if value)
+    chosen = box(params)
+    clouds = load_clouds(args.models_dirs)
+    if not clouds:
+        print("No tie points saved in {}".format(", ".join(args.models_dirs)))
+        return 1
+    names = list(clouds)
+    fixed = "center" in chosen and "size" in chosen
+    shares, oversize, centers, sizes = evaluate([clouds[name] for name in names], chosen.get("center", [0, 0, 0]),
+                                                chosen.get("size", [np.inf] * 3), args.percentiles, args.margin, args.trim)
+    for i, name in enumerate(names):
+        line = "{}: fitted center {} size {}".format(name, _triple(centers[i]), _triple(sizes[i]))
+        if fixed:
+            line += ", {:.1%} of tie points in the box, box {:.1f}x the fitted volume".format(shares[i], oversize[i])
+        print(line)
+    if fixed:
+        # A model is cut when the box holds fewer of its tie points than its fitted box spans.
+        cut = int((shares < (args.percentiles[1] - args.percentiles[0]) / 100.).sum())
+        print("Box center {} size {}: {} of {} models cut, median {:.1f}x the fitted volume".format(
+            _triple(chosen["center"]), _triple(chosen["size"]), cut, len(names), float(np.median(oversize))))
+    center, size = suggest(centers, sizes)
+    print("Smallest box holding every fitted box: center {} size {}".format(_triple(center), _triple(size)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,115 @@
+# PURPOSE: Retry a model down a ladder of rescue settings inside the same job when it fails, instead of waiting for the batch to finish,
+# spotting the failure in the report and resubmitting it by hand with adjustables_template_rescue.py / _rescue2.py.
+# The quality gates (see metashape_batch/quality.py) check the model after alignment, marker detection, the scalebars and the scaling, and
+# raise Failure when a metric is past its rescue limit. Failures are of three kinds: "alignment" (too few cameras aligned or tie points),
+# "markers" (too few markers detected, located or making scalebars) and "scale" (a scalebar's measured length is off its reference).
+# The runner then takes the next rung of the ladder that addresses that kind of failure, applies it on top of the settings the model was
+# built with and reruns the model from the first stage whose settings the rung actually changes, reopening the saved project so the
+# stages before it (adding photos, detecting markers, ...) are kept. A rung must change the failed stage or one before it (rescue2 after
+# rescue only changes the depth maps, so it cannot help a failed alignment and is passed over), unless it swaps stages out: noscale routes
+# around missing markers, so the model goes on from the stage after the failed one. Rungs mirror the 1.8.3 rescue templates:
+#     rescue    match without reference preselection or stationary point filtering, realign from scratch, skip the tie point filtering,
+#               optimize without b1, b2 and k4 (with tie point covariance, for the scalebar errors) and rebuild depth maps without reuse
+#     rescue2   as rescue, with depth maps at downscale 4
+#     noscale   drop the scalebars (the model is left unscaled, or scaled by its reference coordinates only)
+# The rungs a model needed are kept in the status index ("rescue") and the runtime history, and a resumed model gets them back. The
+# ladder can be changed with a "rescue" entry in the profile or the manifest's settings (ex. {"rescue": {"ladder": ["rescue", "noscale"]}}),
+# or switched off with {"rescue": false} or the runner's --no-rescue (failures then fail the model).
+
+import copy
+
+from . import profiles
+
+
+RESCUE_PARAMS = {
+    "matchPhotos": {"reference_preselection": False, "filter_stationary_points": False, "reset_matches": True},
+    "alignCameras": {"reset_alignment": True},
+    "filterTiePoints": {"ReconstructionUncertainty": None, "ProjectionAccuracy": None},
+    "optimizeCameras": {"fit_b1": False, "fit_b2": False, "fit_k4": False, "tiepoint_covariance": True},
+    "buildDepthMaps": {"reuse_depth": False},
+}
+
+# Rungs in the order they are tried. "fixes" are the kinds of failure a rung can help with, "params" per-stage overrides and "replace"
+# stages swapped for others (None drops the stage).
+LADDER = [
+    {"name": "rescue", "fixes": ("alignment", "scale"), "params": RESCUE_PARAMS},
+    {"name": "rescue2", "fixes": ("alignment", "scale"),
+     "params": dict(RESCUE_PARAMS, buildDepthMaps=dict(RESCUE_PARAMS["buildDepthMaps"], downscale=4))},
+    {"name": "noscale", "fixes": ("markers", "scale"), "replace": {"scalebars": "clearScalebars"}},
+]
+
+RUNGS = {rung["name"]: rung for rung in LADDER}
+
+# Stages whose parameters are not named after them.
+PARAM_STAGES = {"filterTiePoints": "optimizeCameras"}
+
+
+class Failure(Exception):
+    """A model past a rescue limit of the quality gates: kind is "alignment", "markers" or "scale"."""
+
+    def __init__(self, kind, stage, message):
+        Exception.__init__(self, "{} check after {} failed: {}".format(kind, stage, message))
+        self.kind = kind
+        self.stage = stage
+
+
+def options(profile):
+    """The profile's rescue options with the defaults filled in, or None if rescue is switched off."""
+    given = profile.get("rescue", {})
+    if given is False:
+        return None
+    resolved = {"ladder": [rung["name"] for rung in LADDER]}
+    resolved.update(given or {})
+    unknown = [name for name in resolved["ladder"] if name not in RUNGS]
+    if unknown:
+        raise ValueError("Unknown rescue rung(s) {}. Choose from: {}".format(", ".join(unknown), ", ".join(RUNGS)))
+    return resolved
+
+
+def next_rung(options, failure, tried, profile):
+    """The first rung of the ladder (of the rescue options) that addresses the failure, has not been tried and can change its outcome
+    for a model built with the profile. Returns (rung, rescued profile, stage to restart at), or None."""
+    for name in options["ladder"]:
+        if name in tried or failure.kind not in RUNGS[name]["fixes"]:
+            continue
+        rescued = apply(profile, RUNGS[name])
+        restart = restart_stage(profile, rescued, RUNGS[name], failure.stage)
+        if restart is not None:
+            return RUNGS[name], rescued, restart
+    return None
+
+
+def apply(profile, rung):
+    """A copy of the profile with the rung's settings on top."""
+    profile = copy.deepcopy(profile)
+    for stage, overrides in rung.get("params", {}).items():
+        profile["params"].setdefault(stage, {}).update(overrides)
+    replace = rung.get("replace", {})
+    profile["stages"] = [replace.get(stage, stage) for stage in profile["stages"] if replace.get(stage, stage) is not None]
+    return profile
+
+
+def fixed_downscale(names):
+    """Whether any of the named rungs sets the depth map downscale (which then takes over from the depth map policy)."""
+    return any("downscale" in RUNGS[name].get("params", {}).get("buildDepthMaps", {}) for name in names)
+
+
+def _stage_params(profile, stage):
+    """Everything that sets how a stage runs: its parameters and those named after something else (ex. the tie point filters)."""
+    return [profiles.stage_params(profile, name) for name in [stage] + [name for name, of in PARAM_STAGES.items() if of == stage]]
+
+
+def restart_stage(profile, rescued, rung, failed_stage):
+    """Stage of the rescued profile to rerun from, or None if the rung cannot change the failed stage's outcome: the first stage that is
+    new or whose settings differ from the profile's, if it is not after the failed stage; for a rung that swaps stages, the stage after
+    the failed one if that comes first."""
+    before, after = profile["stages"], rescued["stages"]
+    changed = [i for i, stage in enumerate(after) if stage not in before or _stage_params(profile, stage) != _stage_params(rescued, stage)]
+    failed = after.index(failed_stage) if failed_stage in after else before.index(failed_stage)
+    if changed and changed[0] <= failed:
+        i = changed[0]
+    elif changed and rung.get("replace"):
+        i = failed + 1
+    else:
+        return None
+    return after[i] if i < len(after) else None
@@ -0,0 +1,328 @@
+# PURPOSE: Build every photoset listed in a manifest inside ONE Metashape process, instead of starting Metashape once per generated script.
+# The Metashape module and the scale files are loaded once and the photosets are processed one after another, so the per-model
+# interpreter/licence/Qt start up cost is paid only once per batch. A failed model is reported and skipped; the rest of the batch continues.
+# Rerunning a manifest (ex. after a job hit its --time limit) resumes each model from its saved .psz; pass --restart to start over.
+# Progress is recorded in the batch status index (batch_status.json in the output directory, see metashape_batch/status.py), and each model's
+# inputs and stage timings are appended to runtime_history.jsonl for the runtime predictor (see metashape_batch/predict.py).
+# With --claim BATCH the runner takes photosets from the index one at a time instead of walking the list, so several runners on one node can
+# share a manifest (see metashape_batch/scheduler.py). With --task N only the Nth task of the manifest (counting from 0; one photoset unless
+# the manifest groups them) is built, as one task of a slurm job array (see metashape_batch/slurm.py).
+# With --stage each model is built on node-local disk ($TMPDIR): the photoset is copied there (the next one is prefetched in the background)
+# and the outputs are copied back to the output directory (see metashape_batch/staging.py).
+# With --upload DEST (or "upload" in the manifest) each finished model's .obj, .mtl, textures and report are copied to DEST in the
+# background as soon as the model is done (see metashape_batch/upload.py).
+# Photos flagged by the pre-flight scan (<photoset>_preflight.csv in the output directory, see metashape_batch/preflight.py) are left out or
+# added as disabled cameras; pass --no-preflight to add every photo.
+# With --lod FACES (or "lod" in the manifest) a decimated copy of each finished model, of about that many faces, is written to lod/<name>.obj
+# in the output directory (see metashape_batch/decimate.py) and uploaded along with the model.
+# With a "depth_policy" in the settings, each model's depth map downscale and max_neighbors are chosen to fit a time budget (see
+# metashape_batch/policy.py); the decision is kept in the status index and the runtime history.
+# Quality gates after alignment and after scaling (see metashape_batch/quality.py) stop doomed models early and mark them failed; a model
+# past a rescue limit is retried within the job down the rescue ladder (see metashape_batch/rescue.py), from the first stage the rescue
+# settings change. Pass --no-rescue to fail it straight away. The metrics are kept in the status index and the runtime history.
+#
+# Run through metashape.sh (see scripts/run_batch.py):
+#     bash metashape.sh -r /path/to/metashape_batch_process/scripts/run_batch.py ToRun/SinglePolyp/090425/manifest.json -platform offscreen
+#
+# A manifest is a JSON file written by `python3 -m metashape_batch.generate ... --mode runner`:
+#     {"profile": "fragram", "project": "SinglePolyp", "timepoint": "090425", "scoupr": null,
+#      "output": "/scratch1/migomez/3Dmodels/models/SinglePolyp/090425",
+#      "photosets": ["/scratch1/migomez/3Dmodels/source_images/SinglePolyp/090425/090425_3-E-B", ...],
+#      "settings": {"params": {"buildDepthMaps": {"downscale": 4}}}, "upload": "/project2/ckenkel_26/migomez/models", "lod": 200000}
+# "settings" is optional and overrides any profile key (per-stage "params" are merged stage by stage). An optional "tasks" list groups the
+# photosets into array tasks (written when the generator packs photosets by predicted cost); --task N then builds the Nth group. Optional
+# "digests" (photoset -> digest of its photos, see metashape_batch/fingerprint.py) are stored in the status index as models finish.
+
+import argparse
+import json
+import os
+import socket
+import sys
+import time
+import traceback
+
+from . import imageindex
+from . import policy
+from . import predict
+from . import preflight
+from . import profiles
+from . import quality
+from . import rescue
+from . import staging
+from . import status
+from . import upload
+
+
+def write_manifest(path, profile_name, photosets, output, project=None, timepoint=None, scoupr=None, settings=None, tasks=None,
+                   upload_dest=None, digests=None, lod=None):
+    manifest = {
+        "profile": profile_name,
+        "project": project,
+        "timepoint": timepoint,
+        "scoupr": scoupr,
+        "output": output,
+        "photosets": list(photosets),
+        "settings": settings or {},
+    }
+    if tasks:
+        manifest["tasks"] = [list(task) for task in tasks]
+    if upload_dest:
+        manifest["upload"] = upload_dest
+    if lod:
+        manifest["lod"] = lod
+    if digests:
+        manifest["digests"] = {photoset: digests[photoset] for photoset in photosets if photoset in digests}
+    with open(path, "w") as f:
+        json.dump(manifest, f, indent=1)
+    return manifest
+
+
+def load_manifest(path):
+    with open(path) as f:
+        manifest = json.load(f)
+    for key in ("profile", "output", "photosets"):
+        if key not in manifest:
+            raise ValueError("{} is missing {!r}".format(path, key))
+    return manifest
+
+
+def build_profile(manifest):
+    """The manifest's profile with its settings applied."""
+    profile = profiles.get_profile(manifest["profile"])
+    settings = dict(manifest.get("settings") or {})
+    params = settings.pop("params", {})
+    profile.update(settings)
+    for stage, overrides in params.items():
+        profile["params"].setdefault(stage, {}).update(overrides)
+    return profile
+
+
+def select_photosets(manifest, only=None, task=None):
+    """Photosets to build: all of them, those of task number `task`, or just those whose directory name is in `only`."""
+    photosets = manifest["photosets"]
+    if task is not None:
+        tasks = manifest.get("tasks") or [[photoset] for photoset in photosets]
+        if not 0 <= task < len(tasks):
+            raise ValueError("Task {} is out of range; the manifest has {} tasks".format(task, len(tasks)))
+        photosets = tasks[task]
+    if only:
+        photosets = [p for p in photosets if os.path.basename(p.rstrip("/")) in only]
+    return photosets
+
+
+def run_manifest(manifest, only=None, resume=True, claim=None, task=None, stager=None, uploader=None, use_preflight=True, lod=None,
+                 use_rescue=True):
+    """Build each photoset in the manifest (or, with claim set to a batch id, each one this runner claims from the status index).
+    With a staging.Stager, models are built on its local copies and their outputs copied back. With an upload.Uploader, each finished
+    model's products are queued for upload. Unless use_preflight is off, photos the pre-flight scan flagged (the photoset's
+    _preflight.csv in the output directory) are excluded or disabled. With lod (a face count), a decimated copy of each finished model
+    is written to lod/ in the output directory. Models are checked by the quality gates; unless use_rescue is off, a model past a
+    rescue limit is retried down the rescue ladder. Returns the names of the models that failed."""
+    from . import pipeline  # imports Metashape
+
+    profile = build_profile(manifest)
+    output = manifest["output"]
+    os.makedirs(output, exist_ok=True)
+
+    # Read the scale file once for the whole batch.
+    scalebars = None
+    if "scalebars" in profile["stages"]:
+        scalebars = pipeline.read_scalebars(profile["scalebars"])
+
+    index = status.StatusIndex(output)
+    hashes = {"template_hash": status.settings_hash(profile), "scale_hash": status.scale_hash(profile)}
+
+    photosets = select_photosets(manifest, only, task)
+    digests = manifest.get("digests") or {}
+    photo_index = imageindex.ImageIndex(output)
+    depth_policy = policy.Policy.from_profile(profile, predict.load_history(output))
+    gates = quality.options(profile)
+    check = quality.checker(gates) if gates else None
+    ladder = rescue.options(profile) if use_rescue else None
+    if claim:
+        worker = "{}:{}".format(socket.gethostname(), os.getpid())
+        queue = iter(lambda: index.claim(photosets, claim, worker), None)
+    else:
+        queue = iter(photosets)
+    failed = []
+    built = 0
+    upload_dir = upload.destination_dir("", manifest.get("project"), manifest.get("timepoint"), manifest.get("scoupr"))
+
+    def queue_upload(photoset, name):
+        def on_done(result):
+            if result.ok:
+                index.update(photoset, uploaded=time.strftime("%Y-%m-%d %H:%M:%S"), upload_error=None)
+            else:
+                index.update(photoset, upload_error="; ".join(error for _, error in result.failed))
+        uploader.submit(name, upload.model_files(output, name), upload_dir, on_done)
+
+    def write_lod(photoset, name):
+        from . import decimate  # needs numpy
+        try:
+            path, _, faces = decimate.decimate_file(os.path.join(output, name + ".obj"), lod)
+        except Exception as e:  # the full model is built; a failed LOD must not fail it
+            print("[{}] LOD failed: {!r}".format(name, e))
+            index.update(photoset, lod_error=repr(e))
+            return
+        print("[{}] LOD of {} faces: {}".format(name, faces, path))
+        index.update(photoset, lod_faces=faces, lod_error=None)
+        if uploader is not None:
+            uploader.submit(name + " LOD", [path], os.path.join(upload_dir, decimate.LOD_DIR))
+
+    def finish(photoset, name):
+        """Post-build work on a model's products once they are in the output directory."""
+        if lod:
+            write_lod(photoset, name)
+        if uploader is not None:
+            queue_upload(photoset, name)
+
+    after_stage = None
+    if stager is not None:
+        def after_stage(model, stage):
+            if stage in staging.CHECKPOINT_STAGES:
+                stager.checkpoint(model.psz, output)
+
+    for photoset in queue:
+        built += 1
+        position = photosets.index(photoset)
+        print("=== ({}/{}) {} ===".format(position + 1, len(photosets), os.path.basename(photoset.rstrip("/"))))
+        # A model built with other settings, scale files or photos is stale; it is rebuilt from scratch rather than resumed.
+        record = index.get(photoset) or {}
+        fresh = all(record.get(key, value) == value for key, value in hashes.items())
+        if photoset in digests and record.get("photoset_digest") not in (None, digests[photoset]):
+            fresh = False
+        # A resumed model keeps the rescue settings it was being built with.
+        rungs = [name for name in record.get("rescue") or [] if name in rescue.RUNGS] if resume and fresh else []
+        attempt = profile
+        for name in rungs:
+            attempt = rescue.apply(attempt, rescue.RUNGS[name])
+        index.update(photoset, status=status.RUNNING, rescue=list(rungs) or None, **hashes)
+        actions = preflight.load_actions(output, photoset) if use_preflight else None
+        model_policy = None if rescue.fixed_downscale(rungs) else depth_policy
+        if stager is None:
+            model = pipeline.Model(photoset, output, attempt, scalebars, actions, model_policy)
+        else:
+            local = stager.fetch(photoset)
+            if not claim and position + 1 < len(photosets):
+                stager.prefetch(photosets[position + 1])
+            model = pipeline.Model(local, stager.work_dir(os.path.basename(local), output, resume and fresh), attempt, scalebars, actions,
+                                   model_policy, source=photoset)
+        images, size = predict.photoset_inputs(photoset, profile["photo_extensions"], photo_index)
+        history = {"photoset": photoset, "profile": profile["name"], "images": images, "bytes": size,
+                   "downscale": predict.downscale(attempt), "started": time.strftime("%Y-%m-%d %H:%M:%S")}
+        start = time.time()
+        try:
+            restart = None
+            while True:
+                try:
+                    timings = pipeline.run(model, attempt["stages"], resume and fresh, after_stage, restart, check)
+                    break
+                except rescue.Failure as failure:
+                    step = rescue.next_rung(ladder, failure, rungs, attempt) if ladder else None
+                    if step is None:
+                        raise
+                    rung, rescued, restart = step
+                    print("[{}] {}. Retrying with {} from {}".format(model.name, failure, rung["name"], restart))
+                    rungs.append(rung["name"])
+                    index.update(photoset, rescue=list(rungs))
+                    attempt = rescued
+                    measured = model.quality
+                    model = pipeline.Model(model.photoset, model.output_dir, attempt, scalebars, actions,
+                                           None if rescue.fixed_downscale(rungs) else depth_policy, model.source)
+                    model.quality.update(measured)  # metrics of the stages before the restart
+        except Exception as e:
+            if isinstance(e, (quality.Rejected, rescue.Failure)):
+                print("[{}] {}".format(model.name, e))
+            else:
+                traceback.print_exc()
+            failed.append(model.name)
+            index.update(photoset, status=status.FAILED, elapsed=round(time.time() - start), error=repr(e))
+            history.update(status=status.FAILED, elapsed=round(time.time() - start), complete=False)
+            print("=== {} FAILED after {:.0f} s ===".format(model.name, time.time() - start))
+        else:
+            index.update(photoset, status=status.DONE, elapsed=round(time.time() - start), error=None,
+                         photoset_digest=digests.get(photoset))
+            # Only a build that ran every stage (not a resumed or rescued one) tells the predictor how long a whole model takes.
+            history.update(model.stats, status=status.DONE, elapsed=round(time.time() - start), stages=dict(timings),
+                           complete=len(timings) == len(attempt["stages"]))
+            print("=== {} done in {:.0f} s ===".format(model.name, time.time() - start))
+        if rungs:
+            history.update(rescue=rungs, downscale=predict.downscale(attempt))
+        if model.quality:
+            index.update(photoset, quality=model.quality)
+            history.update(quality=model.quality)
+        if model.depth_decision is not None:
+            decision = model.depth_decision
+            index.update(photoset, depth=decision)
+            history.update(downscale=decision["downscale"], max_neighbors=decision["max_neighbors"], depth_units=decision["units"])
+        send = None
+        if (uploader is not None or lod) and model.name not in failed:
+            send = lambda photoset=photoset, name=model.name: finish(photoset, name)
+        if stager is not None:
+            stager.push(model.output_dir, output, then=send)  # failed models too, so they can be resumed
+            stager.release(photoset)
+        elif send is not None:
+            send()
+        predict.append_history(output, history)
+
+    photo_index.save()
+    print("Built {} of {} models.".format(built - len(failed), built))
+    if failed:
+        print("Failed: " + ", ".join(failed))
+    return failed
+
+
+def strip_qt_args(argv):
+    """Drop the Qt options (ex. -platform offscreen) that metashape.sh passes through to the script."""
+    out = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg == "-platform":
+            skip = True
+        else:
+            out.append(arg)
+    return out
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="metashape.sh -r scripts/run_batch.py", description="Build every photoset in a manifest.")
+    parser.add_argument("manifest", help="manifest.json written by metashape_batch.generate --mode runner")
+    parser.add_argument("--only", nargs="+", metavar="PHOTOSET", help="only build these photosets (directory names)")
+    parser.add_argument("--restart", action="store_true", help="ignore existing .psz projects and build every model from scratch")
+    parser.add_argument("--claim", metavar="BATCH", help="take photosets from the status index (shared with other runners of this batch id)")
+    parser.add_argument("--stage", action="store_true", help="build on node-local disk ($TMPDIR) and copy the outputs back")
+    parser.add_argument("--stage-dir", help="node-local directory to stage in (implies --stage; default: $TMPDIR)")
+    parser.add_argument("--stage-cache", default=staging.CACHE_SIZE, help="most photoset data to keep staged, ex. 200G (default: {})".format(
+        staging.CACHE_SIZE))
+    parser.add_argument("--upload", metavar="DEST", help="copy each finished model to DEST/<project>/<timepoint> (default: the manifest's)")
+    parser.add_argument("--task", type=int, metavar="N", help="only build the Nth task (photoset) of the manifest (ex. $SLURM_ARRAY_TASK_ID)")
+    parser.add_argument("--no-preflight", action="store_false", dest="use_preflight",
+                        help="add every photo, ignoring the pre-flight tables")
+    parser.add_argument("--lod", type=int, metavar="FACES",
+                        help="also write a decimated copy of each model with about FACES faces (default: the manifest's)")
+    parser.add_argument("--no-rescue", action="store_false", dest="use_rescue",
+                        help="fail models past a rescue limit of the quality gates instead of retrying them")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(strip_qt_args(sys.argv[1:] if argv is None else argv))
+    manifest = load_manifest(args.manifest)
+    stager = staging.Stager(args.stage_dir, args.stage_cache) if args.stage or args.stage_dir else None
+    dest = args.upload or manifest.get("upload")
+    uploader = upload.Uploader(dest) if dest else None
+    try:
+        failed = run_manifest(manifest, args.only, resume=not args.restart, claim=args.claim, task=args.task, stager=stager,
+                              uploader=uploader, use_preflight=args.use_preflight, lod=args.lod or manifest.get("lod"),
+                              use_rescue=args.use_rescue)
+    finally:
+        if stager is not None:
+            stager.close()
+        results = uploader.close() if uploader is not None else []
+    upload_failed = [path for result in results for path, _ in result.failed]
+    if uploader is not None:
+        print("Uploaded {} files to {} ({} already there, {} failed)".format(sum(len(r.sent) for r in results), dest,
+                                                                           sum(len(r.skipped) for r in results), len(upload_failed)))
+    return 1 if failed or upload_failed else 0
@@ -0,0 +1,131 @@
+# PURPOSE: Create scalebars from a scale file in one pass, replacing the Create_Scalebars() block that used to be pasted into every template.
+# The old block re-read the chunk for every line of the scale file: it scanned every scalebar for the pair, then every marker (twice) to
+# find both ends, so with the 24+ target rack and multi-scoupr scale files most of the time went to attribute access on the Metashape API.
+# Here the file is read and checked up front (all problems are reported at once, before the chunk is touched), the chunk's markers and
+# scalebars are indexed by label once, and every bar is created or updated in a single pass. What happened to each line (created, updated,
+# or skipped because a marker was not detected) comes back in one ScalebarResult instead of a print per missing marker.
+#
+# Scale file format (one bar per line, no header): Marker_1_label,Marker_2_label,distance,accuracy
+#     target 5,target 6,0.02162,0.0005
+#
+# From a template (the generator expands SCALEBARSDEF into this):
+#     from metashape_batch import scalebars as scalebar_tools
+#     scalebar_tools.create_scalebars(chunk, scalebars_path)
+
+
+class ScaleFileError(ValueError):
+    """A scale file that cannot be used. `problems` lists every bad line."""
+
+    def __init__(self, path, problems):
+        self.path = path
+        self.problems = problems
+        super().__init__("{} has {} problem(s):\n  {}".format(path, len(problems), "\n  ".join(problems)))
+
+
+class ScalebarResult:
+    """What create/apply did: labels of the bars created and updated, and the bars skipped for missing markers."""
+
+    def __init__(self):
+        self.created = []
+        self.updated = []
+        self.skipped = []   # (point1, point2, [labels of the markers that were not found])
+
+    @property
+    def missing_markers(self):
+        """Every marker label named in the scale file but not found in the chunk (sorted)."""
+        return sorted(set(label for _, _, labels in self.skipped for label in labels))
+
+    @property
+    def ok(self):
+        return not self.skipped
+
+    def summary(self):
+        text = "Scalebars: {} created, {} updated, {} skipped".format(len(self.created), len(self.updated), len(self.skipped))
+        if self.skipped:
+            text += " (markers not found: {})".format(", ".join(self.missing_markers))
+        return text
+
+    def __repr__(self):
+        return "<ScalebarResult {}>".format(self.summary())
+
+
+def parse(lines, path="<scale file>"):
+    """Check and parse the lines of a scale file into (point1, point2, distance, accuracy) tuples. Raises ScaleFileError listing every
+    bad line (wrong number of fields, non numeric or non positive distance, negative accuracy, a bar from a marker to itself or a
+    duplicated pair)."""
+    rows = []
+    problems = []
+    seen = {}
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        fields = [field.strip() for field in line.rstrip("\n").split(",")]
+        if len(fields) != 4:
+            problems.append("line {}: expected 4 fields (marker,marker,distance,accuracy), found {}".format(number, len(fields)))
+            continue
+        point1, point2, dist, acc = fields
+        try:
+            dist = float(dist)
+            acc = float(acc)
+        except ValueError:
+            problems.append("line {}: distance and accuracy must be numbers ({!r}, {!r})".format(number, fields[2], fields[3]))
+            continue
+        if not point1 or not point2:
+            problems.append("line {}: missing marker label".format(number))
+        elif point1 == point2:
+            problems.append("line {}: scalebar from {} to itself".format(number, point1))
+        elif dist <= 0:
+            problems.append("line {}: distance must be positive ({})".format(number, dist))
+        elif acc < 0:
+            problems.append("line {}: accuracy must not be negative ({})".format(number, acc))
+        else:
+            pair = frozenset((point1, point2))
+            if pair in seen:
+                problems.append("line {}: {} - {} is already on line {}".format(number, point1, point2, seen[pair]))
+                continue
+            seen[pair] = number
+            rows.append((point1, point2, dist, acc))
+    if problems:
+        raise ScaleFileError(path, problems)
+    return rows
+
+
+def read(path):
+    """Read and check a scale file. Raises ScaleFileError if any line is bad."""
+    with open(path) as f:
+        return parse(f, path)
+
+
+def apply(chunk, rows):
+    """Create or update a scalebar for every (point1, point2, distance, accuracy) row. Returns a ScalebarResult.
+
+    Raises an Exception if the chunk has no markers at all (ex. marker detection failed), as the template did.
+    """
+    markers = {marker.label: marker for marker in chunk.markers}
+    if not markers:
+        raise Exception("No markers found. Unable to create scalebars")
+    bars = {bar.label: bar for bar in chunk.scalebars}
+
+    result = ScalebarResult()
+    for point1, point2, dist, acc in rows:
+        bar = bars.get(point1 + "_" + point2) or bars.get(point2 + "_" + point1)
+        if bar is not None:
+            result.updated.append(bar.label)
+        else:
+            missing = [label for label in (point1, point2) if label not in markers]
+            if missing:
+                result.skipped.append((point1, point2, missing))
+                continue
+            bar = chunk.addScalebar(markers[point1], markers[point2])
+            bars[bar.label] = bar
+            result.created.append(bar.label)
+        bar.reference.distance = dist
+        bar.reference.accuracy = acc
+    return result
+
+
+def create_scalebars(chunk, path):
+    """Read the scale file at `path`, apply it to the chunk and print a one line summary. Returns the ScalebarResult."""
+    result = apply(chunk, read(path))
+    print(result.summary())
+    return result
@@ -0,0 +1,111 @@
+# PURPOSE: Run several models at once on one node, within the single node-locked licence.
+# Stages like addPhotos, buildUV, exportModel and exportReport barely use more than one core, so a single model at a time leaves most of a
+# 32 CPU reservation idle for long stretches. This scheduler splits the job's CPUs and memory into N worker slots and starts one batch runner
+# (metashape.sh -r scripts/run_batch.py ... --claim) per slot. The runners share the manifest through the batch status index, each taking
+# the next unclaimed photoset when it finishes the last, so the serial phases of one model overlap the parallel phases of another.
+# All workers run on the same node, so they share its (node-locked) licence.
+#
+# Run from the slurm script in place of the bash metashape.sh lines (generate --mode runner --slots N writes this for you):
+#     PYTHONPATH=/path/to/metashape_batch_process python3 -m metashape_batch.scheduler ToRun/SinglePolyp/090425/manifest.json --slots 2
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+import time
+
+from . import profiles
+
+
+RUN_BATCH = os.path.join(profiles.REPO_ROOT, "scripts", "run_batch.py")
+
+# Smallest share of the node worth giving one model.
+MIN_CPUS_PER_SLOT = 4
+MEM_PER_SLOT = "16G"
+
+
+def parse_mem(text):
+    """Memory in MB from a slurm style size (ex. 64G, 64000M, 64000)."""
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*", str(text), re.IGNORECASE)
+    if not match:
+        raise ValueError("Could not read memory size {!r}".format(text))
+    scale = {"K": 1. / 1024, "": 1, "M": 1, "G": 1024, "T": 1024 * 1024}[match.group(2).upper()]
+    return int(float(match.group(1)) * scale)
+
+
+def node_budget(cpus=None, mem=None):
+    """CPUs and memory (MB) available to this job: given values, else the slurm allocation, else the whole node."""
+    if cpus is None:
+        cpus = int(os.environ.get("SLURM_CPUS_PER_TASK") or len(os.sched_getaffinity(0)))
+    if mem is None:
+        mem = os.environ.get("SLURM_MEM_PER_NODE")
+        if not mem or mem == "0":  # --mem=0 asks for all of the node's memory
+            mem = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // (1024 * 1024)
+    return int(cpus), parse_mem(mem)
+
+
+def plan_slots(slots, cpus, mem_mb, min_cpus=MIN_CPUS_PER_SLOT, mem_per_slot=MEM_PER_SLOT):
+    """Cap the requested number of slots so that each one gets at least min_cpus CPUs and mem_per_slot memory.
+
+    Returns a list of CPU id lists, one per slot, carved from the CPUs this process may run on.
+    """
+    available = sorted(os.sched_getaffinity(0))[:cpus]
+    slots = max(1, min(slots, len(available) // min_cpus, mem_mb // parse_mem(mem_per_slot)))
+    per_slot = len(available) // slots
+    return [available[i * per_slot:(i + 1) * per_slot] for i in range(slots)]
+
+
+def worker_command(manifest, batch, metashape="metashape.sh"):
+    return ["bash", metashape, "-r", RUN_BATCH, manifest, "--claim", batch, "-platform", "offscreen"]
+
+
+def run(manifest, slots, cpus=None, mem=None, min_cpus=MIN_CPUS_PER_SLOT, mem_per_slot=MEM_PER_SLOT, pin=True, stagger=60,
+        metashape="metashape.sh"):
+    """Start one runner per slot and wait for all of them. Returns the number of workers that exited with an error."""
+    cpus, mem_mb = node_budget(cpus, mem)
+    cpu_sets = plan_slots(slots, cpus, mem_mb, min_cpus, mem_per_slot)
+    batch = "{}-{}".format(time.strftime("%Y%m%d%H%M%S"), os.getpid())
+    print("Running {} worker(s) for batch {} ({} CPUs, {} MB): {} CPUs each".format(
+        len(cpu_sets), batch, sum(len(cpu_set) for cpu_set in cpu_sets), mem_mb, len(cpu_sets[0])))
+
+    workers = []
+    for i, cpu_set in enumerate(cpu_sets):
+        if i and stagger:
+            time.sleep(stagger)  # offset the workers so they are not all in the same stage at once
+        env = dict(os.environ, OMP_NUM_THREADS=str(len(cpu_set)))
+        preexec = (lambda cpu_set=cpu_set: os.sched_setaffinity(0, cpu_set)) if pin else None
+        workers.append(subprocess.Popen(worker_command(manifest, batch, metashape), env=env, preexec_fn=preexec))
+
+    errors = 0
+    for i, worker in enumerate(workers):
+        if worker.wait() != 0:
+            errors += 1
+            print("Worker {} exited with status {}".format(i, worker.returncode))
+    return errors
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python3 -m metashape_batch.scheduler",
+                                     description="Build the models of a manifest with several concurrent Metashape workers on this node.")
+    parser.add_argument("manifest", help="manifest.json written by metashape_batch.generate --mode runner")
+    parser.add_argument("--slots", type=int, default=2, help="number of models to build at once (default: 2)")
+    parser.add_argument("--cpus", type=int, help="CPUs to share between the slots (default: $SLURM_CPUS_PER_TASK)")
+    parser.add_argument("--mem", help="memory to share between the slots, ex. 64G (default: the job's --mem)")
+    parser.add_argument("--min-cpus", type=int, default=MIN_CPUS_PER_SLOT, help="fewest CPUs a slot may get")
+    parser.add_argument("--mem-per-slot", default=MEM_PER_SLOT, help="least memory a slot may get, ex. 16G")
+    parser.add_argument("--no-pin", dest="pin", action="store_false",
+                        help="let workers float over all CPUs instead of pinning each to its own share")
+    parser.add_argument("--stagger", type=float, default=60, help="seconds between worker start ups (default: 60)")
+    parser.add_argument("--metashape", default="metashape.sh", help="path to metashape.sh")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    errors = run(args.manifest, args.slots, args.cpus, args.mem, args.min_cpus, args.mem_per_slot, args.pin, args.stagger, args.metashape)
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,104 @@
+# PURPOSE: Slurm job array submission for a batch, as an alternative to one long job that runs every model in turn.
+# Each array task builds one photoset of the manifest (scripts/run_batch.py ... --task $SLURM_ARRAY_TASK_ID), so a short model never waits
+# behind a long one and a failed model only fails its own task. The array keeps the template's partition and nodelist (the licence is
+# node-locked), caps how many tasks run at once with %N and asks for a walltime sized from how long earlier models took (the "elapsed"
+# recorded in the batch status indexes, or the predicted cost of the task's photosets, see metashape_batch/predict.py). The licence is activated once before the array and deactivated once after it, by a small
+# submit script that chains the three jobs with --dependency:
+#     activate job  ->  array job (afterok)  ->  deactivate_Metashape.slm (afterany)
+#
+# Written by `python3 -m metashape_batch.generate ... --mode array`; submit with `bash <project>_<timepoint>_submit.sh`.
+
+import math
+import os
+import re
+
+from . import status
+
+
+# Walltime used when there is no history to size it from (the limit of the single job template).
+DEFAULT_WALLTIME = 72 * 3600
+MIN_WALLTIME = 3600
+MAX_WALLTIME = 72 * 3600
+
+# Tasks get the given quantile of past build times, with head room.
+WALLTIME_QUANTILE = 0.95
+WALLTIME_FACTOR = 1.5
+
+TASK_LINE = "bash metashape.sh -r {run_batch} {manifest} --task $SLURM_ARRAY_TASK_ID -platform offscreen\n"
+
+
+def format_walltime(seconds):
+    """Slurm --time value (HH:MM:SS, hours may exceed 24)."""
+    seconds = int(math.ceil(seconds))
+    return "{:02d}:{:02d}:{:02d}".format(seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
+def elapsed_history(models_dir):
+    """Build times (s) of the finished models in this models directory and its siblings (other timepoints or scouprs of the project)."""
+    elapsed = []
+    for path in status.sibling_files(models_dir, status.INDEX_NAME):
+        for record in status.StatusIndex(os.path.dirname(path)).load().values():
+            if record.get("status") == status.DONE and record.get("elapsed"):
+                elapsed.append(record["elapsed"])
+    return elapsed
+
+
+def pad_walltime(seconds, factor=WALLTIME_FACTOR, minimum=MIN_WALLTIME, maximum=MAX_WALLTIME):
+    """Walltime (s) for an expected run time: times factor, rounded up to the quarter hour and kept within the limits."""
+    seconds = math.ceil(seconds * factor / 900.) * 900
+    return int(min(maximum, max(minimum, seconds)))
+
+
+def history_walltime(elapsed, quantile=WALLTIME_QUANTILE, factor=WALLTIME_FACTOR, default=DEFAULT_WALLTIME):
+    """Per-task walltime (s) for one model: the quantile of past build times, padded."""
+    if not elapsed:
+        return default
+    elapsed = sorted(elapsed)
+    return pad_walltime(elapsed[min(len(elapsed) - 1, int(math.ceil(quantile * len(elapsed))) - 1)], factor)
+
+
+def set_directive(header, option, value):
+    """Set (or add, after the last #SBATCH line) the #SBATCH --option=value line of a slurm header."""
+    line = "#SBATCH --{}={}".format(option, value)
+    pattern = re.compile(r"^#SBATCH\s+--{}(=.*)?$".format(re.escape(option)), re.MULTILINE)
+    if pattern.search(header):
+        return pattern.sub(lambda match: line, header)
+    directives = list(re.finditer(r"^#SBATCH.*$", header, re.MULTILINE))
+    if not directives:
+        raise ValueError("No #SBATCH lines in the slurm template")
+    end = directives[-1].end()
+    return header[:end] + "\n" + line + header[end:]
+
+
+def _comment_out(text, command):
+    return re.sub(r"^({})\s*$".format(re.escape(command)), r"#\1    # done once per batch by the submit script", text, flags=re.MULTILINE)
+
+
+def array_script(slm_template, tasks, cap, walltime, task_line):
+    """The job template turned into an array of `tasks` tasks (at most `cap` at once) that each run task_line."""
+    with open(slm_template) as f:
+        slm = f.read()
+    slm = set_directive(slm, "time", format_walltime(walltime))
+    slm = set_directive(slm, "array", "0-{}%{}".format(tasks - 1, cap))
+    slm = set_directive(slm, "output", "%x_%A_%a.out")
+    slm = set_directive(slm, "error", "%x_%A_%a.err")
+    slm = _comment_out(slm, "activate_metashape")
+    return slm.rstrip("\n") + "\n\n" + task_line
+
+
+def activate_script(deactivate_slm):
+    """A short job that activates the licence, made from deactivate_Metashape.slm."""
+    with open(deactivate_slm) as f:
+        slm = f.read()
+    return re.sub(r"^deactivate_metashape\s*$", "activate_metashape", slm, flags=re.MULTILINE)
+
+
+def submit_script(array_slm, activate_slm, deactivate_slm):
+    return """#!/bin/bash
+# Activate the licence, run the array once it is active, then deactivate once every task has finished (or failed).
+set -e
+ACTIVATE=$(sbatch --parsable {activate})
+ARRAY=$(sbatch --parsable --dependency=afterok:$ACTIVATE {array})
+DEACTIVATE=$(sbatch --parsable --dependency=afterany:$ARRAY {deactivate})
+echo "Submitted activate $ACTIVATE, array $ARRAY, deactivate $DEACTIVATE"
+""".format(activate=activate_slm, array=array_slm, deactivate=deactivate_slm)
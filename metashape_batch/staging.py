@@ -0,0 +1,191 @@
+# PURPOSE: Build models on node-local disk instead of straight off /scratch1.
+# The templates addPhotos straight from /scratch1 and save the .psz straight into /scratch1/.../models, so every read of every image during
+# matching and depth map building goes over the busy parallel filesystem. With staging the batch runner copies the current photoset to
+# node-local disk ($TMPDIR), copies the next photoset of the manifest in a background thread while the current model builds, runs Metashape
+# on the local copies, and copies the finished outputs back to the models directory (also in the background, so the next model can start).
+# The project is also copied back after the long stages (alignment, depth maps, mesh) so a job that hits its --time limit can still be
+# resumed from /scratch1. Projects are saved pointing at the photos on /scratch1 (and repointed at the local copy when reopened), so the
+# copies on /scratch1 can be resumed without staging or opened in the GUI after the local copies are gone. A resumed model's stage log is
+# copied in with its project, so the stage times from before the --time limit are kept. Local photosets are kept in a cache of bounded
+# size; the least recently used are evicted first.
+#
+# Used by the runner with --stage (see metashape_batch/runner.py):
+#     bash metashape.sh -r scripts/run_batch.py manifest.json --stage --stage-cache 200G -platform offscreen
+
+import collections
+import concurrent.futures
+import os
+import shutil
+import tempfile
+import threading
+
+from .instrument import LOG_SUFFIX
+from .scheduler import parse_mem
+
+
+# Stages after which the project is copied back to the models directory (so a killed job can resume from there).
+CHECKPOINT_STAGES = ("alignCameras", "buildDepthMaps", "buildModel", "buildTexture")
+
+CACHE_SIZE = "100G"
+
+# Per-model logs copied into a local output directory (when they exist in the models directory), since pushing the outputs back replaces
+# them; they are appended to, so a rebuilt or resumed model keeps its earlier records.
+LOG_FILES = (LOG_SUFFIX,)
+
+
+def dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+def copy_file(src, dst):
+    """Copy a file through a temporary name, so a partly copied file never appears under the final name."""
+    tmp = dst + ".part"
+    shutil.copyfile(src, tmp)
+    shutil.copystat(src, tmp)
+    os.replace(tmp, dst)
+
+
+def copy_tree(src, dst):
+    tmp = dst + ".part"
+    shutil.rmtree(tmp, ignore_errors=True)
+    shutil.copytree(src, tmp)
+    os.replace(tmp, dst)
+
+
+class Stager:
+    """Node-local copies of photosets and model outputs.
+
+    root holds photosets/ (the cache of copied photosets) and work/ (one directory per model being built). cache_size bounds the bytes
+    of cached photosets (a slurm style size, ex. 200G); photosets in use or being prefetched are never evicted.
+    """
+
+    def __init__(self, root=None, cache_size=CACHE_SIZE):
+        # One directory per runner, so runners sharing a node (see scheduler.py) never evict each other's photosets.
+        self.root = root or os.path.join(os.environ.get("TMPDIR") or tempfile.gettempdir(), "metashape_stage_{}".format(os.getpid()))
+        self.photosets_dir = os.path.join(self.root, "photosets")
+        self.work_root = os.path.join(self.root, "work")
+        os.makedirs(self.photosets_dir, exist_ok=True)
+        os.makedirs(self.work_root, exist_ok=True)
+        self.cache_bytes = parse_mem(cache_size) * 1024 * 1024
+        self._cache = collections.OrderedDict()  # photoset -> (local path, bytes), least recently used first
+        self._pending = {}                       # photoset -> Future of its copy
+        self._pinned = set()
+        self._lock = threading.Lock()
+        self._fetcher = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._pusher = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._pushes = []
+        self._snapshots = 0
+
+    def _local_path(self, photoset):
+        # Keep the photoset's own directory name (models are named after it) under its parent's name (timepoints reuse photoset names).
+        photoset = photoset.rstrip("/")
+        return os.path.join(self.photosets_dir, os.path.basename(os.path.dirname(photoset)), os.path.basename(photoset))
+
+    def _copy(self, photoset):
+        local = self._local_path(photoset)
+        if not os.path.isdir(local):
+            copy_tree(photoset, local)
+        size = dir_size(local)
+        with self._lock:
+            self._cache[photoset] = (local, size)
+            self._cache.move_to_end(photoset)
+            self._evict()
+        return local
+
+    def _evict(self):
+        total = sum(size for _, size in self._cache.values())
+        for photoset in list(self._cache):
+            if total <= self.cache_bytes:
+                break
+            if photoset in self._pinned or photoset in self._pending:
+                continue
+            local, size = self._cache.pop(photoset)
+            shutil.rmtree(local, ignore_errors=True)
+            total -= size
+
+    def prefetch(self, photoset):
+        """Start copying a photoset in the background (if it is not cached or already on its way)."""
+        with self._lock:
+            if photoset in self._cache or photoset in self._pending:
+                return
+            self._pending[photoset] = self._fetcher.submit(self._copy, photoset)
+
+    def fetch(self, photoset):
+        """Local copy of a photoset (waiting for its prefetch, or copying it now). It stays pinned in the cache until release()."""
+        with self._lock:
+            self._pinned.add(photoset)
+            future = self._pending.get(photoset)
+            cached = self._cache.get(photoset)
+            if cached:
+                self._cache.move_to_end(photoset)
+        try:
+            if future is not None:
+                return future.result()
+            if cached:
+                return cached[0]
+            return self._copy(photoset)
+        finally:
+            with self._lock:
+                self._pending.pop(photoset, None)
+
+    def release(self, photoset):
+        with self._lock:
+            self._pinned.discard(photoset)
+            self._evict()
+
+    def work_dir(self, name, output_dir, resume=True):
+        """A fresh local output directory for one model, holding copies of the model's stage log and, with resume, its saved project
+        from output_dir."""
+        work = os.path.join(self.work_root, name)
+        shutil.rmtree(work, ignore_errors=True)
+        os.makedirs(work)
+        for suffix in LOG_FILES + ((".psz",) if resume else ()):
+            path = os.path.join(output_dir, name + suffix)
+            if os.path.exists(path):
+                copy_file(path, os.path.join(work, name + suffix))
+        return work
+
+    def checkpoint(self, path, output_dir):
+        """Copy one file (ex. the project after a long stage) back to output_dir. A local snapshot is taken first, so Metashape can go on
+        saving the file while the snapshot is copied back in the background."""
+        self._snapshots += 1
+        snapshot = "{}.{}.snapshot".format(path, self._snapshots)
+        shutil.copyfile(path, snapshot)
+
+        def push():
+            try:
+                copy_file(snapshot, os.path.join(output_dir, os.path.basename(path)))
+            finally:
+                os.remove(snapshot)
+        self._pushes.append(self._pusher.submit(push))
+
+    def push(self, work, output_dir, remove=True, then=None):
+        """Copy everything in a model's local output directory back to output_dir in the background (then remove it, with remove).
+        then(), if given, is called from the copy thread once the files are in output_dir."""
+        def push():
+            os.makedirs(output_dir, exist_ok=True)
+            for entry in os.scandir(work):
+                if entry.is_file() and not entry.name.endswith((".part", ".snapshot")):
+                    copy_file(entry.path, os.path.join(output_dir, entry.name))
+            if remove:
+                shutil.rmtree(work, ignore_errors=True)
+            if then is not None:
+                then()
+        self._pushes.append(self._pusher.submit(push))
+
+    def wait(self):
+        """Wait for every copy back to finish; raises the first copy error."""
+        pushes, self._pushes = self._pushes, []
+        for future in pushes:
+            future.result()
+
+    def close(self, clean=True):
+        self.wait()
+        self._fetcher.shutdown(wait=True)
+        self._pusher.shutdown(wait=True)
+        if clean:
+            shutil.rmtree(self.root, ignore_errors=True)
@@ -0,0 +1,151 @@
+# PURPOSE: Batch status index, so rerunning a batch only schedules models that still need building.
+# The index is a JSON file (batch_status.json) in the models output directory, keyed by photoset path. Each record holds the model's status
+# (running / done / failed), the hash of the template (or runner settings) and of the scale files it was built with, and when it finished.
+# The generator consults it to skip finished models; the batch runner updates it as models start, finish or fail. Writes are locked and
+# atomic so several runners can share one index, and runners started by the node-local scheduler (metashape_batch.scheduler) use it as their
+# work queue: each one claims the next photoset nobody in the same batch has taken yet. Records also hold the digest of the photos a model
+# was built from (see metashape_batch/fingerprint.py), so a photoset whose photos changed is rebuilt.
+
+import contextlib
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import re
+import time
+
+
+INDEX_NAME = "batch_status.json"
+
+# Assignments of a scale or coordinate file in a template script (ex. scalebars_path = "/scratch1/.../Scales/BARSTICKERS_060123.txt"),
+# commented out lines excepted.
+TEMPLATE_SCALE_FILE = re.compile(r"""^[ \t]*\w+[ \t]*=[ \t]*["']([^"'\n]+\.txt)["']""", re.MULTILINE)
+
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+def file_hash(*paths):
+    """sha1 of the contents of the given files (missing or None paths are skipped)."""
+    h = hashlib.sha1()
+    for path in paths:
+        if path and os.path.exists(path):
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    h.update(block)
+    return h.hexdigest()
+
+
+def settings_hash(profile):
+    """sha1 of the processing settings the batch runner uses (stage order, stage arguments and photo types)."""
+    settings = {key: profile.get(key) for key in ("stages", "params", "photo_extensions")}
+    return hashlib.sha1(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+
+
+def scale_hash(profile):
+    return file_hash(profile.get("scalebars"), profile.get("coords"))
+
+
+def template_scale_hash(template):
+    """sha1 of the scale and coordinate files a template script reads (its own paths, not the profile's, which only the runner uses)."""
+    with open(template) as f:
+        return file_hash(*TEMPLATE_SCALE_FILE.findall(f.read()))
+
+
+def sibling_files(models_dir, name):
+    """Paths of the file `name` in this models directory and its siblings (other timepoints or scouprs of the project) that exist."""
+    parent = os.path.dirname(models_dir.rstrip("/"))
+    paths = set(glob.glob(os.path.join(parent, "*", name)))
+    own = os.path.join(models_dir, name)
+    if os.path.exists(own):
+        paths.add(own)
+    return sorted(paths)
+
+
+def outputs_exist(models_dir, photoset):
+    """True if the .obj and _report.pdf for a photoset are already in the models directory."""
+    name = os.path.basename(photoset.rstrip("/"))
+    return all(os.path.exists(os.path.join(models_dir, name + suffix)) for suffix in (".obj", "_report.pdf"))
+
+
+class StatusIndex:
+    """The batch_status.json file of one models directory."""
+
+    def __init__(self, models_dir):
+        self.models_dir = models_dir
+        self.path = os.path.join(models_dir, INDEX_NAME)
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as f:
+            return json.load(f)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """Exclusive lock around a read-modify-write of the index. Yields the records; they are written back on exit."""
+        os.makedirs(self.models_dir, exist_ok=True)
+        with open(self.path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                records = self.load()
+                yield records
+                tmp = self.path + ".tmp"
+                with open(tmp, "w") as f:
+                    json.dump(records, f, indent=1, sort_keys=True)
+                os.replace(tmp, self.path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def get(self, photoset):
+        return self.load().get(photoset)
+
+    def update(self, photoset, **fields):
+        """Merge fields into a photoset's record (and stamp it with the current time)."""
+        fields["updated"] = time.strftime("%Y-%m-%d %H:%M:%S")
+        with self._locked() as records:
+            records.setdefault(photoset, {}).update(fields)
+
+    def claim(self, photosets, batch, worker):
+        """Mark the first photoset not yet taken in this batch as running by `worker` and return it (None once all are taken)."""
+        with self._locked() as records:
+            for photoset in photosets:
+                record = records.setdefault(photoset, {})
+                if record.get("batch") != batch:
+                    record.update(status=RUNNING, batch=batch, worker=worker, updated=time.strftime("%Y-%m-%d %H:%M:%S"))
+                    return photoset
+        return None
+
+    def pending(self, photosets, template_hash, scale_hash, digests=None):
+        """Split photosets into those that need building and those that are finished.
+
+        Returns (todo, done) where todo is a list of (photoset, reason) with reason one of "missing", "failed", "unfinished" (a run
+        stopped part way, ex. at the --time limit), "stale" (built with a different template or scale file) or "changed" (its photos
+        changed since it was built; only with digests, the photoset digests of metashape_batch.fingerprint). A photoset whose outputs
+        exist but that has no record (ex. it was built before the index existed) is adopted as done with the current hashes.
+        """
+        digests = digests or {}
+        todo = []
+        done = []
+        with self._locked() as records:
+            for photoset in photosets:
+                record = records.get(photoset)
+                if not outputs_exist(self.models_dir, photoset):
+                    todo.append((photoset, FAILED if record and record.get("status") == FAILED else "missing"))
+                elif record is None:
+                    records[photoset] = {"status": DONE, "template_hash": template_hash, "scale_hash": scale_hash, "adopted": True,
+                                         "updated": time.strftime("%Y-%m-%d %H:%M:%S")}
+                    if photoset in digests:
+                        records[photoset]["photoset_digest"] = digests[photoset]
+                    done.append(photoset)
+                elif record.get("status") != DONE:
+                    todo.append((photoset, FAILED if record.get("status") == FAILED else "unfinished"))
+                elif record.get("template_hash") != template_hash or record.get("scale_hash") != scale_hash:
+                    todo.append((photoset, "stale"))
+                elif photoset in digests and record.get("photoset_digest") not in (None, digests[photoset]):
+                    todo.append((photoset, "changed"))
+                else:
+                    done.append(photoset)
+        return todo, done
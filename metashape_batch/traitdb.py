@@ -0,0 +1,253 @@
+# PURPOSE: Keep the traits of every model of every timepoint in one SQLite database, so growth can be followed colony by colony without
+# re-reading a phenotypes.csv per timepoint.
+# One row per colony and timepoint, keyed by project / tag / timepoint, holding the traits of metashape_batch.phenotype, the scoupr the
+# model was built in ("" for projects without one) and the date the photos were taken. The scoupr is not part of the key, as scoupr
+# directories are named after their session (ex. 090923_PS_3D_AW, then 031524_PS_3D_AW), so a colony changes scoupr between timepoints. The tag is the model name without its timepoint prefix (ex.
+# 090425_3-E-B at timepoint 090425 is colony 3-E-B), so the same colony lines up across timepoints. The date comes from the photos' EXIF
+# (the image index, see metashape_batch/imageindex.py) and otherwise from the timepoint name (090425 is MMDDYY, ORCC_April2023 is the
+# 1st of that month). Rows are upserted, so ingesting a timepoint again replaces its values. Growth between consecutive timepoints of each
+# colony is a single indexed query (window functions over the colony's rows in date order).
+#
+# Ex: python3 -m metashape_batch.phenotype /scratch1/migomez/3Dmodels/models/AcroFLaT/ORCC_April2023/1A --db /project2/ckenkel_26/migomez/traits.sqlite
+#     python3 -m metashape_batch.traitdb ingest /project2/ckenkel_26/migomez/traits.sqlite /scratch1/migomez/3Dmodels/models/SinglePolyp/090425
+#     python3 -m metashape_batch.traitdb growth /project2/ckenkel_26/migomez/traits.sqlite --project SinglePolyp --trait volume_cm3
+
+import argparse
+import csv
+import datetime
+import math
+import os
+import re
+import sqlite3
+import sys
+import time
+
+from . import imageindex
+from . import phenotype
+from . import profiles
+
+
+# Trait columns: every phenotype field but the model name and timepoint.
+TRAITS = tuple(field for field in phenotype.FIELDS if field not in ("model", "timepoint"))
+
+KEY = ("project", "tag", "timepoint")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS traits (
+    project TEXT NOT NULL,
+    scoupr TEXT NOT NULL DEFAULT '',
+    tag TEXT NOT NULL,
+    timepoint TEXT NOT NULL,
+    date TEXT,
+    model TEXT,
+    {traits},
+    updated TEXT,
+    PRIMARY KEY (project, tag, timepoint)
+);
+CREATE INDEX IF NOT EXISTS traits_colony_date ON traits (project, tag, date);
+CREATE INDEX IF NOT EXISTS traits_timepoint ON traits (project, timepoint);
+""".format(traits=",\n    ".join("{} REAL".format(trait) for trait in TRAITS))
+
+MONTHS = {name: number for number, names in enumerate(
+    [("jan", "january"), ("feb", "february"), ("mar", "march"), ("apr", "april"), ("may",), ("jun", "june"), ("jul", "july"),
+     ("aug", "august"), ("sep", "sept", "september"), ("oct", "october"), ("nov", "november"), ("dec", "december")], 1) for name in names}
+
+
+def connect(path):
+    """Open (and if needed create) the database. WAL mode, so readers never wait on a batch being ingested."""
+    db = sqlite3.connect(path, timeout=60)
+    db.execute("PRAGMA journal_mode=WAL")
+    # SQLite only has ln() when built with its math functions.
+    db.create_function("ln", 1, math.log, deterministic=True)
+    db.executescript(SCHEMA)
+    _add_traits(db)
+    _rekey(db)
+    return db
+
+
+def _add_traits(db):
+    """Add the columns of traits phenotype has gained since the database was made."""
+    have = {row[1] for row in db.execute("PRAGMA table_info(traits)")}
+    with db:
+        for trait in TRAITS:
+            if trait not in have:
+                db.execute("ALTER TABLE traits ADD COLUMN {} REAL".format(trait))
+
+
+def _rekey(db):
+    """Rebuild a database keyed by an older KEY (with the scoupr) under the current one, keeping the latest row of each colony and
+    timepoint."""
+    info = db.execute("PRAGMA table_info(traits)").fetchall()
+    if tuple(row[1] for row in sorted(info, key=lambda row: row[5]) if row[5]) == KEY:
+        return
+    columns = ", ".join(row[1] for row in info)
+    db.executescript("""
+        BEGIN;
+        DROP INDEX IF EXISTS traits_colony_date;
+        DROP INDEX IF EXISTS traits_timepoint;
+        ALTER TABLE traits RENAME TO traits_old;
+        {schema}
+        INSERT OR REPLACE INTO traits ({columns}) SELECT {columns} FROM traits_old ORDER BY updated;
+        DROP TABLE traits_old;
+        COMMIT;
+    """.format(schema=SCHEMA, columns=columns))
+
+
+def timepoint_date(timepoint):
+    """ISO date from a timepoint name: MMDDYY (090425) or a month and year (ORCC_April2023, DRTO_Sept2023). None if neither."""
+    match = re.search(r"(?<!\d)(\d{2})(\d{2})(\d{2})(?!\d)", timepoint)
+    if match:
+        month, day, year = (int(x) for x in match.groups())
+        try:
+            return datetime.date(2000 + year, month, day).isoformat()
+        except ValueError:
+            pass
+    match = re.search(r"([A-Za-z]+)[_ -]?(\d{4})", timepoint)
+    if match and match.group(1).lower() in MONTHS:
+        return datetime.date(int(match.group(2)), MONTHS[match.group(1).lower()], 1).isoformat()
+    return None
+
+
+def photo_dates(models_dir):
+    """{photoset name: ISO date the earliest photo was taken} from the timepoint's image index (EXIF)."""
+    column = imageindex.FIELDS.index("taken")
+    dates = {}
+    for photoset, entry in imageindex.ImageIndex(models_dir).photosets.items():
+        taken = sorted(record[column] for record in entry["photos"] if record[column])
+        if taken:
+            dates[os.path.basename(photoset)] = taken[0][:10].replace(":", "-")
+    return dates
+
+
+def tag_of(model, timepoint):
+    """Colony tag of a model: its name without the timepoint (or a leading MMDDYY date) prefix."""
+    if model.startswith(timepoint + "_"):
+        return model[len(timepoint) + 1:]
+    return re.sub(r"^\d{6}_", "", model)
+
+
+def locate(models_dir, models_root=profiles.MODELS_ROOT):
+    """(project, timepoint, scoupr) of a models directory laid out as models/{project}/{timepoint}[/{scoupr}] (rack models are
+    models/{timepoint}/Rack). Outside models_root, the directory is taken to be the timepoint and its parent the project."""
+    path = os.path.abspath(models_dir)
+    root = os.path.abspath(models_root)
+    parts = os.path.relpath(path, root).split(os.sep) if path.startswith(root + os.sep) else []
+    if len(parts) == 3:
+        return parts[0], parts[1], parts[2]
+    if len(parts) == 2 and parts[1] == "Rack":
+        return "Rack", parts[0], ""
+    if len(parts) == 2:
+        return parts[0], parts[1], ""
+    return os.path.basename(os.path.dirname(path)), os.path.basename(path), ""
+
+
+def upsert(db, rows, project, timepoint, scoupr="", dates=None):
+    """Insert or replace the traits of a timepoint's models (phenotype rows). dates maps model name -> ISO date (default: from the
+    timepoint name). Returns the number of rows written."""
+    default_date = timepoint_date(timepoint)
+    dates = dates or {}
+    columns = KEY + ("date", "model") + TRAITS + ("updated",)
+    stamp = time.strftime("%Y-%m-%d %H:%M:%S")
+    values = []
+    for row in rows:
+        traits = [None if row.get(trait) in (None, "") else float(row[trait] in (True, "True") if trait == "closed" else row[trait])
+                  for trait in TRAITS]
+        values.append((project, scoupr or "", tag_of(row["model"], timepoint), timepoint, dates.get(row["model"], default_date),
+                       row["model"]) + tuple(traits) + (stamp,))
+    sql = "INSERT INTO traits ({}) VALUES ({}) ON CONFLICT ({}) DO UPDATE SET {}".format(
+        ", ".join(columns), ", ".join("?" * len(columns)), ", ".join(KEY),
+        ", ".join("{0} = excluded.{0}".format(column) for column in columns if column not in KEY))
+    with db:
+        db.executemany(sql, values)
+    return len(values)
+
+
+def ingest(db, models_dir, project=None, timepoint=None, scoupr=None, rows=None):
+    """Upsert a models directory's phenotypes (rows, or its phenotypes.csv), dated from the photos' EXIF where the index has it."""
+    located = locate(models_dir)
+    project = project if project is not None else located[0]
+    timepoint = timepoint or located[1]
+    scoupr = scoupr if scoupr is not None else located[2]
+    if rows is None:
+        with open(os.path.join(models_dir, phenotype.CSV_NAME), newline="") as f:
+            rows = list(csv.DictReader(f))
+    return upsert(db, rows, project, timepoint, scoupr, photo_dates(models_dir))
+
+
+def growth(db, trait, project=None, tags=None):
+    """Change of a trait between consecutive timepoints of each colony: rows of (project, scoupr, tag, timepoint, date, value, previous
+    timepoint, previous date, days, change, change per day, relative growth per day (ln(value / previous) / days))."""
+    if trait not in TRAITS:
+        raise ValueError("Unknown trait {!r}. Choose from: {}".format(trait, ", ".join(TRAITS)))
+    where, args = [], []
+    if project is not None:
+        where.append("project = ?")
+        args.append(project)
+    if tags:
+        where.append("tag IN ({})".format(", ".join("?" * len(tags))))
+        args.extend(tags)
+    sql = """
+        SELECT project, scoupr, tag, timepoint, date, value, prev_timepoint, prev_date, days, value - prev AS change,
+               (value - prev) / days AS per_day,
+               CASE WHEN value > 0 AND prev > 0 THEN ln(value / prev) / days END AS relative_per_day
+        FROM (
+            SELECT project, scoupr, tag, timepoint, date, {trait} AS value,
+                   LAG({trait}) OVER colony AS prev,
+                   LAG(timepoint) OVER colony AS prev_timepoint,
+                   LAG(date) OVER colony AS prev_date,
+                   julianday(date) - julianday(LAG(date) OVER colony) AS days
+            FROM traits {where}
+            WINDOW colony AS (PARTITION BY project, tag ORDER BY date, timepoint)
+        )
+        WHERE prev IS NOT NULL AND days > 0
+        ORDER BY project, tag, date
+    """.format(trait=trait, where="WHERE " + " AND ".join(where) if where else "")
+    return db.execute(sql, args).fetchall()
+
+
+GROWTH_FIELDS = ("project", "scoupr", "tag", "timepoint", "date", "value", "prev_timepoint", "prev_date", "days", "change", "per_day",
+                 "relative_per_day")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python3 -m metashape_batch.traitdb", description="Store traits across timepoints and query growth.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    ingest_parser = commands.add_parser("ingest", help="upsert the phenotypes.csv of models directories")
+    ingest_parser.add_argument("db", help="SQLite database (created if missing)")
+    ingest_parser.add_argument("models_dirs", nargs="+", help="models directories (each with a phenotypes.csv)")
+    ingest_parser.add_argument("--project", help="project (default: from the models directory path)")
+    ingest_parser.add_argument("--scoupr", help="scoupr (default: from the models directory path)")
+    growth_parser = commands.add_parser("growth", help="growth of a trait between consecutive timepoints of each colony")
+    growth_parser.add_argument("db", help="SQLite database")
+    growth_parser.add_argument("--trait", default="volume_cm3", choices=TRAITS, help="trait (default: volume_cm3)")
+    growth_parser.add_argument("--project", help="only this project")
+    growth_parser.add_argument("--tag", nargs="+", dest="tags", help="only these colonies")
+    growth_parser.add_argument("--out", help="write a CSV here instead of printing")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    db = connect(args.db)
+    try:
+        if args.command == "ingest":
+            for models_dir in args.models_dirs:
+                n = ingest(db, models_dir, args.project, scoupr=args.scoupr)
+                print("{}: {} models".format(models_dir, n))
+            return 0
+        rows = growth(db, args.trait, args.project, args.tags)
+        out = open(args.out, "w", newline="") if args.out else sys.stdout
+        try:
+            writer = csv.writer(out)
+            writer.writerow(GROWTH_FIELDS)
+            writer.writerows(rows)
+        finally:
+            if args.out:
+                out.close()
+        return 0
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,189 @@
+# PURPOSE: Hand each finished model off to the lab share as soon as it is built, instead of scp -r of the whole timepoint at the end.
+# The batch runner queues a model's products (.obj, .mtl, the texture images named in the .mtl and the _report.pdf) as soon as the model is
+# done, and a background thread copies them to the destination while the next model builds. Every copy is checked against the source's
+# sha256 and retried (with a growing wait) if it fails or does not match, and files already at the destination with the same hash are
+# skipped, so rerunning a batch or re-syncing a timepoint only sends what changed. Hashes of sent files are kept in SHA256SUMS at the
+# destination (sha256sum -c format).
+#
+# The destination is a directory (ex. a mounted lab share); models go to <destination>/<project>/<timepoint>[/<scoupr>]/.
+#     bash metashape.sh -r scripts/run_batch.py manifest.json --upload /project2/ckenkel_26/migomez/models -platform offscreen
+# or re-sync a finished timepoint by hand:
+#     python3 -m metashape_batch.upload /scratch1/migomez/3Dmodels/models/SinglePolyp/090425 /project2/ckenkel_26/migomez/models/SinglePolyp/090425
+
+import argparse
+import concurrent.futures
+import glob
+import hashlib
+import os
+import shutil
+import sys
+import threading
+import time
+
+
+SUMS_NAME = "SHA256SUMS"
+
+RETRIES = 3
+RETRY_WAIT = 5  # seconds before the first retry; doubled for each one after
+
+
+def sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def textures(mtl):
+    """Image files named by a .mtl (map_Kd and other map_ lines), relative to its directory."""
+    names = []
+    with open(mtl) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) >= 2 and fields[0].lower().startswith("map_") and fields[-1] not in names:
+                names.append(fields[-1])
+    return names
+
+
+def model_files(models_dir, name):
+    """The products of one model that exist: name.obj, name.mtl, its textures and name_report.pdf."""
+    files = [os.path.join(models_dir, name + ".obj")]
+    mtl = os.path.join(models_dir, name + ".mtl")
+    if os.path.exists(mtl):
+        files.append(mtl)
+        files.extend(os.path.join(models_dir, texture) for texture in textures(mtl))
+    files.append(os.path.join(models_dir, name + "_report.pdf"))
+    return [path for path in files if os.path.isfile(path)]
+
+
+def destination_dir(root, project=None, timepoint=None, scoupr=None):
+    return os.path.join(root, *[part for part in (project, timepoint, scoupr) if part])
+
+
+class UploadResult:
+    def __init__(self, name):
+        self.name = name
+        self.sent = []
+        self.skipped = []
+        self.failed = []   # (path, error)
+
+    @property
+    def ok(self):
+        return not self.failed
+
+
+class Uploader:
+    """Background queue that copies files into a destination directory, checking and retrying each copy."""
+
+    def __init__(self, dest, retries=RETRIES, retry_wait=RETRY_WAIT, workers=1):
+        self.dest = dest
+        self.retries = retries
+        self.retry_wait = retry_wait
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self._futures = []
+        self._sums_lock = threading.Lock()
+
+    def _record(self, dest_dir, name, digest):
+        """Set the file's line in the destination's SHA256SUMS (rewritten whole, so a resent file never has two lines)."""
+        path = os.path.join(dest_dir, SUMS_NAME)
+        with self._sums_lock:
+            sums = {}
+            if os.path.exists(path):
+                with open(path) as f:
+                    for line in f:
+                        if line.strip():
+                            file_digest, file_name = line.rstrip("\n").split("  ", 1)
+                            sums[file_name] = file_digest
+            sums[name] = digest
+            with open(path + ".part", "w") as f:
+                f.writelines("{}  {}\n".format(sums[file_name], file_name) for file_name in sorted(sums))
+            os.replace(path + ".part", path)
+
+    def _send(self, path, dest_dir):
+        """Copy one file unless an identical one is there already. Returns True if it was copied."""
+        name = os.path.basename(path)
+        target = os.path.join(dest_dir, name)
+        digest = sha256(path)
+        if os.path.exists(target) and os.path.getsize(target) == os.path.getsize(path) and sha256(target) == digest:
+            return False
+        wait = self.retry_wait
+        for attempt in range(self.retries + 1):
+            tmp = target + ".part"
+            try:
+                shutil.copyfile(path, tmp)
+                if sha256(tmp) != digest:
+                    raise IOError("checksum mismatch after copying {}".format(name))
+                os.replace(tmp, target)
+                self._record(dest_dir, name, digest)
+                return True
+            except (IOError, OSError):
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                if attempt == self.retries:
+                    raise
+                time.sleep(wait)
+                wait *= 2
+
+    def _upload(self, name, paths, subdir, on_done):
+        result = UploadResult(name)
+        dest_dir = os.path.join(self.dest, subdir) if subdir else self.dest
+        try:
+            os.makedirs(dest_dir, exist_ok=True)
+        except OSError as e:
+            result.failed.extend((path, repr(e)) for path in paths)
+            paths = []
+        for path in paths:
+            try:
+                (result.sent if self._send(path, dest_dir) else result.skipped).append(path)
+            except (IOError, OSError) as e:
+                result.failed.append((path, repr(e)))
+        if on_done is not None:
+            on_done(result)
+        return result
+
+    def submit(self, name, paths, subdir=None, on_done=None):
+        """Queue the files of one model (`name`) for upload into dest/subdir. on_done(UploadResult) is called from the upload thread."""
+        future = self._pool.submit(self._upload, name, list(paths), subdir, on_done)
+        self._futures.append(future)
+        return future
+
+    def wait(self):
+        """Wait for everything queued so far. Returns the UploadResults."""
+        futures, self._futures = self._futures, []
+        return [future.result() for future in futures]
+
+    def close(self):
+        results = self.wait()
+        self._pool.shutdown(wait=True)
+        return results
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python3 -m metashape_batch.upload",
+                                     description="Copy the models (.obj, .mtl, textures, reports) of a models directory to a destination, "
+                                                 "skipping files already there with the same checksum.")
+    parser.add_argument("models_dir", help="models directory (ex. a timepoint)")
+    parser.add_argument("dest", help="destination directory")
+    parser.add_argument("--retries", type=int, default=RETRIES, help="retries per file (default: {})".format(RETRIES))
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    uploader = Uploader(args.dest, retries=args.retries)
+    for obj in sorted(glob.glob(os.path.join(args.models_dir, "*.obj"))):
+        name = os.path.splitext(os.path.basename(obj))[0]
+        uploader.submit(name, model_files(args.models_dir, name))
+    results = uploader.close()
+    failed = [path for result in results for path, _ in result.failed]
+    print("Sent {} files, {} already up to date, {} failed".format(sum(len(r.sent) for r in results), sum(len(r.skipped) for r in results),
+                                                                  len(failed)))
+    for result in results:
+        for path, error in result.failed:
+            print("FAILED {}: {}".format(path, error))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -16,16 +16,7 @@
 TEMPLATE=fragram_template.py	# Option to change this to the template script of your choosing.
 PROJECT=SinglePolyp #CalcExpt_Skeletons
 TIMEPOINT=$1
-DIR=/scratch1/migomez/3Dmodels/source_images/$PROJECT/$TIMEPOINT	# Option to change this location. All you should need to do is change migomez to your username.
-
-
-
-# Create an output directory for the custom scripts. 
-mkdir /scratch1/migomez/metashape-pro_2_2_1/ToRun/$PROJECT/$TIMEPOINT          # Option to change this locatio
-OUT=/scratch1/migomez/metashape-pro_2_2_1/ToRun/$PROJECT/$TIMEPOINT     	# Option to change this location.
-
-# Create an output directory for the 3D models to be saved to (for this batch).
-mkdir /scratch1/migomez/3Dmodels/models/$PROJECT/$TIMEPOINT
+BATCH=/scratch1/migomez/metashape_batch_process	# Location of this repository (holds the metashape_batch python package). Option to change this location.
 
 
 # If TIMEPOINT is not provided when ./buildscripts.sh is run, then exit and output the following text:
@@ -45,47 +36,7 @@ fi
 
 ###### SCRIPT ######
 
-# Compile a list of the absolute file paths for each photoset directory within the timepoint directory and place in the output ($OUT) directory. 
-ls -d -1 $DIR/** > $OUT/PhotosetDirs.txt
-
-
-# Create a unique Metashape script (based on rack_template.py) for each photoset and save to the output directory. This simply takes rack_template.py and replaces the PHOTOSET variable.
-(set -f 	# this is required so that echo does not expand the * wildcards within the newly created py scripts
-for line in `cat $OUT/PhotosetDirs.txt`; do
-    IFS='/' read -ra NAME <<< "$line";		# this splits the file path
-    name1="${NAME[7]}";				# this picks the 6th thing in the file path and names the output .py as such
-    while read script; do
-        echo ${script//PHOTOSET/$line};
-    done < $TEMPLATE > $OUT/${name1}.py 	# Option to change to the name of the base script that you would like to use as a template HERE
-done
-)
-
-
-# Create a list of all of the newly created python scripts.
-ls $OUT/*.py > $OUT/listofscripts.txt
-
-
-# Then replace any instances of REPLACEME and ALSOREPLACE with the following hard coded if statements. This is necessary because in the prior step, when the template script is echoed to a new file, all formatting is removed (ie. tabs) and if statements no longer work.
-for file in `cat $OUT/listofscripts.txt`; do
-   sed -i 's/REPLACEME/if found_major_version != compatible_major_version: \n\t raise Exception("Incompatible Metashape version: {} != {}".format(found_major_version, compatible_major_version))/' $file
-   sed -i 's/ALSOREPLACE/if chunk.crs: \n\t m = chunk.crs.localframe(v_t) \nelse: \n\t m = Metashape.Matrix().Diag([1, 1, 1, 1])/' $file
-   sed -i 's#SCALEBARSDEF#def Create_Scalebars(): \n\n   iNumScaleBars=len(chunk.scalebars) \n   iNumMarkers=len(chunk.markers) \n   if (iNumMarkers == 0): \n      raise Exception("No markers found. Unable to create scalebars") \n   if (iNumScaleBars > 0): \n      print("There are already ",iNumScaleBars," scalebars in this project.") \n\n   file = open(scalebars_path) \n   eof = False \n   line = file.readline() \n   while not eof: \n      point1, point2, dist, acc = line.split(",") \n      scalebarfound=0 \n      if (iNumScaleBars > 0): \n         for sbScaleBar in chunk.scalebars: \n            strScaleBarLabel_1=point1+"_"+point2 \n            strScaleBarLabel_2=point2+"_"+point1 \n            if sbScaleBar.label==strScaleBarLabel_1 or sbScaleBar.label==strScaleBarLabel_2: \n               scalebarfound=1 \n               sbScaleBar.reference.distance=float(dist) \n               sbScaleBar.reference.accuracy=float(acc) \n      if (scalebarfound==0): \n         bMarker1Found=0 \n         for marker in chunk.markers: \n            if (marker.label == point1): \n               marker1 = marker \n               bMarker1Found=1 \n               break \n         bMarker2Found=0 \n         for marker in chunk.markers: \n            if (marker.label == point2): \n               marker2 = marker \n               bMarker2Found=1 \n               break \n         if bMarker1Found==1 and bMarker2Found==1: \n            sbScaleBar = chunk.addScalebar(marker1,marker2) \n            sbScaleBar.reference.distance=float(dist) \n            sbScaleBar.reference.accuracy=float(acc) \n         else: \n            if (bMarker1Found == 0): \n               print("Marker "+point1+" was not found") \n            if (bMarker2Found == 0): \n               print("Marker "+point2+" was not found") \n      line = file.readline() \n      if not len(line): \n         eof = True \n         break \n\n   file.close() \n   Metashape.app.update() \n\nCreate_Scalebars()#' $file
-done
-
-#Note on the 3rd sed command above, the / breaks when it gets to the URL
-
-# Make all newly created python scripts executable.
-chmod +x $OUT/*.py
-
-
-# Create a list of the full command that calls each unique python script so that they can be run one after another in a slurm script. Save as ToDo.txt
-for i in `ls ToRun/$PROJECT/$TIMEPOINT/*.py`; do		# This could also be done as follows: for i in `cat $OUT/listofscripts.txt`; do 
-    echo bash metashape.sh -r $i -platform offscreen >> $OUT/ToDo.txt; 
-done
-
-
-# Finally, append ToDo.txt to the template Metashape job submission script (template_MetashapeJobSubmit.slm) and make it executable.
-cat template_MetashapeJobSubmit.slm $OUT/ToDo.txt > ${PROJECT}_${TIMEPOINT}_MetashapeJobSubmit.slm
-chmod +x ${PROJECT}_${TIMEPOINT}_MetashapeJobSubmit.slm
-
-
+# The python generator lists the photoset directories, renders one script per photoset from the template (indentation intact, so no sed
+# clean up is needed), and writes PhotosetDirs.txt, listofscripts.txt, ToDo.txt and ${PROJECT}_${TIMEPOINT}_MetashapeJobSubmit.slm in one pass.
+# Output locations default to /scratch1/migomez/... (see metashape_batch/profiles.py). Run with --help for options.
+PYTHONPATH=$BATCH python3 -m metashape_batch.generate fragram $TIMEPOINT --project $PROJECT --template $TEMPLATE --slm-template template_MetashapeJobSubmit.slm
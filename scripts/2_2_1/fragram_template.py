@@ -34,6 +34,9 @@ import Metashape
 import os
 import glob
 import math
+import sys
+sys.path.insert(0, "BATCHROOT") 	# location of metashape_batch_process (filled in when this script is generated)
+from metashape_batch import instrument 	# per-stage timing & memory log
 
 
 ## Set file paths:
@@ -74,10 +77,12 @@ os.chdir(source_images)
 cwd = os.getcwd()
 print(cwd)
 swd = cwd.split("/") # split the name into a list by the '/'
+stage_log = instrument.StageLog(output+swd[-1]+"_stages.jsonl", photoset=swd[-1]) 	# one JSON line per stage (time, CPU, peak memory, output sizes), saved next to the .psz
 
 photoset=glob.glob(cwd+"/*.bmp") 	# directs metashape to photos to be used to build the model. There is a chance you have to change between .jpg/.JPG/.bmp/.png
-chunk.addPhotos(photoset) 	# adds photos to project
-doc.save(output+swd[-1]+'.psz') 	# names the Metashape Project file based on the last portion of swd
+with stage_log.stage("addPhotos", output+swd[-1]+'.psz'):
+    chunk.addPhotos(photoset) 	# adds photos to project
+    doc.save(output+swd[-1]+'.psz') 	# names the Metashape Project file based on the last portion of swd
 
 
 ## Rename the chunk to the file name
@@ -89,7 +94,8 @@ chunk.label = os.path.splitext(os.path.basename(doc.path))[0]
 ### 3. Detect markers
 
 # NOTE: Tolerance is how sensitive the algorithm is to detecting targets. Range is 0 - 100. If tolerance is high, then there is risk of overdetecting markers (ie. thinks something is a marker that is not). If tole>
-chunk.detectMarkers(target_type = Metashape.CircularTarget12bit, tolerance=50, filter_mask=False, inverted=False, noparity=False, maximum_residual=5, minimum_size=0, minimum_dist=5)
+with stage_log.stage("detectMarkers", doc.path):
+    chunk.detectMarkers(target_type = Metashape.CircularTarget12bit, tolerance=50, filter_mask=False, inverted=False, noparity=False, maximum_residual=5, minimum_size=0, minimum_dist=5)
 
 
 
@@ -104,13 +110,15 @@ chunk.detectMarkers(target_type = Metashape.CircularTarget12bit, tolerance=50, f
 # Many of the details below are not doing anything at the moment, but they are also not hurting - so just leave for now! Can be used for refining in the future.
 	# Ex. subdivide_task is not doing anything now, BUT could be really useful in the future for a senario that divides work across multiple nodes.	
 
-chunk.matchPhotos(downscale = 1, keypoint_limit_per_mpx = 300, generic_preselection = True, reference_preselection=True, filter_mask=False, mask_tiepoints=True,
-			filter_stationary_points=True, keypoint_limit=40000, tiepoint_limit=4000, keep_keypoints=False, guided_matching=False,
-                    reset_matches=False, subdivide_task=True, workitem_size_cameras=20, workitem_size_pairs=80, max_workgroup_size=100)
-doc.save()
+with stage_log.stage("matchPhotos", doc.path):
+    chunk.matchPhotos(downscale = 1, keypoint_limit_per_mpx = 300, generic_preselection = True, reference_preselection=True, filter_mask=False, mask_tiepoints=True,
+    			filter_stationary_points=True, keypoint_limit=40000, tiepoint_limit=4000, keep_keypoints=False, guided_matching=False,
+                        reset_matches=False, subdivide_task=True, workitem_size_cameras=20, workitem_size_pairs=80, max_workgroup_size=100)
+    doc.save()
 
-chunk.alignCameras(adaptive_fitting = True, min_image=2, reset_alignment=False, subdivide_task=True)
-doc.save()
+with stage_log.stage("alignCameras", doc.path):
+    chunk.alignCameras(adaptive_fitting = True, min_image=2, reset_alignment=False, subdivide_task=True)
+    doc.save()
 
 
 
@@ -121,7 +129,8 @@ doc.save()
 crs_local = Metashape.CoordinateSystem('LOCAL_CS["Local Coordinates (m)",LOCAL_DATUM["Local Datum",0],UNIT["metre",1,AUTHORITY["EPSG","9001"]]]') # Defines crs as local coordinate system instead of WGS 84 (ESPSG::4326)
 
 # Set
-chunk.importReference(path = FragramCoords, format = Metashape.ReferenceFormatCSV, delimiter = ',', columns = "nXYZxyz", skip_rows = 2, crs = crs_local, ignore_labels=False, create_markers=False, threshold=0.1, shutter_lag=0)
+with stage_log.stage("importReference", doc.path):
+    chunk.importReference(path = FragramCoords, format = Metashape.ReferenceFormatCSV, delimiter = ',', columns = "nXYZxyz", skip_rows = 2, crs = crs_local, ignore_labels=False, create_markers=False, threshold=0.1, shutter_lag=0)
 # Additional options: columns = "nxyz", items = Metashape.ReferenceItemsMarkers
 
 chunk.updateTransform()
@@ -301,23 +310,26 @@ chunk.region.size = size
 # Select depth maps quality (downscale) based on the following scale: Ultra = 1, High = 2, Medium = 4, Low = 8, Lowest = 16
 	# Ultra will take 4x as long as High. Ultra also has a higher likelihood of having holes (lower settings can fill in larger holes). Will recommends using high or medium quality (ultra is not better!).
 	# Wyatt had it at low quality (8), possibly just to make it run faster?
-chunk.buildDepthMaps(downscale = 2, filter_mode = Metashape.MildFiltering, reuse_depth = True, max_neighbors=16, subdivide_task=True, workitem_size_cameras=20, max_workgroup_size=100)
-doc.save()
+with stage_log.stage("buildDepthMaps", doc.path):
+    chunk.buildDepthMaps(downscale = 2, filter_mode = Metashape.MildFiltering, reuse_depth = True, max_neighbors=16, subdivide_task=True, workitem_size_cameras=20, max_workgroup_size=100)
+    doc.save()
 
 # NOTES:
 # face_count=Metashape.HighFaceCount means that Metashape uses as many triangles as it thinks it needs to represent the mesh (mesh = series of interconnected triangles that represent the surface) vs. forcing it to use fewer triangles with LowFaceCount.
 	# If you set it to high then it ignores the face_count_custom
 	# Wyatt had face_count=Metashape.LowFaceCount - which is not preferable.
-chunk.buildModel(surface_type = Metashape.Arbitrary, interpolation = Metashape.EnabledInterpolation, face_count=Metashape.HighFaceCount, 
-				face_count_custom = 1000000, source_data = Metashape.DepthMapsData, keep_depth = False) # change this to false to avoid wasted space? 
-doc.save()
+with stage_log.stage("buildModel", doc.path):
+    chunk.buildModel(surface_type = Metashape.Arbitrary, interpolation = Metashape.EnabledInterpolation, face_count=Metashape.HighFaceCount, 
+    				face_count_custom = 1000000, source_data = Metashape.DepthMapsData, keep_depth = False) # change this to false to avoid wasted space? 
+    doc.save()
 
 
 ### 2. Clean Model
 # This removes shards and leaves only the big coral mesh behind
 
 # This only works with 2.2.1
-chunk.model.cleanModel(criterion=Metashape.Model.Criterion.ComponentSize, level=99)
+with stage_log.stage("cleanModel", doc.path):
+    chunk.model.cleanModel(criterion=Metashape.Model.Criterion.ComponentSize, level=99)
 
 # Theres's a chance this works with 1.8.3 but need to test. Tried this once and it didnt work.
 #chunk.model.removeComponents(max_components=1)
@@ -329,9 +341,11 @@ chunk.model.cleanModel(criterion=Metashape.Model.Criterion.ComponentSize, level=
 # chunk.buildUV and chunk.buildTexture are not necessary. They are simply a visual tool. Remove these to reduce processing time.
 # If the output is too pixelated, increase the texture_size up to 8192x2 (always increase in groupings of 8192). 
 	# Wyatt originally had texture_size=25000 which may be why models were taking so long to build and why their file sizes were huge.
-chunk.buildUV(mapping_mode=Metashape.GenericMapping) #part of build texture step
-chunk.buildTexture(blending_mode=Metashape.MosaicBlending, texture_size=8192, fill_holes=True) #rest of build texture step
-doc.save()
+with stage_log.stage("buildUV", doc.path):
+    chunk.buildUV(mapping_mode=Metashape.GenericMapping) #part of build texture step
+with stage_log.stage("buildTexture", doc.path):
+    chunk.buildTexture(blending_mode=Metashape.MosaicBlending, texture_size=8192, fill_holes=True) #rest of build texture step
+    doc.save()
 
 
 # List of other Metashape functions that could be applicable in the future:
@@ -356,11 +370,13 @@ doc.save()
 
  
 ### 2. Export products as .OBJ (and other supplementary files) for use in MeshLab
-chunk.exportModel(output+swd[-1]+".obj", binary=True, precision=6, save_normals=True, save_colors=True, save_cameras=True, save_markers=True, save_udim=False, strip_extensions=False)
+with stage_log.stage("exportModel", output+swd[-1]+".obj"):
+    chunk.exportModel(output+swd[-1]+".obj", binary=True, precision=6, save_normals=True, save_colors=True, save_cameras=True, save_markers=True, save_udim=False, strip_extensions=False)
 
 
 ### 3. Generate report
 # Option to add a description beneath the title. Ex. description = "Processing report for ORCC October 2022 Rack Model - Timepoint 0"
-chunk.exportReport(path = output+swd[-1]+"_report.pdf", title = swd[-1], font_size=12, page_numbers=True, include_system_info=True)
+with stage_log.stage("exportReport", output+swd[-1]+"_report.pdf"):
+    chunk.exportReport(path = output+swd[-1]+"_report.pdf", title = swd[-1], font_size=12, page_numbers=True, include_system_info=True)
 
 doc.save()
@@ -0,0 +1,12 @@
+# PURPOSE: Entry point for running a whole batch (manifest) inside one Metashape process. See metashape_batch/runner.py.
+# Ex: bash metashape.sh -r /scratch1/migomez/metashape_batch_process/scripts/run_batch.py ToRun/SinglePolyp/090425/manifest.json -platform offscreen
+
+import os
+import sys
+
+# Make the metashape_batch package (one directory up) importable from Metashape's python.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(globals().get("__file__", sys.argv[0])))))
+
+from metashape_batch import runner
+
+sys.exit(runner.main())